@@ -0,0 +1,65 @@
+# Timing runs for the learner on the bundled lexica
+
+import argparse
+import io, contextlib
+from timeit import default_timer as timer
+
+from utils import *
+from mgagr import file_to_mg
+
+
+def plain_mg(curr_name): # read an agreement lexicon, dropping morphological features: {LI name: Bundle}
+    start, lis, eqs = file_to_mg(curr_name)
+    mg, reps, seen = {}, {}, set()
+    for sem, sb in lis:
+        b = Bundle(Feature(f.type, f.name) for f in sb)
+        if not (sem, b) in seen: # unpacked agreement variants collapse into one LI
+            seen.add((sem, b))
+            new_name, reps = li_name(sem, reps)
+            mg[new_name] = b
+    return start, mg
+
+
+def time_it(f, repeat):
+    times = []
+    for i in range(repeat):
+        t = timer()
+        with contextlib.redirect_stdout(io.StringIO()): # the optimizer reports every level
+            result = f()
+        times.append(timer() - t)
+    return min(times), result
+
+
+def bench_bundle_hash(curr_name, beam_size, repeat): # transform_mg with repr-based vs. structural Bundle hashes
+    import optimize
+
+    start, mg = plain_mg(curr_name)
+    orig_mg, orig_eqs, mor_to_str = optimize.preprocess_mg(mg, start)
+    config = optimize.Config(beam_size=beam_size, grammar_cost=optimize.mdl_2d, overall_cost=optimize.hsize_grammar)
+    run = lambda: optimize.run_search(optimize.Corpus(start, [], None, orig_mg, dict(orig_eqs), mor_to_str), config)
+
+    structural_hash = Bundle.__hash__
+    Bundle.__hash__ = lambda self: hash(repr(self)) # previous implementation
+    time_repr, (result_repr, cost_repr) = time_it(run, repeat)
+    Bundle.__hash__ = structural_hash
+    time_struct, (result_struct, cost_struct) = time_it(run, repeat)
+
+    print("transform_mg on {}, beam size {}:".format(curr_name, beam_size))
+    print("  repr hash:       {:0.3f}s, cost ({:0.2f}, {:0.2f})".format(time_repr, *cost_repr))
+    print("  structural hash: {:0.3f}s, cost ({:0.2f}, {:0.2f})".format(time_struct, *cost_struct))
+    print("  speedup: {:0.2f}x".format(time_repr / time_struct))
+
+
+benchmarks = {
+    'bundle_hash': bench_bundle_hash,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=benchmarks.keys())
+    parser.add_argument('-g', '--grammar', action='store', type=str, default='eng')
+    parser.add_argument('-bs', '--beam_size', action='store', type=int, default=100)
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmarks[args.benchmark](args.grammar, args.beam_size, args.repeat)
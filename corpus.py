@@ -0,0 +1,214 @@
+# Corpus files: derivation trees and the rule table as flat integer arrays, read lazily through mmap
+
+import json
+import mmap
+import sys
+from array import array
+from collections.abc import Sequence
+from functools import cached_property
+
+from utils import *
+from grammars import Chain, Expression, Rule_data, LI_usage
+
+corpus_magic = b"MGCORPUS"
+corpus_version = 1
+int_code = 'i' # 4-byte signed integers in every section
+sections = ['lefts', 'rule_lhs', 'rule_term', 'rule_map', 'rhs_start', 'rhs', 'usage_start', 'usage_li', 'usage_ind', 'usage_num', 'tree_start', 'nodes']
+
+# Values are stored by field, not by class, so that the format survives changes to the classes themselves
+def encode(x):
+    if x is None or isinstance(x, (str, int, float, bool)): return x
+    elif isinstance(x, Expression): return ["E"] + [encode(c) for c in x]
+    elif isinstance(x, Chain): return ["C", encode(x.type), encode(x.features)]
+    elif isinstance(x, SBundle): return ["SB"] + [encode(f) for f in x]
+    elif isinstance(x, SFeature): return ["SF", encode(x.type), x.name, encode(x.cin), encode(x.cout)]
+    elif isinstance(x, MBundle): return ["MB"] + [encode(f) for f in x]
+    elif isinstance(x, MFeature): return ["MF", x.name, x.value, x.is_lex]
+    elif isinstance(x, Bundle): return ["B"] + [encode(f) for f in x]
+    elif isinstance(x, Feature): return ["F", encode(x.type), x.val]
+    elif isinstance(x, tuple): return ["T"] + [encode(y) for y in x]
+    elif isinstance(x, list): return ["L"] + [encode(y) for y in x]
+    else: raise Exception("Cannot store {} in a corpus file".format(type(x).__name__))
+
+decoders = {
+    "E": lambda xs: Expression(decode(x) for x in xs),
+    "C": lambda xs: Chain(decode(xs[0]), decode(xs[1])),
+    "SB": lambda xs: SBundle(decode(x) for x in xs),
+    "SF": lambda xs: SFeature(decode(xs[0]), xs[1], decode(xs[2]), decode(xs[3])),
+    "MB": lambda xs: MBundle(decode(x) for x in xs),
+    "MF": lambda xs: MFeature(*xs),
+    "B": lambda xs: Bundle(decode(x) for x in xs),
+    "F": lambda xs: Feature(decode(xs[0]), xs[1]),
+    "T": lambda xs: tuple(decode(x) for x in xs),
+    "L": lambda xs: [decode(x) for x in xs],
+}
+
+def decode(x):
+    if isinstance(x, list): return decoders[x[0]](x[1:])
+    return x
+
+
+class Symbols: # interns values as consecutive integers
+    def __init__(self):
+        self.ids, self.values = {}, []
+
+    def __call__(self, x):
+        key = (type(x), x) # an Expression equals the plain tuple of its chains
+        if not key in self.ids:
+            self.ids[key] = len(self.values)
+            self.values.append(x)
+        return self.ids[key]
+
+
+def flatten_tree(t, symbols, nodes): # preorder; a node is (2*label + is_term, number of children), a leaf is (LI, string)
+    stack = [t]
+    while stack:
+        t = stack.pop()
+        (label, is_term), children = t[0], t[1:]
+        nodes.extend((2 * symbols(label) + is_term, len(children)))
+        if is_term:
+            for c in children: nodes.extend((symbols(c[0]), symbols(c[1])))
+        else: stack.extend(reversed(children))
+
+
+def write_corpus(path, head_name, examples, mcfg, mg, eqs, solution):
+    symbols, maps = Symbols(), Symbols()
+    arrays = {name: array(int_code) for name in sections}
+
+    for left, rights in mcfg.items():
+        arrays['lefts'].append(symbols(left))
+        for right, data in rights.items():
+            arrays['rule_lhs'].append(symbols(left))
+            arrays['rule_term'].append(int(data.is_term))
+            arrays['rule_map'].append(-1 if data.mcfg_map is None else maps(data.mcfg_map))
+            arrays['rhs_start'].append(len(arrays['rhs']))
+            arrays['rhs'].extend(symbols(r) for r in right)
+            arrays['usage_start'].append(len(arrays['usage_li']))
+            for li, usage in data.usage.items():
+                arrays['usage_li'].append(symbols(li))
+                arrays['usage_ind'].append(-1 if usage.ind is None else usage.ind)
+                arrays['usage_num'].append(usage.num)
+    arrays['rhs_start'].append(len(arrays['rhs']))
+    arrays['usage_start'].append(len(arrays['usage_li']))
+
+    for t in examples:
+        arrays['tree_start'].append(len(arrays['nodes']))
+        flatten_tree(t, symbols, arrays['nodes'])
+    arrays['tree_start'].append(len(arrays['nodes']))
+
+    header = {
+        'version': corpus_version, 'byteorder': sys.byteorder, 'sections': {},
+        'symbols': [encode(x) for x in symbols.values], 'maps': [encode(x) for x in maps.values],
+        'grammar': encode([head_name, list(mg.items()), list(eqs.items()), list(solution.items())]),
+    }
+    offset = 0
+    for name in sections: # offsets from the end of the header, in bytes
+        header['sections'][name] = [offset, len(arrays[name])]
+        offset += len(arrays[name]) * arrays[name].itemsize
+    header_bytes = json.dumps(header, ensure_ascii=False).encode()
+
+    with open(path, 'wb') as f:
+        f.write(corpus_magic)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name in sections: arrays[name].tofile(f)
+
+
+class Stored_trees(Sequence): # derivation trees, rebuilt one at a time on access
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __len__(self):
+        return len(self.corpus.section('tree_start')) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError("tree index out of range")
+        return self.corpus.unflatten_tree(self.corpus.section('tree_start')[i])[0]
+
+
+class Stored_corpus: # a corpus file; every part is decoded on first use
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(corpus_magic)) != corpus_magic: raise Exception("{} is not a corpus file".format(path))
+            header_len = int.from_bytes(f.read(8), 'little')
+            self.header = json.loads(f.read(header_len).decode())
+            if self.header['version'] != corpus_version:
+                raise Exception("{}: corpus format version {}, expected {}".format(path, self.header['version'], corpus_version))
+            self.data_start = len(corpus_magic) + 8 + header_len
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sections = {}
+        self.symbols = [None] * len(self.header['symbols'])
+        self.examples = Stored_trees(self)
+
+    def section(self, name):
+        if not name in self.sections:
+            offset, n = self.header['sections'][name]
+            start = self.data_start + offset
+            if self.header['byteorder'] == sys.byteorder:
+                self.sections[name] = memoryview(self.data)[start:start + 4 * n].cast(int_code)
+            else: # written on a machine with the other byte order
+                self.sections[name] = array(int_code, self.data[start:start + 4 * n])
+                self.sections[name].byteswap()
+        return self.sections[name]
+
+    def symbol(self, i):
+        if self.symbols[i] is None: self.symbols[i] = decode(self.header['symbols'][i])
+        return self.symbols[i]
+
+    def unflatten_tree(self, pos): # returns the tree starting at pos and the position after it
+        nodes = self.section('nodes')
+        root, stack = None, [] # [tree, children still to read] for each inner node being read
+        while True:
+            code, n_children = nodes[pos], nodes[pos + 1]
+            t, pos = [(self.symbol(code // 2), bool(code % 2))], pos + 2
+            if code % 2: # the leaves follow the node
+                for j in range(n_children):
+                    t.append((self.symbol(nodes[pos]), self.symbol(nodes[pos + 1])))
+                    pos += 2
+            if root == None: root = t
+            else: # t is the next child of the innermost unfinished node
+                stack[-1][0].append(t)
+                stack[-1][1] -= 1
+            if not code % 2 and n_children: stack.append([t, n_children])
+            while stack and stack[-1][1] == 0: stack.pop()
+            if not stack: return root, pos
+
+    @cached_property
+    def grammar(self):
+        return decode(self.header['grammar'])
+
+    @cached_property
+    def head_name(self):
+        return self.grammar[0]
+
+    @cached_property
+    def mg(self):
+        return dict(self.grammar[1])
+
+    @cached_property
+    def eqs(self):
+        return dict(self.grammar[2])
+
+    @cached_property
+    def solution(self):
+        return dict(self.grammar[3])
+
+    @cached_property
+    def mcfg(self):
+        maps = [decode(m) for m in self.header['maps']]
+        rule_lhs, rule_term, rule_map = self.section('rule_lhs'), self.section('rule_term'), self.section('rule_map')
+        rhs_start, rhs = self.section('rhs_start'), self.section('rhs')
+        usage_start, usage_li, usage_ind, usage_num = self.section('usage_start'), self.section('usage_li'), self.section('usage_ind'), self.section('usage_num')
+
+        mcfg = {self.symbol(left): {} for left in self.section('lefts')}
+        for r in range(len(rule_lhs)):
+            right = tuple(self.symbol(x) for x in rhs[rhs_start[r]:rhs_start[r+1]])
+            usage = {self.symbol(usage_li[u]): LI_usage(None if usage_ind[u] == -1 else usage_ind[u], usage_num[u]) for u in range(usage_start[r], usage_start[r+1])}
+            mcfg[self.symbol(rule_lhs[r])][right] = Rule_data(bool(rule_term[r]), usage, None if rule_map[r] == -1 else maps[rule_map[r]])
+        return mcfg
+
+
+def read_corpus(path):
+    return Stored_corpus(path)
@@ -2,8 +2,9 @@
 # MG to MCFG, file to MG, MG to file, sentence generators
 
 from utils import *
-from sys import maxsize
+import math
 import random
+import multiprocessing
 
 title_line = '{} {{}}'.format(datetime.now().isoformat(' ', 'seconds')) # curr_name
 
@@ -16,22 +17,39 @@ template_mg = '''/{}/
 ''' # name, start category, LIs
 
 
-class Chain: # type and syntactic feature configuration
-    def __init__(self, type, features, strip_mfeats=False):
-        self.type = type # atomic, derived, covert
-        self.features = SBundle((f.stripped() for f in features) if strip_mfeats else features)
+class Chain(Interned): # type and syntactic feature configuration
+    __slots__ = ('type', 'features', 'id')
+    table, by_id = {}, []
+    
+    def __new__(cls, type, features, strip_mfeats=False):
+        key = (type, SBundle((f.stripped() for f in features) if strip_mfeats else features)) # atomic, derived, covert
+        try: return cls.table[key]
+        except KeyError:
+            c = object.__new__(cls)
+            c.type, c.features = key
+            return cls.register(c, key)
+    def __reduce__(self):
+        return (Chain, (self.type, self.features))
     def __repr__(self):
         return "{} {}".format(self.type, pf(self.features))        
-    def __members(self):
-        return (self.type, self.features)
-    def __eq__(self, other):
-        return type(other) is type(self) and self.__members() == other.__members()
-    def __hash__(self):
-        return hash(self.__members())
     def __len__(self):
         return len(self.features)
 
 
+class Expression(tuple): # tuple of chains; indexes licensees once, at creation
+    def __new__(cls, chains):
+        exp = super(Expression, cls).__new__(cls, tuple(chains))
+        exp.movers = {} # {vanilla licensee name: indices of non-initial chains starting with it}
+        for i, c in enumerate(exp[1:], 1):
+            if is_lee(c.features[0]):
+                dict_append_rep(exp.movers, c.features[0].vanilla().name, i)
+        nchain_names = [c.features[0].name for c in exp[1:]] # first feature names of all non-initial chains
+        lee_names = [c.features[0].name for c in exp if is_lee(c.features[0])]
+        exp.smc = len(nchain_names) == len(set(nchain_names)) # check uniqueness
+        exp.smc_one_op = len(lee_names) == len(set(lee_names))
+        return exp
+
+
 # start_exp_fun = lambda hn: (Chain(derived, SBundle([SFeature(cat, hn),])),) # NOTE: assuming that :: s is not a thing
 
 
@@ -97,27 +115,27 @@ map_start = (((0,0), (0,1), (0,2)),)
 def mrg_right(exp1, exp2, is_mcfg=True): # final right merge
     newsubexp = Chain(derived, exp1[0].features[1:])
     mcfg_map = map_mrg_right(map_movers(exp1, 0), map_movers(exp2, 1)) if is_mcfg else None
-    result = (newsubexp,) + exp1[1:] + exp2[1:]
+    result = Expression((newsubexp,) + exp1[1:] + exp2[1:])
     return result, mcfg_map
 
 
 def mrg_right_s(exp1, exp2, is_mcfg=True): # final right strong merge
     newsubexp = Chain(derived, exp1[0].features[1:])
     mcfg_map = map_mrg_right_s(map_movers(exp1, 0), map_movers(exp2, 1)) if is_mcfg else None
-    result = (newsubexp,) + exp1[1:] + exp2[1:]
+    result = Expression((newsubexp,) + exp1[1:] + exp2[1:])
     return result, mcfg_map
 
 
 def mrg_right_w(exp1, exp2, is_mcfg=True): # final right weak merge
     newsubexp = Chain(derived, exp1[0].features[1:])
     mcfg_map = map_mrg_right_w(map_movers(exp1, 0), map_movers(exp2, 1)) if is_mcfg else None
-    result = (newsubexp,) + exp1[1:] + exp2[1:]
+    result = Expression((newsubexp,) + exp1[1:] + exp2[1:])
     return result, mcfg_map
 
 def mrg_left(exp1, exp2, is_mcfg=True): # final left merge
     newsubexp = Chain(derived, exp1[0].features[1:])
     mcfg_map = map_mrg_left(map_movers(exp1, 0), map_movers(exp2, 1)) if is_mcfg else None
-    result = (newsubexp,) + exp1[1:] + exp2[1:]
+    result = Expression((newsubexp,) + exp1[1:] + exp2[1:])
     return result, mcfg_map
 
 
@@ -125,14 +143,14 @@ def mrg_nonfinal(exp1, exp2, is_mcfg=True): # nonfinal merge
     newsubexp = Chain(derived, exp1[0].features[1:])
     newmover = Chain(derived, exp2[0].features[1:])
     mcfg_map = map_mrg_nonfinal(map_movers(exp1, 0), map_movers(exp2, 1)) if is_mcfg else None
-    result = (newsubexp,) + exp1[1:] + (newmover,) + exp2[1:]
+    result = Expression((newsubexp,) + exp1[1:] + (newmover,) + exp2[1:])
     return result, mcfg_map
     
 def mrg_right_cov(exp1, exp2, is_mcfg=True): # nonfinal right merge of a covert mover
     newsubexp = Chain(derived, exp1[0].features[1:])
     newmover = Chain(covert, exp2[0].features[1:])
     mcfg_map = map_mrg_right_cov(map_movers(exp1, 0), map_movers(exp2, 1)) if is_mcfg else None
-    result = (newsubexp,) + exp1[1:] + (newmover,) + exp2[1:]
+    result = Expression((newsubexp,) + exp1[1:] + (newmover,) + exp2[1:])
     return result, mcfg_map
 
 
@@ -140,14 +158,14 @@ def mrg_left_cov(exp1, exp2, is_mcfg=True): # nonfinal left merge of a covert mo
     newsubexp = Chain(derived, exp1[0].features[1:])
     newmover = Chain(covert, exp2[0].features[1:])
     mcfg_map = map_mrg_left_cov(map_movers(exp1, 0), map_movers(exp2, 1)) if is_mcfg else None
-    result = (newsubexp,) + exp1[1:] + (newmover,) + exp2[1:]
+    result = Expression((newsubexp,) + exp1[1:] + (newmover,) + exp2[1:])
     return result, mcfg_map
 
 
 def mv_final(exp, ind, is_mcfg=True): # exp: expression, ind: mover's index; final move
     newsubexp = Chain(derived, exp[0].features[1:])
     mcfg_map = map_mv_final(map_movers(exp, 0, ind+2), ind+2) if is_mcfg else None
-    result = (newsubexp,) + exp[1:ind] + exp[ind+1:]
+    result = Expression((newsubexp,) + exp[1:ind] + exp[ind+1:])
     return result, mcfg_map
 
 
@@ -155,7 +173,7 @@ def mv_nonfinal(exp, ind, is_mcfg=True): # exp: expression, ind: mover's index;
     newsubexp = Chain(derived, exp[0].features[1:])
     newmover = Chain(derived, exp[ind].features[1:])
     mcfg_map = map_mv_nonfinal(map_movers(exp, 0)) if is_mcfg else None
-    result = (newsubexp,) + exp[1:ind] + (newmover,) + exp[ind+1:]
+    result = Expression((newsubexp,) + exp[1:ind] + (newmover,) + exp[ind+1:])
     return result, mcfg_map
 
 
@@ -163,17 +181,12 @@ def mv_nonfinal_cov(exp, ind, is_mcfg=True): # exp: expression, ind: mover's ind
     newsubexp = Chain(derived, exp[0].features[1:])
     newmover = Chain(covert, exp[ind].features[1:])
     mcfg_map = map_mv_cov(map_movers(exp, 0, ind+2), ind+2) if is_mcfg else None
-    result = (newsubexp,) + exp[1:ind] + (newmover,) + exp[ind+1:]
+    result = Expression((newsubexp,) + exp[1:ind] + (newmover,) + exp[ind+1:])
     return result, mcfg_map
 
 
-def smc_compliant(exp, one_op=False):
-    if one_op:
-        nchain_names = [c.features[0].name for c in exp if is_lee(c.features[0])]
-        pass
-    else:
-        nchain_names = [c.features[0].name for c in exp[1:]] # first feature names of all non-initial chains
-    return len(nchain_names) == len(set(nchain_names)) # check uniqueness
+def smc_compliant(exp, one_op=False): # uniqueness of first feature names is recorded when the expression is built
+    return exp.smc_one_op if one_op else exp.smc
 
  
 fun = { # {(positive feature type, whether selectee/licensee will move) : [function(s) to run]}
@@ -192,14 +205,21 @@ fun = { # {(positive feature type, whether selectee/licensee will move) : [funct
 }
 
 
-def update_exps(mcfg_dict, feat_to_exp, one_op):
+def update_exps(mcfg_dict, feat_to_exp, one_op, delta=None): # delta: {first feature: expressions new in the last pass}; None to combine everything
     new_exps = set()
 
     for first_feat, exps in feat_to_exp.items():
+        mrg_neg_type = lee if one_op else cat
+        mrg_key = SFeature(type=mrg_neg_type, name=first_feat.name, cin=first_feat.cout, cout=first_feat.cin)
+        new_in_feat = set() if delta is None else delta.get(first_feat, set())
+        lic_name = first_feat.vanilla().name if is_lic(first_feat) else None
+        if delta is not None and not new_in_feat and not mrg_key in delta:
+            continue # nothing new to combine with: every rule from this group is already known
+
         for exp in exps: # iterate over exps
+            is_new = delta is None or exp in new_in_feat
 
             if one_op:
-                mrg_neg_type = lee
                 if len(exp[0].features) < 2 or not is_lic(exp[0].features[0]):
                     continue
                 elif any(is_lee(c.features[0]) and c.features[0].name == first_feat.name for c in exp[1:]):
@@ -211,14 +231,13 @@ def update_exps(mcfg_dict, feat_to_exp, one_op):
                     do_move = False
                     fun_type = rsel if exp[0].type == atomic else lsel
             else:
-                mrg_neg_type = cat
                 do_merge = is_sel(first_feat)
                 do_move = is_lic(first_feat)
                 fun_type = first_feat.type
 
             if do_merge: # apply Merge
-                try: 
-                    matches = feat_to_exp[SFeature(type=mrg_neg_type, name=first_feat.name, cin=first_feat.cout, cout=first_feat.cin)]
+                try: # a new expression combines with everything; an old one only with new matches
+                    matches = (feat_to_exp if is_new else delta)[mrg_key]
                 except KeyError: matches = []
 
                 for m in matches: # for every matching expression
@@ -230,8 +249,8 @@ def update_exps(mcfg_dict, feat_to_exp, one_op):
                             mcfg_dict.setdefault(result, {}) # if the LHS is not present
                             mcfg_dict[result].setdefault((exp, m), Rule_data(False, {}, mcfg_map)) # if the RHS is not present
 
-            elif do_move: # apply Move
-                move_indices = [ind for ind in range(1, len(exp)) if is_lee(exp[ind].features[0]) and exp[ind].features[0].vanilla().name == first_feat.vanilla().name] # TODO: compatibility if some channels are closed
+            elif do_move and is_new: # apply Move; unary, so old expressions have nothing new to offer
+                move_indices = exp.movers.get(lic_name, []) # TODO: compatibility if some channels are closed
                 if len(move_indices) == 1: # check for a unique, matching licensee
                     mover_ind = move_indices[0]
                     if (exp[mover_ind].type==covert) == (first_feat.type==clic): # make sure mover type matches licensor type
@@ -246,32 +265,37 @@ def update_exps(mcfg_dict, feat_to_exp, one_op):
     return new_exps, mcfg_dict
 
 
-def closure(mcfg_dict, feat_to_exp, one_op):
+def closure(mcfg_dict, feat_to_exp, one_op=False, semi_naive=False, delta=None): # delta: expressions to start from, already in feat_to_exp
+    semi_naive = semi_naive or delta is not None
+    if semi_naive and delta is None: delta = dict(feat_to_exp) # everything is new in the first pass
+    
     while True: # close the set of expressions under Merge and Move  
-        new_exps, mcfg_dict = update_exps(mcfg_dict, feat_to_exp, one_op)
+        new_exps, mcfg_dict = update_exps(mcfg_dict, feat_to_exp, one_op, delta)
         updated = False
+        if semi_naive: delta = {}
 
         for new_exp in new_exps:
             new_first_feat = new_exp[0].features[0] # NOTE: make this vanilla?
             if not in_dict(feat_to_exp, new_first_feat, new_exp): # check if exp is new
                 dict_append(feat_to_exp, new_first_feat, new_exp, True)
+                if semi_naive: dict_append(delta, new_first_feat, new_exp, True)
                 updated = True
         if not updated: break
 
     return mcfg_dict
 
 
-def mg2mcfg(mg, start_name, useful=False, one_op=False): # TODO: fix start expression(s) -- t/s can also carry mbundles!
+def mg2mcfg(mg, start_name, useful=False, one_op=False, semi_naive=False): # TODO: fix start expression(s) -- t/s can also carry mbundles!
     feat_to_exp = {}
     mcfg_dict = {}
     
     for right, left in mg.items(): # generate terminal rules and expressions
-        li_exp = (Chain(atomic, left, strip_mfeats=False),)
+        li_exp = Expression((Chain(atomic, left, strip_mfeats=False),))
         dict_append(feat_to_exp, left[0], li_exp, True) # NOTE: make this vanilla?
         mcfg_dict.setdefault(li_exp, {})
         mcfg_dict[li_exp][(right,)] = Rule_data(True, {})
 
-    mcfg_dict = closure(mcfg_dict, feat_to_exp, one_op) # generate nonterminal rules
+    mcfg_dict = closure(mcfg_dict, feat_to_exp, one_op, semi_naive) # generate nonterminal rules
 
     mcfg_dict[start_symbol] = {}
     for left in mcfg_dict: # generalization: add S --> t for every t that is _a_ start configuration
@@ -285,37 +309,35 @@ def mg2mcfg(mg, start_name, useful=False, one_op=False): # TODO: fix start expre
 
 
 def rule_heads(mcfg): # record possible head LIs for each LHS expression; should not overwrite existing usage data
-    rule_heads_aux.mcfg = mcfg
-    rule_heads_aux.exp_to_heads = {}
-    rule_heads_aux(start_symbol, set())
-    return rule_heads_aux.mcfg
+    rule_heads_aux(mcfg, {}, start_symbol, set())
+    return mcfg
 
 
-def rule_heads_aux(left, ancestors):
+def rule_heads_aux(mcfg, exp_to_heads, left, ancestors):
     left_heads = {} # all LIs that can be the head of this expression
     if left in ancestors: return
     ancestors.add(left)
 
-    for right in rule_heads_aux.mcfg[left]: # rule is fully determined by left and right
-        if right[0] in rule_heads_aux.exp_to_heads:
-            heir_heads = rule_heads_aux.exp_to_heads[right[0]]
-        elif rule_heads_aux.mcfg[left][right].is_term == True:
+    for right in mcfg[left]: # rule is fully determined by left and right
+        if right[0] in exp_to_heads:
+            heir_heads = exp_to_heads[right[0]]
+        elif mcfg[left][right].is_term == True:
             heir_heads = {right[0]:-1}    
         else:
-            heir_heads = rule_heads_aux(right[0], ancestors)
+            heir_heads = rule_heads_aux(mcfg, exp_to_heads, right[0], ancestors)
         allowed_heads = {m:i+1 for m, i in heir_heads.items()}
             
         for right_arg in right[1:]: # run the function for nonfirst argument(s)
-            if right_arg not in rule_heads_aux.exp_to_heads:
-                rule_heads_aux(right_arg, ancestors)
+            if right_arg not in exp_to_heads:
+                rule_heads_aux(mcfg, exp_to_heads, right_arg, ancestors)
 
         for m, i in allowed_heads.items():
             left_m = left_heads.setdefault(m, i) # update list of heads for the left-hand side expression
-            rule_m = rule_heads_aux.mcfg[left][right].usage.setdefault(m, LI_usage(i, 0)) # update usage of the rule (right, left)
+            rule_m = mcfg[left][right].usage.setdefault(m, LI_usage(i, 0)) # update usage of the rule (right, left)
             if not (left_m == rule_m.ind == i):
                 raise Exception("An LI produced the same expression at different steps. This shouldn't be possible.")
     
-    rule_heads_aux.exp_to_heads[left] = left_heads
+    exp_to_heads[left] = left_heads
     return left_heads
 
 
@@ -354,6 +376,184 @@ def rules_useful(rules, qreach_init=start_symbol): # remove useless rules, given
     return rules_generating
 
 
+class Incremental_mcfg: # MCFG of an MG, kept up to date as single LIs are added, removed or changed
+    def __init__(self, mg, start_name, one_op=False):
+        self.mg = {}
+        self.start_name = start_name
+        self.one_op = one_op
+        self.feat_to_exp = {} # {first feature: set of expressions}
+        self.rules = {start_symbol:{}} # {left: {right: Rule_data}}, as produced by mg2mcfg
+        self.uses = {} # {expression: set of (left, right) with the expression on the right}
+        self.heads = {start_symbol:{}} # {expression: {LI: index}}
+        self.reachable = {start_symbol}
+
+        new_exps = set()
+        for name, sb in mg.items():
+            li_exp = self.add_term(name, sb)
+            if not in_dict(self.feat_to_exp, li_exp[0].features[0], li_exp): new_exps.add(li_exp)
+        self.extend(new_exps, [(exp, right) for exp in new_exps for right in self.rules[exp]])
+
+    def mcfg(self, useful=False): # the current (M)CFG; rule dictionaries are shared, not copied
+        if useful: return {left:self.rules[left] for left in self.reachable if self.rules[left]}
+        else: return self.rules
+
+    def add_li(self, name, sb):
+        if name in self.mg: raise Exception("This LI is already in the grammar: {}".format(name))
+        li_exp = self.add_term(name, sb)
+        if in_dict(self.feat_to_exp, li_exp[0].features[0], li_exp): self.extend(set(), [(li_exp, (name,))]) # only a new head
+        else: self.extend({li_exp}, [(li_exp, (name,))])
+
+    def remove_li(self, name):
+        li_exp = Expression((Chain(atomic, self.mg.pop(name)),))
+        del self.rules[li_exp][(name,)]
+        
+        affected = self.upward({li_exp}) # everything that might have needed this LI
+        alive = self.rederive(affected)
+        alive.add(start_symbol) # kept even without rules, as in mg2mcfg
+        dead = affected.difference(alive)
+        
+        removed = [(left, right) for exp in dead for (left, right) in self.uses.get(exp, ())] # rules using a dead expression
+        removed.extend((exp, right) for exp in dead for right in self.rules[exp])
+        for left, right in removed: self.drop_rule(left, right)
+        for exp in dead:
+            self.feat_to_exp[exp[0].features[0]].discard(exp)
+            del self.rules[exp], self.heads[exp]
+            self.uses.pop(exp, None)
+        
+        new_heads = {}
+        for exp in affected.intersection(alive): self.recompute_heads(exp, affected, new_heads)
+        self.heads.update(new_heads)
+
+        lost = self.reachable.intersection(dead)
+        self.reachable.difference_update(lost)
+        unreached = self.unreach([right for left, right in removed if left in self.reachable or left in lost])
+        for exp in affected.intersection(self.reachable).union(unreached): self.annotate(exp)
+
+    def replace_li(self, name, sb):
+        if self.mg[name] != sb:
+            self.remove_li(name)
+            self.add_li(name, sb)
+
+    def add_term(self, name, sb):
+        self.mg[name] = sb
+        li_exp = Expression((Chain(atomic, sb, strip_mfeats=False),))
+        self.rules.setdefault(li_exp, {})
+        self.rules[li_exp][(name,)] = Rule_data(True, {})
+        self.heads.setdefault(li_exp, {})
+        return li_exp
+
+    def extend(self, new_exps, new_rules): # close over new expressions, then update heads and reachability
+        delta = {}
+        for exp in new_exps:
+            dict_append(self.feat_to_exp, exp[0].features[0], exp, True)
+            dict_append(delta, exp[0].features[0], exp, True)
+        added = closure({}, self.feat_to_exp, self.one_op, delta=delta) # every rule here involves a new expression
+        
+        new_exps = new_exps.union(left for left in added if not left in self.rules)
+        for left in new_exps:
+            self.rules.setdefault(left, {})
+            self.heads.setdefault(left, {})
+            if is_start(self.start_name, left, self.one_op):
+                self.rules[start_symbol][(left,)] = Rule_data(False, {}, map_start)
+                new_rules.append((start_symbol, (left,)))
+        for left, rights in added.items():
+            for right, data in rights.items():
+                self.rules[left][right] = data
+                new_rules.append((left, right))
+        for left, right in new_rules:
+            if not self.rules[left][right].is_term:
+                for exp in right: self.uses.setdefault(exp, set()).add((left, right))
+
+        grown = self.grow_heads(new_rules)
+        reached = self.reach([right for left, right in new_rules if left in self.reachable])
+        changed = reached.union(grown, (left for left, right in new_rules))
+        changed.update(l for exp in grown for (l, r) in self.uses.get(exp, ()) if r[0] == exp) # rules headed by a grown expression
+        for exp in changed.intersection(self.reachable): self.annotate(exp)
+
+    def rule_heads(self, left, right): # heads a rule passes on to its left-hand side
+        if self.rules[left][right].is_term: return {right[0]:0}
+        else: return {m:i+1 for m, i in self.heads[right[0]].items()}
+
+    def grow_heads(self, new_rules): # propagate heads along first arguments; returns expressions whose heads changed
+        grown, queue = set(), list(new_rules)
+        while queue:
+            left, right = queue.pop()
+            changed = False
+            for m, i in self.rule_heads(left, right).items():
+                if not m in self.heads[left]:
+                    self.heads[left][m] = i
+                    changed = True
+                elif self.heads[left][m] != i: raise Exception(exception_ind)
+            if changed:
+                grown.add(left)
+                queue.extend((l, r) for (l, r) in self.uses.get(left, ()) if r[0] == left)
+        return grown
+
+    def recompute_heads(self, exp, affected, new_heads):
+        if not exp in affected: return self.heads[exp]
+        if not exp in new_heads:
+            heads = {}
+            for right, data in self.rules[exp].items():
+                if data.is_term: heads[right[0]] = 0
+                else: heads.update({m:i+1 for m, i in self.recompute_heads(right[0], affected, new_heads).items()})
+            new_heads[exp] = heads
+        return new_heads[exp]
+
+    def annotate(self, exp): # record possible head LIs in rule usage, keeping existing counts; unreachable rules have none
+        for right, data in self.rules[exp].items():
+            if exp in self.reachable:
+                heads = self.rule_heads(exp, right)
+                data.usage = {m:data.usage.get(m, LI_usage(i, 0)) for m, i in heads.items()}
+                if any(data.usage[m].ind != i for m, i in heads.items()): raise Exception(exception_ind)
+            else: data.usage = {}
+
+    def reach(self, rights): # mark everything below these right-hand sides reachable; returns newly reached expressions
+        reached, queue = set(), [exp for right in rights for exp in right if not self.rules.get(exp) is None]
+        while queue:
+            exp = queue.pop()
+            if not exp in self.reachable:
+                self.reachable.add(exp)
+                reached.add(exp)
+                queue.extend(e for right, data in self.rules[exp].items() if not data.is_term for e in right)
+        return reached
+
+    def unreach(self, rights): # after removing rules: unmark expressions below them that nothing reachable uses
+        candidates, queue = set(), [exp for right in rights for exp in right if exp in self.reachable]
+        while queue: # everything that might have been reached only through the removed rules
+            exp = queue.pop()
+            if not exp in candidates:
+                candidates.add(exp)
+                queue.extend(e for right, data in self.rules[exp].items() if not data.is_term for e in right if e in self.reachable)
+        self.reachable.difference_update(candidates)
+        roots = [right for exp in candidates for (left, right) in self.uses.get(exp, ()) if left in self.reachable]
+        return candidates.difference(self.reach(roots))
+
+    def upward(self, exps): # all expressions built from these, in any argument position
+        result, queue = set(), list(exps)
+        while queue:
+            exp = queue.pop()
+            if not exp in result:
+                result.add(exp)
+                queue.extend(left for (left, right) in self.uses.get(exp, ()))
+        return result
+
+    def rederive(self, affected): # affected expressions that can still be derived without the removed rules
+        alive = set()
+        is_grounded = lambda right, data: data.is_term or all(e in alive or not e in affected for e in right)
+        queue = [exp for exp in affected if any(is_grounded(r, d) for r, d in self.rules[exp].items())]
+        while queue:
+            exp = queue.pop()
+            if not exp in alive:
+                alive.add(exp)
+                queue.extend(left for (left, right) in self.uses.get(exp, ()) if left in affected and not left in alive and is_grounded(right, self.rules[left][right]))
+        return alive
+
+    def drop_rule(self, left, right):
+        if self.rules.get(left, {}).pop(right, None) is not None:
+            for exp in right:
+                if exp in self.uses: self.uses[exp].discard((left, right))
+
+
 def gen_ord_syn(mcfg, mor_to_str, n):
     examples = gen_ord(mcfg, mor_to_str, n, expand_terms=False)
     examples = [add_fringe(x, mcfg, mor_to_str) for x in examples]
@@ -366,11 +566,19 @@ def gen_sample_syn(mcfg, mor_to_str, n):
     return examples
 
 
+def gen_uniform_syn(mcfg, mor_to_str, n):
+    examples = gen_uniform(mcfg, mor_to_str, n, expand_terms=False)
+    examples = [add_fringe(x, mcfg, mor_to_str) for x in examples]
+    return examples
+
+
 def gen_rand(mcfg, mor_to_str, n):
     return [random_tree(mcfg, mor_to_str) for i in range(n)]
 
 
 def gen_ord(mcfg, mor_to_str, n, expand_terms=True):
+    if n == inf and Derivations(mcfg, mor_to_str, expand_terms).max_size(start_symbol) == inf:
+        raise Exception("gen_ord: the grammar has infinitely many derivations; give a finite corpus size")
     iter = gen_ord_all(mcfg, mor_to_str, expand_terms)
     examples = []
     for x in iter:
@@ -379,102 +587,370 @@ def gen_ord(mcfg, mor_to_str, n, expand_terms=True):
     return examples
 
 
-def gen_sample(mcfg, mor_to_str, n, expand_terms=True):
-    pop = [x[0] for x in gen_ord_all(mcfg, mor_to_str, expand_terms)]
-    return random.sample(pop, min(n, len(pop)))
+sample_spread = 10 # by default, sample from the smallest trees that number at least this many times the sample size
+
+def gen_sample(mcfg, mor_to_str, n, expand_terms=True, max_size=None): # n distinct trees, uniformly among those up to max_size
+    derivations = Derivations(mcfg, mor_to_str, expand_terms)
+    if max_size == None and n == inf and derivations.max_size(start_symbol) == inf:
+        raise Exception("gen_sample: the grammar has infinitely many derivations; give a finite corpus size or max_size")
+    if max_size == None: max_size = derivations.size_for(n * sample_spread)
+    sizes = list(range(1, max_size + 1))
+    size_counts = [derivations.count(start_symbol, size) for size in sizes]
+    return [derivations.tree(start_symbol, *derivations.locate(sizes, size_counts, r))
+            for r in random.sample(range(sum(size_counts)), min(n, sum(size_counts)))]
+
+
+def gen_uniform(mcfg, mor_to_str, n, expand_terms=True, max_size=None): # n trees, each drawn uniformly among those up to max_size
+    if n == inf: raise Exception("gen_uniform draws with replacement; give a finite corpus size")
+    derivations = Derivations(mcfg, mor_to_str, expand_terms)
+    if max_size == None: max_size = derivations.size_for(n * sample_spread)
+    sizes = list(range(1, max_size + 1))
+    size_counts = [derivations.count(start_symbol, size) for size in sizes]
+    if sum(size_counts) == 0: return []
+    return [derivations.sample(start_symbol, size) for size in random.choices(sizes, weights=size_counts, k=n)]
+
+
+def gen_pcfg(mcfg, mor_to_str, n, probs=None, mean_length=None, max_factor=10): # n trees drawn from a probabilistic (M)CFG
+    if n == inf: raise Exception("gen_pcfg draws with replacement; give a finite corpus size")
+    if probs == None: probs = rule_probs(mcfg)
+    if mean_length != None: probs = rescale_probs(probs, mean_length)
+    elif expected_lengths(probs)[start_symbol] == inf:
+        raise Exception("Derivations do not terminate with these rule probabilities; give a mean_length")
+    max_size = max_factor * expected_sizes(probs)[start_symbol] # larger trees are redrawn
+    examples = []
+    while len(examples) < n:
+        t = pcfg_tree(mcfg, mor_to_str, probs, max_size)
+        if t != None: examples.append(t)
+    return examples
+
 
+def rule_probs(mcfg, smoothing=1): # {left: {right: probability}}, estimated from the rule usage in mcfg; uniform if unused
+    probs = {}
+    for left, rights in mcfg.items():
+        counts = {right: data.usage_sum() + smoothing for right, data in rights.items()}
+        total = sum(counts.values())
+        probs[left] = {right: c / total for right, c in counts.items()}
+    return probs
+
+
+def solve_linear(matrix, b): # Gaussian elimination with partial pivoting; None if matrix is singular
+    np = load_numpy() # without NumPy, eliminate in pure Python
+    if np is not None:
+        try: x = np.linalg.solve(np.array(matrix, dtype=np.float64), np.array(b, dtype=np.float64))
+        except np.linalg.LinAlgError: return None
+        return list(x) if np.all(np.isfinite(x)) else None
+    n = len(b)
+    rows = [row[:] + [b_i] for row, b_i in zip(matrix, b)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12: return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        pivot_row = rows[col]
+        for row in rows[col + 1:]:
+            f = row[col] / pivot_row[col]
+            if f:
+                for c in range(col, n + 1): row[c] -= f * pivot_row[c]
+    x = [0] * n
+    for r in reversed(range(n)):
+        x[r] = (rows[r][n] - sum(rows[r][c] * x[c] for c in range(r + 1, n))) / rows[r][r]
+    return x
+
+
+def is_nonterm_rule(probs, right): # nonterminal rules have expressions, terminal rules an LI on the right
+    return right[0] in probs
+
+
+def pcfg_lefts(probs): # nonterminals reachable from start_symbol, in probs order; no other one takes part in a sentence
+    reached, stack = {start_symbol}, [start_symbol]
+    while stack:
+        for right in probs[stack.pop()]:
+            if is_nonterm_rule(probs, right):
+                for r in right:
+                    if not r in reached:
+                        reached.add(r)
+                        stack.append(r)
+    return [left for left in probs if left in reached]
+
+
+def pcfg_expect(probs, node, leaf): # expected value of a derivation property worth node per rule application and leaf per LI; reachable nonterminals only
+    lefts = pcfg_lefts(probs)
+    index = {left: i for i, left in enumerate(lefts)}
+    matrix, b = [[0] * len(lefts) for left in lefts], [node] * len(lefts)
+    for i, left in enumerate(lefts): # values[left] = node + sum of p * (leaf for an LI, values of the expressions)
+        matrix[i][i] += 1
+        for right, p in probs[left].items():
+            if is_nonterm_rule(probs, right):
+                for r in right: matrix[i][index[r]] -= p
+            else: b[i] += p * leaf
+    values = solve_linear(matrix, b)
+    if values == None or min(values, default=0) < -1e-9: return {left: inf for left in lefts} # derivations do not terminate
+    return dict(zip(lefts, values))
+
+
+def expected_sizes(probs): # expected number of rule applications per nonterminal
+    return pcfg_expect(probs, 1, 0)
+
+
+def expected_lengths(probs): # expected number of LIs per nonterminal
+    return pcfg_expect(probs, 0, 1)
+
+
+def pcfg_totals(probs, z, tol=1e-10, max_iter=200, too_large=1e12): # sum over derivations of their probability times z ** (number of LIs); None if infinite
+    lefts = pcfg_lefts(probs)
+    index = {left: i for i, left in enumerate(lefts)}
+    rules = [[(p, None, [index[r] for r in right]) if is_nonterm_rule(probs, right) else (p, z, []) for right, p in probs[left].items()] for left in lefts]
+    values = [0] * len(lefts)
+    for it in range(max_iter): # Newton's method from 0 increases monotonically to the least solution
+        residual, matrix = [-v for v in values], [[int(i == j) for j in range(len(lefts))] for i in range(len(lefts))]
+        for i, left_rules in enumerate(rules):
+            for p, term_value, children in left_rules:
+                if term_value != None:
+                    residual[i] += p * term_value
+                    continue
+                weight = p
+                for k in children: weight *= values[k]
+                residual[i] += weight
+                for pos, k in enumerate(children): # derivative of the product with respect to one child
+                    d = p
+                    for other, k2 in enumerate(children):
+                        if other != pos: d *= values[k2]
+                    matrix[i][k] -= d
+        delta = solve_linear(matrix, residual)
+        if delta == None or min(delta) < -tol * (1 + max(values)): return None
+        values = [v + d for v, d in zip(values, delta)]
+        if max(values) > too_large: return None
+        if max(delta) <= tol * max(1, max(values)): return dict(zip(lefts, values))
+    return None
+
+
+def tilt_probs(probs, z): # probabilities of the same trees, reweighted by z ** (number of LIs); None if they do not add up
+    totals = pcfg_totals(probs, z)
+    if totals == None: return None
+    def rule_weight(right):
+        if not is_nonterm_rule(probs, right): return z
+        weight = 1
+        for r in right: weight *= totals[r]
+        return weight
+    return {left: {right: p * rule_weight(right) / totals[left] for right, p in rights.items()} if totals.get(left) else dict(rights)
+            for left, rights in probs.items()} # unreachable nonterminals keep their probabilities
+
+
+def rescale_probs(probs, mean_length, low=-20, high=20, tol=1e-3): # tilt probs so that sentences have this many LIs on average
+    def length(log_z):
+        tilted = tilt_probs(probs, math.exp(log_z))
+        return (inf, None) if tilted == None else (expected_lengths(tilted)[start_symbol], tilted)
+    if length(low)[0] > mean_length: raise Exception("Sentences are longer than {} LIs on average for any rule probabilities".format(mean_length))
+    best = None
+    for i in range(100): # the expected length grows with z
+        mid = (low + high) / 2
+        curr, tilted = length(mid)
+        if tilted != None and (best == None or abs(curr - mean_length) < abs(best[0] - mean_length)): best = (curr, tilted)
+        if abs(curr - mean_length) <= tol * mean_length: break
+        if curr > mean_length: high = mid
+        else: low = mid
+    return best[1] # the closest one if mean_length cannot be reached
+
+
+def pcfg_tree(mcfg, mor_to_str, probs, max_size): # random derivation tree, or None after more than max_size rule applications
+    result = []
+    stack, size = [(start_symbol, result)], 0
+    while stack:
+        size += 1
+        if size > max_size: return None
+        t, parent = stack.pop()
+        rights = probs[t]
+        children = random.choices(tuple(rights), weights=tuple(rights.values()), k=1)[0]
+        is_term = mcfg[t][children].is_term
+        node = [(t, is_term)]
+        if is_term: node.extend([(c, replace_term(mor_to_str, c)) for c in children])
+        else: stack.extend([(c, node) for c in reversed(children)])
+        parent.append(node)
+    return result[0]
 
 def weighted_choice(weights, t, factor=10):
-    rights_zip = list(zip(*weights[t].items()))
-    children = random.choices(rights_zip[0], weights=rights_zip[1], k=1)[0]
+    children = random.choices(list(weights[t]), weights=list(weights[t].values()), k=1)[0]
     for r in weights[t]:
         if r != children: weights[t][r] += factor # increase weights for each alternative rule t --> ...
     return weights, children
 
 
 def random_tree(mcfg, mor_to_str, weighted=True): # produce a random derivation tree given an (M)CFG
-    expand_nonterm.mcfg = mcfg
-    expand_nonterm.weighted = weighted
-    expand_nonterm.mor_to_str = mor_to_str
-    if weighted:
-        expand_nonterm.weights = {l:{r:1 for r, val in mcfg[l].items()} for l in mcfg}
-    result = expand_nonterm(start_symbol)
+    weights = {l:{r:1 for r, val in mcfg[l].items()} for l in mcfg} if weighted else None
+    result = expand_nonterm(mcfg, mor_to_str, weights, start_symbol)
     return result
 
 
-def expand_nonterm(t): # randomly expand nonterminal t
-    if expand_nonterm.weighted:
-        expand_nonterm.weights, children = weighted_choice(expand_nonterm.weights, t)
-    else:
-        children = random.choice(tuple(expand_nonterm.mcfg[t]))
-    is_term = expand_nonterm.mcfg[t][children].is_term
-    result = [(t, is_term)]
-    for c in children:
-        if is_term: result.append((c, replace_term(expand_nonterm.mor_to_str, c)))
-        else: result.append(expand_nonterm(c))
-    return result
+def expand_nonterm(mcfg, mor_to_str, weights, t): # randomly expand nonterminal t; weights are None if unweighted
+    result = []
+    stack = [(t, result)]
+    while stack: # preorder, left to right
+        t, parent = stack.pop()
+        if weights is not None:
+            weights, children = weighted_choice(weights, t)
+        else:
+            children = random.choice(tuple(mcfg[t]))
+        is_term = mcfg[t][children].is_term
+        node = [(t, is_term)]
+        if is_term: node.extend([(c, replace_term(mor_to_str, c)) for c in children])
+        else: stack.extend([(c, node) for c in reversed(children)])
+        parent.append(node)
+    return result[0]
 
 
 def add_fringe(t, mcfg, mor_to_str):
-    add_fringe_aux.mcfg = mcfg
-    add_fringe_aux.mor_to_str = mor_to_str
-    add_fringe_aux.weights = {l:{r:1 for r, val in mcfg[l].items() if val.is_term} for l in mcfg}
-    t = add_fringe_aux(t)
+    t = add_fringe_aux(mcfg, mor_to_str, t)
     return t
 
 
-def add_fringe_aux(t): # traverse t; when reaching a leaf, pick one using weights
-    new_t = [t[0],]
-    children = tuple(t[1:])
-    if t[0][1] == True: # only child is a leaf
-        # add_fringe_aux.weights, children = weighted_choice(add_fringe_aux.weights, t[0][0])
-        # print(add_fringe_aux.mcfg[t[0][0]])
-        children = random.choice([r for r, val in add_fringe_aux.mcfg[t[0][0]].items() if val.is_term])
-        # t[1] = (children[0], add_fringe_aux.mor_to_str[children[0]])
-        new_t.append((children[0], replace_term(add_fringe_aux.mor_to_str, children[0])))
-    else:
-        # for c in children:
-        #     add_fringe_aux(c)
-        new_t.extend([add_fringe_aux(c) for c in children])
-    return new_t
+def add_fringe_aux(mcfg, mor_to_str, t): # traverse t; when reaching a leaf, pick one at random
+    result = []
+    stack = [(t, result)]
+    while stack: # preorder, left to right
+        t, parent = stack.pop()
+        new_t = [t[0],]
+        if t[0][1] == True: # only child is a leaf
+            children = random.choice([r for r, val in mcfg[t[0][0]].items() if val.is_term])
+            new_t.append((children[0], replace_term(mor_to_str, children[0])))
+        else:
+            stack.extend((c, new_t) for c in reversed(t[1:]))
+        parent.append(new_t)
+    return result[0]
 
  
-def gen_ord_all(mcfg, mor_to_str, expand_terms): # produce all trees in order
-    generate_all.mcfg = mcfg    
-    generate_all.mor_to_str = mor_to_str
-    use_hash_start = {lhs:0 for lhs in mcfg}
-    # use_hash_start = {(lhs, rhs):0 for lhs, val in mcfg.items() for rhs in val}    
-    # return [x[0] for x in generate_all([start_symbol,], maxsize, use_hash_start)]
-    return generate_all([start_symbol,], maxsize, use_hash_start, expand_terms)
-
-
-def generate_all(items, depth, use_hash, expand_terms):
-    if items: # there are symbols left to be expanded
-        for frag1 in generate_one(items[0], depth, use_hash, expand_terms): # all options for expanding first symbol in the list
-            for frag2 in generate_all(items[1:], depth, use_hash, expand_terms): # all options for expanding remaining symbols
-                yield [frag1,] + frag2
-    else: yield []
-
-
-def generate_one(item, depth, use_hash_parent, expand_terms):
-    if depth > 0:
-
-        if (not expand_terms) and any(generate_all.mcfg[item][rhs].is_term for rhs in generate_all.mcfg[item]):
-            yield [(item, True), ((), ())]
+def gen_ord_all(mcfg, mor_to_str, expand_terms): # produce all trees in order of size
+    derivations = Derivations(mcfg, mor_to_str, expand_terms)
+    max_size = derivations.max_size(start_symbol)
+    size = 1
+    while size <= max_size:
+        for t in derivations.trees(start_symbol, size): yield [t]
+        size += 1
+
+
+def split_sizes(high): # 1, high, 2, high - 1, ...: a lopsided split is found after few tries
+    low = 1
+    while low <= high:
+        yield low
+        if low < high: yield high
+        low, high = low + 1, high - 1
+
+
+class Derivations: # derivations of an (M)CFG by size, i.e. number of rule applications, counted before they are built
+    def __init__(self, mcfg, mor_to_str=None, expand_terms=True):
+        self.mcfg, self.mor_to_str, self.expand_terms = mcfg, mor_to_str, expand_terms
+        self.rules = {}
+        for lhs, rights in mcfg.items():
+            self.rules[lhs] = [(rhs, val.is_term) for rhs, val in rights.items() if expand_terms or not val.is_term]
+            if not expand_terms and len(self.rules[lhs]) < len(rights): # all terminal rules stand for a single unexpanded leaf
+                self.rules[lhs].insert(0, (((), ()), True))
+        self.counts = {lhs: [0] for lhs in mcfg} # counts[lhs][size]; no derivation has size 0
+        self.splits = {} # (rhs, total): number of ways to derive rhs with sizes adding up to total
+        
+    def leaf(self, rhs):
+        return rhs if rhs == ((), ()) else (rhs[0], replace_term(self.mor_to_str, rhs[0]))
+        
+    def count(self, lhs, size):
+        while len(self.counts[lhs]) <= size: # each size only depends on smaller ones
+            next_size = len(self.counts[lhs])
+            for item in self.counts:
+                if len(self.counts[item]) == next_size:
+                    self.counts[item].append(sum(int(next_size == 1) if is_term else self.ways(rhs, next_size - 1) for rhs, is_term in self.rules[item]))
+        return self.counts[lhs][size]
         
-        for rhs in generate_all.mcfg[item]:
-            use_hash = {key:val for key, val in use_hash_parent.items()} # copy the dictionary
+    def ways(self, rhs, total):
+        if not rhs: return int(total == 0)
+        if not (rhs, total) in self.splits:
+            rest = rhs[1:]
+            self.splits[(rhs, total)] = sum(self.count(rhs[0], size) * self.ways(rest, total - size) for size in split_sizes(total - len(rest)))
+        return self.splits[(rhs, total)]
+        
+    def trees(self, lhs, size): # every derivation of lhs of this size, in the order used by tree()
+        if self.count(lhs, size) == 0: return
+        for rhs, is_term in self.rules[lhs]:
+            if is_term:
+                if size == 1: yield [(lhs, True), self.leaf(rhs)]
+            else:
+                for children in self.children(rhs, size - 1): yield [(lhs, False),] + children
+                
+    def children(self, rhs, total):
+        if not rhs:
+            if total == 0: yield []
+            return
+        rest = rhs[1:]
+        for size in split_sizes(total - len(rest)):
+            if self.count(rhs[0], size) and self.ways(rest, total - size):
+                for t in self.trees(rhs[0], size):
+                    for ts in self.children(rest, total - size): yield [t,] + ts
+                    
+    def tree(self, lhs, size, r): # derivation number r of lhs of this size, without building the others
+        result = []
+        stack = [(lhs, size, r, result)]
+        while stack: # preorder, left to right
+            lhs, size, r, parent = stack.pop()
+            rhs, is_term, r = self.rule_at(lhs, size, r)
+            node = [(lhs, is_term)]
+            if is_term: node.append(self.leaf(rhs))
+            else: stack.extend((c, c_size, c_r, node) for c, c_size, c_r in reversed(self.split_at(rhs, size - 1, r)))
+            parent.append(node)
+        return result[0]
+        
+    def rule_at(self, lhs, size, r): # rule used by derivation number r of lhs of this size, and the number within that rule
+        for rhs, is_term in self.rules[lhs]:
+            n = int(size == 1) if is_term else self.ways(rhs, size - 1)
+            if r < n: return rhs, is_term, r
+            r -= n
+        raise IndexError("{} has only {} derivations of size {}".format(lhs, self.count(lhs, size), size))
+        
+    def split_at(self, rhs, total, r): # (child, size, number) for each child in derivation number r of rhs
+        result = []
+        for i, c in enumerate(rhs):
+            rest = rhs[i+1:]
+            for size in split_sizes(total - len(rest)):
+                n_rest = self.ways(rest, total - size)
+                n = self.count(c, size) * n_rest
+                if r < n: break
+                r -= n
+            result.append((c, size, r // n_rest))
+            total, r = total - size, r % n_rest
+        return result
             
-            if use_hash[item] < 2: # how many times the same expression is allowed on the path from the root
-                use_hash[item] += 1
-            # if use_hash[(item, rhs)] < 1: # how many times the same rule is allowed on the path from the root
-            #     use_hash[(item, rhs)] += 1
-                if generate_all.mcfg[item][rhs].is_term:
-                    if expand_terms: yield[(item, True), (rhs[0], replace_term(generate_all.mor_to_str, rhs[0]))]
-                    else: pass
-                else:
-                    for frag in generate_all(rhs, depth - 1, use_hash, expand_terms):
-                        yield [(item, False),] + frag
+    def sample(self, lhs, size): # a derivation of lhs of this size, all equally likely
+        return self.tree(lhs, size, random.randrange(self.count(lhs, size)))
+        
+    def locate(self, sizes, size_counts, r): # size and index within that size of derivation number r overall
+        for size, n in zip(sizes, size_counts):
+            if r < n: return size, r
+            r -= n
+            
+    def productive(self): # nonterminals with at least one derivation
+        result, changed = set(), True
+        while changed:
+            changed = False
+            for lhs, rules in self.rules.items():
+                if not lhs in result and any(is_term or all(c in result for c in rhs) for rhs, is_term in rules):
+                    result.add(lhs)
+                    changed = True
+        return result
+        
+    def max_size(self, lhs): # size of the largest derivation; inf if there is no largest one
+        productive, sizes, open = self.productive(), {}, set()
+        def visit(item): # longest derivation through productive rules; a cycle makes it unbounded
+            if item in open: return inf
+            if not item in sizes:
+                open.add(item)
+                sizes[item] = max((1 if is_term else 1 + sum(visit(c) for c in rhs)
+                                   for rhs, is_term in self.rules[item] if is_term or all(c in productive for c in rhs)), default=0)
+                open.discard(item)
+            return sizes[item]
+        return visit(lhs) if lhs in productive else 0
+        
+    def size_for(self, n, lhs=start_symbol): # smallest size such that there are at least n derivations up to it, or the largest size
+        max_size, size, total = self.max_size(lhs), 0, 0
+        if n == inf and max_size == inf: raise Exception("size_for: infinitely many derivations of {}; n must be finite".format(lhs))
+        while total < n and size < max_size:
+            size += 1
+            total += self.count(lhs, size)
+        return size
+
 
 def replace_term(replace_dict, x):
     if replace_dict is None: return x
@@ -482,56 +958,72 @@ def replace_term(replace_dict, x):
 
 
 def mcfg_uses(t, mcfg): # count rule uses per head LI, updating an (M)CFG
-    mcfg_uses_aux.mcfg = mcfg
-    mcfg_uses_aux(t)
-    return mcfg_uses_aux.mcfg
-
-
-def mcfg_uses_aux(t):
-    children = tuple(t[1:])
-    
-    if t[0][1] == True: # only child is a leaf
-        t_usage = mcfg_uses_aux.mcfg[t[0][0]][(t[1][0],)].usage
-        head_li = t[1][0]
-        head_ind = 0
-    else:
-        (child_head_lis, child_head_inds) = zip(*[mcfg_uses_aux(c) for c in children])
-        child_names = tuple(c[0][0] for c in children)
-        t_usage = mcfg_uses_aux.mcfg[t[0][0]][child_names].usage
-        head_li = child_head_lis[0]
-        head_ind = child_head_inds[0] + 1
-        
-    if (not head_li in t_usage):
-        raise Exception("This expression: {} cannot be headed by this LI: {}".format(t[0][0], head_li))
-    elif t_usage[head_li].ind != head_ind:
-        raise Exception(exception_ind)
-    else: t_usage[head_li].num += 1
+    rule_counts = Counter()
+    mcfg_uses_aux(mcfg, t, rule_counts)
+    return add_rule_counts(mcfg, rule_counts)
+
+
+def add_rule_counts(mcfg, rule_counts): # rule_counts: {(left, right, head LI): number of uses}
+    for (left, right, head_li), num in rule_counts.items():
+        mcfg[left][right].usage[head_li].num += num
+    return mcfg
+
+
+def mcfg_uses_aux(mcfg, t, rule_counts, derive=False): # add the rule uses in t to rule_counts, checking them against the (M)CFG
+    heads, exps = [], [] # (head LI, index) and, if derive, derived expression of each finished subtree
+    for t in postorder(t):
+        if t[0][1] == True: # only child is a leaf
+            right = (t[1][0],)
+            head_li = t[1][0]
+            head_ind = 0
+            t_data = mcfg[t[0][0]][right]
+            if derive: exps.append((tuple(), (t[1],), tuple()))
+        else:
+            n = len(t) - 1
+            right = tuple([c[0][0] for c in t[1:]])
+            head_li, head_ind = heads[-n]
+            head_ind += 1
+            del heads[-n:]
+            t_data = mcfg[t[0][0]][right]
+            if derive:
+                t_exp = mcfg_concat(t_data.mcfg_map, exps[-n:])
+                del exps[-n:]
+                exps.append(t_exp)
+            
+        t_usage = t_data.usage
+        if (not head_li in t_usage):
+            raise Exception("This expression: {} cannot be headed by this LI: {}".format(t[0][0], head_li))
+        elif t_usage[head_li].ind != head_ind:
+            raise Exception(exception_ind)
+        else: rule_counts[(t[0][0], right, head_li)] += 1
+        heads.append((head_li, head_ind))
     
-    return head_li, head_ind
+    return heads[0], exps[0] if derive else None
 
 
 def mcfg_string(t, mcfg): # produce a derived tuple of strings from derivation tree, given an MCFG
-    mcfg_string_aux.mcfg = mcfg
-    return mcfg_string_aux(t)[0]
+    return mcfg_string_aux(mcfg, t)[0]
 
 
-def mcfg_string_aux(t):
-    children = tuple(t[1:])
-    if t[0][1] == True: # only child is a leaf
-        t_exp = (tuple(), (children[0],), tuple())
-    else:
-        child_names = tuple(c[0][0] for c in children)
-        child_exps = [mcfg_string_aux(c) for c in children]
-        t_map = mcfg_string_aux.mcfg[t[0][0]][child_names].mcfg_map
-        t_exp = mcfg_concat(t_map, child_exps)
-    return t_exp
+def mcfg_string_aux(mcfg, t):
+    exps = [] # derived expression of each finished subtree
+    for t in postorder(t):
+        if t[0][1] == True: # only child is a leaf
+            exps.append((tuple(), (t[1],), tuple()))
+        else:
+            n = len(t) - 1
+            child_names = tuple([c[0][0] for c in t[1:]])
+            t_exp = mcfg_concat(mcfg[t[0][0]][child_names].mcfg_map, exps[-n:])
+            del exps[-n:]
+            exps.append(t_exp)
+    return exps[0]
 
 
 def mcfg_concat(rule_map, exp_list): # combine a list of expressions according to the MCFG map
     exp = []
     for component in rule_map:
         if component != None:
-            exp.append(tuple(x for pair in component for x in exp_list[pair[0]][pair[1]]))
+            exp.append(tuple(chain.from_iterable([exp_list[i][j] for i, j in component])))
         else: exp.append(tuple())
     return tuple(exp)
 
@@ -559,9 +1051,9 @@ def mcfg_to_pf_simple(s):
 
 def cfg_check(cfg, eqs, verbose=False):
     # cfg = rules_useful(cfg) # TODO: rewrite and use
-    cfg_check_aux.term, cfg_check_aux.nonterm, cfg_check_aux.selectees = {}, {}, {}
-    cfg_check_aux.verbose=verbose
-    if cfg_check_aux.verbose: print("Verbose mode")
+    term, nonterm, selectees = {}, {}, {}
+    first_args = {} # {exp: rules in nonterm with exp as first argument}
+    if verbose: print("Verbose mode")
     
     term_usage = {}
     for word, morphemes in eqs.items():
@@ -575,44 +1067,43 @@ def cfg_check(cfg, eqs, verbose=False):
                     if verbose:
                         print("Terminal usage problem: {} -- actual {} vs. expected {}".format(val, val.usage_sum(), term_usage[r[0]]))
                     return False
-                else: cfg_check_aux.term[(l, r)] = val.usage_sum()
+                else: term[(l, r)] = val.usage_sum()
             else:
                 if l != start_symbol and val.usage != {}:
-                    cfg_check_aux.nonterm[(l, r)] = dict(val.usage)
+                    nonterm[(l, r)] = dict(val.usage)
+                    first_args.setdefault(r[0], []).append((l, r))
                 if len(r) == 2 or l==start_symbol:
-                    cfg_check_aux.selectees[r[-1]] = cfg_check_aux.selectees.get(r[-1], 0) + val.usage_sum()
+                    selectees[r[-1]] = selectees.get(r[-1], 0) + val.usage_sum()
     
-    for ((b, exp), val_sum) in cfg_check_aux.term.items():
-        if cfg_check_aux.verbose: print("Processing LI: {} {} {}".format(pf(b), pf(exp), val_sum))
-        if not cfg_check_aux(b, exp[0], val_sum): return False
+    for ((b, exp), val_sum) in term.items():
+        if verbose: print("Processing LI: {} {} {}".format(pf(b), pf(exp), val_sum))
+        if not cfg_check_aux(nonterm, first_args, selectees, b, exp[0], val_sum, verbose): return False
     
-    if cfg_check_aux.verbose:
-        print(cfg_check_aux.nonterm.items())
-        print(cfg_check_aux.selectees.items())
+    if verbose:
+        print(nonterm.items())
+        print(selectees.items())
     
-    if any(v != {} for v in cfg_check_aux.nonterm.values()) or any(v != 0 for v in cfg_check_aux.selectees.values()):
+    if any(v != {} for v in nonterm.values()) or any(v != 0 for v in selectees.values()):
         return False
     
     return True
 
    
-def cfg_check_aux(exp, li, n):
-    
-    if cfg_check_aux.verbose: print("Expression: {} {} {}".format(pf(exp), pf(li), n))
+def cfg_check_aux(nonterm, first_args, selectees, exp, li, n, verbose=False): # nonterm and selectees are used up as usage is accounted for
+    stack = [(exp, n)] # expressions headed by li, with the number of uses still to account for
+    while stack:
+        exp, n = stack.pop()
+        if verbose: print("Expression: {} {} {}".format(pf(exp), pf(li), n))
+        
+        if exp[0].features[0].type == cat: # lhs will serve as second argument
+            selectees[exp] -= n
     
-    if exp[0].features[0].type == cat: # lhs will serve as second argument
-        cfg_check_aux.selectees[exp] -= n
-
-    else: # lhs will serve as first argument
-        next_rules = [(lhs, cfg_check_aux.nonterm[(lhs, rhs)].pop(li).num) for (lhs, rhs) in cfg_check_aux.nonterm if rhs[0] == exp]
-        if cfg_check_aux.verbose: print(next_rules)
-            
-        if (
-            next_rules == [] or 
-            sum ([x[1] for x in next_rules]) != n or 
-            any(cfg_check_aux(lhs, li, n_share)==False for (lhs, n_share) in next_rules)
-        ):
-            return False
+        else: # lhs will serve as first argument
+            next_rules = [(lhs, nonterm[(lhs, rhs)].pop(li).num) for (lhs, rhs) in first_args.get(exp, ())]
+            if verbose: print(next_rules)
+                
+            if next_rules == [] or sum([x[1] for x in next_rules]) != n: return False
+            stack.extend(reversed(next_rules))
 
     return True
 
@@ -622,22 +1113,52 @@ def drop_maps(mcfg): # get rid of MCFG maps
     return {l: {r: Rule_data(val.is_term, val.usage) for r, val in mcfg[l].items()} for l in mcfg}
 
  
-def make_corpus(mg, eqs, mor_to_str, corpus_size, gen_method, start_name):
+def make_corpus(mg, eqs, mor_to_str, corpus_size, gen_method, start_name, jobs=1, gen_args={}): # gen_args: keyword arguments for gen_method
     eqs_reverse = {tuple(morphemes):list(word) for word, morphemes in eqs.items()}    
     
     mcfg = mg2mcfg(mg, start_name)
-    examples = gen_method(mcfg, mor_to_str, corpus_size) # n smallest trees  
+    examples = gen_method(mcfg, mor_to_str, corpus_size, **gen_args) # n smallest trees  
     
-    for ex in examples:
-        mcfg = mcfg_uses(ex, mcfg)
-        # pprint_tree(ex)
-        for w in mcfg_to_words(mcfg_string(ex, mcfg), mg):
-            eqs_reverse[w][2] +=1    
+    rule_counts, word_counts = corpus_counts(examples, mcfg, mg, jobs)
+    mcfg = add_rule_counts(mcfg, rule_counts)
+    for w, num in word_counts.items():
+        eqs_reverse[w][2] += num
     eqs_usage = {tuple(word):list(morphemes) for morphemes, word in eqs_reverse.items()}
 
     return mcfg, examples, eqs_usage
 
 
+def example_counts(examples, mcfg, mg): # rule uses per head LI and word uses in examples; the MCFG is not changed
+    rule_counts, word_counts = Counter(), Counter()
+    for ex in examples: # one pass over each tree for both
+        head, exp = mcfg_uses_aux(mcfg, ex, rule_counts, derive=True)
+        word_counts.update(mcfg_to_words(exp[0], mg))
+    return rule_counts, word_counts
+
+
+worker_corpus = None # (examples, mcfg, mg) a pool worker was forked with; only index ranges are sent to it
+
+def init_counts_worker(examples, mcfg, mg):
+    global worker_corpus
+    worker_corpus = (examples, mcfg, mg)
+
+def counts_worker(bounds):
+    examples, mcfg, mg = worker_corpus
+    return example_counts(examples[bounds[0]:bounds[1]], mcfg, mg)
+
+
+def corpus_counts(examples, mcfg, mg, jobs=1): # example_counts over jobs processes; counts from each chunk are added up
+    if jobs <= 1 or len(examples) < 2 * jobs: return example_counts(examples, mcfg, mg)
+    chunksize = -(-len(examples) // (4 * jobs))
+    chunks = [(i, i + chunksize) for i in range(0, len(examples), chunksize)]
+    rule_counts, word_counts = Counter(), Counter()
+    with multiprocessing.get_context('fork').Pool(jobs, init_counts_worker, (examples, mcfg, mg)) as pool:
+        for chunk_rules, chunk_words in pool.imap_unordered(counts_worker, chunks): # addition does not depend on the order
+            rule_counts.update(chunk_rules)
+            word_counts.update(chunk_words)
+    return rule_counts, word_counts
+
+
 from copy import deepcopy
 from mdl import mdl_corpus
 
@@ -1,5 +1,6 @@
 from math import log2, inf
-from utils import pphon
+from collections import OrderedDict
+from utils import pphon, load_numpy
 
 mdl_full = lambda f1, f2: lambda mg, cfg: (f1(mg), f2(cfg))
 
@@ -21,82 +22,175 @@ def count_naive(mg):
         lexicon_cost += (len(pphon(left)) + (2 * len(right)) + 1) # total number of all features, pronounced chars, and separators
     return lexicon_cost
 
-def mdl_1d(mg): # same-length encoding for each symbol in Sigma, Types, and Base, plus LI delimiter
-    symbol_cost = get_symbol_cost(mg)
-    lexicon_cost = 0
-    sum_phon, sum_syn = 0, 0
+phon_len = lambda phon: len(pphon((phon,))) # pronounced length of a solution string
 
-    for left, right in mg.items(): # for each LI
-        # add 
-        lexicon_cost += symbol_cost * (len(pphon(left)) + (2 * len(right)) + 1)
-        sum_phon += len(pphon(left))
-        sum_syn += len(right)
-    
-    print("Base size: {}".format(get_feature_number(mg)))
-    print("Sum syn: {}".format(sum_syn))
-    print("Sum phon: {}".format(sum_phon))
-    print("Symbol cost: {}".format(symbol_cost))
-    return lexicon_cost
+def count_add(counter, key, k): # add k to a count; True if key appeared or disappeared
+    n = counter.get(key, 0) + k
+    if n: counter[key] = n
+    else: del counter[key]
+    return n == k or n == 0
+
+class Lexicon_stats: # multisets the lexicon costs are computed from, so that LIs can be added and removed
+    def __init__(self):
+        self.features, self.bundles, self.types, self.vals = {}, {}, {}, {} # feature names, bundles, type sequences, value sequences by type
+        self.n, self.phon, self.syn = 0, 0, 0 # LIs, pronounced characters, features
+        self.bundle_sum, self.types_sum, self.vals_sum = 0, 0, 0 # sizes of distinct bundles, type sequences, value sequences with separators
+        
+    def copy(self):
+        new = Lexicon_stats()
+        new.features, new.bundles, new.types, new.vals = dict(self.features), dict(self.bundles), dict(self.types), dict(self.vals)
+        new.n, new.phon, new.syn = self.n, self.phon, self.syn
+        new.bundle_sum, new.types_sum, new.vals_sum = self.bundle_sum, self.types_sum, self.vals_sum
+        return new
+        
+    def update(self, p_len, b, k=1): # add (k=1) or remove (k=-1) an LI with pronounced length p_len and bundle b
+        self.n += k
+        self.phon += k * p_len
+        self.syn += k * len(b)
+        
+        b_types, b_vals = zip(*b) if b else ((), ())
+        for f_val in b_vals: count_add(self.features, f_val, k)
+        if count_add(self.bundles, b, k): self.bundle_sum += k * (2 * len(b) + 1)
+        if count_add(self.types, b_types, k): self.types_sum += k * (len(b_types) + 1)
+        if count_add(self.vals, (b_types, b_vals), k): self.vals_sum += k * (len(b_vals) + 1)
+        
+def lexicon_stats(mg):
+    stats = Lexicon_stats()
+    for left, right in mg.items(): stats.update(len(pphon(left)), right)
+    return stats
+
+stats_symbol_cost = lambda stats: log2(26 + len_types + len(stats.features) + 1)
+
+# same-length encoding for each symbol in Sigma, Types, and Base, plus LI delimiter
+cost_1d = lambda stats: stats_symbol_cost(stats) * (stats.phon + 2 * stats.syn + stats.n)
+# each distinct bundle once, plus each string and a separator
+cost_2d = lambda stats: stats_symbol_cost(stats) * (stats.bundle_sum + stats.phon + stats.n)
+# each distinct type sequence once, each distinct value sequence once per type sequence, plus each string and a separator
+cost_3d = lambda stats: stats_symbol_cost(stats) * (stats.types_sum + stats.vals_sum + stats.phon + stats.n)
+
+def mdl_1d(mg):
+    stats = lexicon_stats(mg)
+    print("Base size: {}".format(len(stats.features)))
+    print("Sum syn: {}".format(stats.syn))
+    print("Sum phon: {}".format(stats.phon))
+    print("Symbol cost: {}".format(stats_symbol_cost(stats)))
+    return cost_1d(stats)
 
 def mdl_2d(mg):
-    symbol_cost = get_symbol_cost(mg)
-    lexicon_cost = 0
-    
-    mg_by_bundle = {}    
-    for left, right in mg.items():
-        mg_by_bundle.setdefault(right, [])
-        mg_by_bundle[right].append(len(pphon(left)))
-    
-    for b, strs in mg_by_bundle.items(): # (bundle, list of lengths of associated strings)
-        b_cost = symbol_cost * (2 * len(b) + 1) # pay for bundle + one separator
-        str_cost = symbol_cost * (sum(strs) + len(strs)) # for each string, pay its length + separator
-        lexicon_cost += (b_cost + str_cost)
-    
-    return lexicon_cost
+    return cost_2d(lexicon_stats(mg))
     
 def mdl_3d(mg):
-    symbol_cost = get_symbol_cost(mg)
-    lexicon_cost = 0
-    
-    mg_by_types = {}
-    for left, right in mg.items():
-        b_types = tuple(f.type for f in right)
-        b_vals = tuple(f.val for f in right)
-        mg_by_types.setdefault(b_types, {})
-        mg_by_types[b_types].setdefault(b_vals, [])
-        mg_by_types[b_types][b_vals].append(len(pphon(left)))
-        # if not b_types in mg_by_types: mg_by_types[b_types] = {}
-        # dict_append_rep(mg_by_types[b_types], b_vals, len(pphon(left)))
-    
-    for b_types in mg_by_types: # (bundle, list of length of associated strings)
-        b_types_cost = symbol_cost * (len(b_types) + 1) # pay for types + one separator
-        lexicon_cost += b_types_cost
-        
-        for b_vals, strs in mg_by_types[b_types].items():
-            b_vals_cost = symbol_cost * (len(b_vals) + 1) # pay for values + one separator
-            str_cost = symbol_cost * (sum(strs) + len(strs)) # for each string, pay its length + separator
-            lexicon_cost += (b_vals_cost + str_cost)
-    
-    return lexicon_cost
+    return cost_3d(lexicon_stats(mg))
 
 mdl_cfg = lambda cfg: mdl_corpus(cfg, False)
 mdl_cfg_split = lambda cfg: mdl_corpus(cfg, True)
 
 def mdl_corpus(cfg, split_lex):
     if cfg == None: return 0
+    if load_numpy() is not None: return Usage_table(cfg).cost(split_lex) # without NumPy, walk the CFG
+    
     corpus_cost = 0
+    for left in cfg: corpus_cost += mdl_left(cfg[left], split_lex)
+    return corpus_cost
 
-    for left in cfg:
+class Usage_table: # one entry per rule: left-hand side index, terminal flag, total usage
+    def __init__(self, cfg):
+        np = load_numpy()
+        left_ids, is_term, usage = [], [], []
+        for i, rights in enumerate(cfg.values()):
+            for right_data in rights.values():
+                left_ids.append(i)
+                is_term.append(right_data.is_term)
+                usage.append(right_data.usage_sum())
+        self.n_lefts = len(cfg)
+        self.left_ids = np.array(left_ids, dtype=np.intp)
+        self.is_term = np.array(is_term, dtype=bool)
+        self.usage = np.array(usage, dtype=np.float64)
+        
+    def cost(self, split_lex): # mdl_corpus, one left-hand side per array position
+        np = load_numpy()
+        per_left = lambda weights=None: np.bincount(self.left_ids, weights=weights, minlength=self.n_lefts)
+        n_rights, left_usage = per_left(), per_left(self.usage)
+        
+        if split_lex:
+            n_lex, lex_usage = per_left(self.is_term), per_left(np.where(self.is_term, self.usage, 0))
+            split = n_lex > 1 # lexical rules are paid for separately
+            left_cost = left_usage * np.log2(np.where(split, n_rights - n_lex + 1, np.maximum(n_rights, 1)))
+            left_cost += np.where(split, lex_usage * np.log2(np.maximum(n_lex, 1)), 0)
+        else:
+            left_cost = left_usage * np.log2(np.maximum(n_rights, 1))
+        return float(left_cost.sum())
 
-        right_lex = [right_data.usage_sum() for right_data in cfg[left].values() if right_data.is_term]
+def mdl_left(rights, split_lex): # cost of the rules for one left-hand side
+    right_lex = [right_data.usage_sum() for right_data in rights.values() if right_data.is_term]
+    
+    if split_lex and len(right_lex) > 1:
+        left_cost = log2(len(rights)-len(right_lex)+1)
+        return sum(right_data.usage_sum() for right_data in rights.values()) * left_cost + sum(right_lex) * log2(len(right_lex)) # pay for lexical usages
         
-        if split_lex and len(right_lex) > 1:
-            left_cost = log2(len(cfg[left])-len(right_lex)+1)
-            corpus_cost += sum(right_data.usage_sum() for right_data in cfg[left].values()) * left_cost
-            corpus_cost += sum(right_lex) * log2(len(right_lex)) # pay for lexical usages
-            
+    else:
+        left_cost = log2(len(rights))
+        return sum(right_data.usage_sum() for right_data in rights.values()) * left_cost
+
+lexicon_costs = {mdl_1d: cost_1d, mdl_2d: cost_2d, mdl_3d: cost_3d}
+corpus_splits = {mdl_cfg: False, mdl_cfg_split: True}
+
+class Incremental_cost: # scores a grammar from its parent's cached cost components and the LIs and rules that changed
+    def __init__(self, grammar_cost, corpus_cost, maxsize=1000):
+        if not (grammar_cost in lexicon_costs and corpus_cost in corpus_splits):
+            raise Exception("No incremental version of {} and {}".format(grammar_cost.__name__, corpus_cost.__name__))
+        self.lexicon_cost = lexicon_costs[grammar_cost]
+        self.split_lex = corpus_splits[corpus_cost]
+        self.maxsize = maxsize
+        self.cache = OrderedDict() # grammar hash: (LI pair counts, Lexicon_stats, cost of each left-hand side); least recently used first
+        self.hits, self.misses = 0, 0
+        self.phon_lens = {} # solution string: pronounced length
+        
+    def components(self, mg, solution, cfg):
+        pairs, stats = {}, Lexicon_stats()
+        for li_mor, li_syn in mg.items():
+            if count_add(pairs, (solution[li_mor], li_syn), 1): stats.update(self.phon_len(solution[li_mor]), li_syn)
+        left_costs = {left: mdl_left(rights, self.split_lex) for left, rights in cfg.items()} if cfg != None else {}
+        return pairs, stats, left_costs
+        
+    def phon_len(self, phon):
+        if not phon in self.phon_lens: self.phon_lens[phon] = phon_len(phon)
+        return self.phon_lens[phon]
+        
+    def parent_components(self, h, mg, solution, cfg):
+        if h in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(h)
         else:
-            left_cost = log2(len(cfg[left]))
-            corpus_cost += sum(right_data.usage_sum() for right_data in cfg[left].values()) * left_cost
-                    
-    return corpus_cost
\ No newline at end of file
+            self.misses += 1
+            self.cache[h] = self.components(mg, solution, cfg)
+            if len(self.cache) > self.maxsize: self.cache.popitem(last=False)
+        return self.cache[h]
+        
+    def cost(self, mg, solution, cfg): # from scratch
+        pairs, stats, left_costs = self.components(mg, solution, cfg)
+        return self.lexicon_cost(stats), self.corpus_cost(left_costs.values())
+        
+    def corpus_cost(self, left_costs):
+        corpus_cost = 0
+        for left_cost in left_costs: corpus_cost += left_cost # summed in rule order, as in mdl_corpus
+        return corpus_cost
+        
+    def child_cost(self, h, parent_mg, parent_solution, parent_cfg, new_mg, new_solution, new_cfg):
+        parent_pairs, parent_stats, parent_left_costs = self.parent_components(h, parent_mg, parent_solution, parent_cfg)
+        pairs, stats = None, None # copied on the first change
+        
+        for li_mor in parent_mg.keys() | new_mg.keys():
+            old_li = (parent_solution[li_mor], parent_mg[li_mor]) if li_mor in parent_mg else None
+            new_li = (new_solution[li_mor], new_mg[li_mor]) if li_mor in new_mg else None
+            if old_li == new_li: continue
+            
+            if pairs == None: pairs, stats = dict(parent_pairs), parent_stats.copy()
+            if old_li != None and count_add(pairs, old_li, -1): stats.update(self.phon_len(old_li[0]), old_li[1], -1)
+            if new_li != None and count_add(pairs, new_li, 1): stats.update(self.phon_len(new_li[0]), new_li[1])
+        
+        if new_cfg == None: left_costs = []
+        else: # rules under an unchanged left-hand side keep their cost
+            left_costs = [parent_left_costs[left] if parent_cfg != None and parent_cfg.get(left) is rights else mdl_left(rights, self.split_lex)
+                          for left, rights in new_cfg.items()]
+        return self.lexicon_cost(stats if stats != None else parent_stats), self.corpus_cost(left_costs)
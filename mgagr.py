@@ -31,9 +31,17 @@ def get_morphemes(eqs):
     return set(m for morphemes in eqs.keys() for m in morphemes)
 
 
+def get_morpheme_index(eqs): # {semantic label: [set of mfeatures] for every morpheme with that label}
+    index = {}
+    for sem, mb in get_morphemes(eqs):
+        index.setdefault(sem, []).append(set(mb))
+    return index
+
+
 def unpack_sf(sf, sem_features):
-    if sf.cin is None: # no incoming agreement, return singleton list of original SFeature
-        return [sf,]
+    if sf.cin is None: # no incoming agreement, yield the original SFeature only
+        yield sf
+        return
 
     options = {f.name: [(f.value, f.is_lex), None] for f in sf.cin}
     for key, val in sem_features.items():
@@ -43,21 +51,18 @@ def unpack_sf(sf, sem_features):
                 options[key].append((v, False))
 
     options_list = [[(key, v) for v in val] for key, val in options.items()]
-    combinations = list(itertools.product(*options_list))
-    sfeatures = [SFeature(
-        sf.type, 
-        sf.name, 
-        cin=MBundle(MFeature(t[0], *t[1]) for t in c if t[1] is not None),
-        cout=MBundle(sf.cout)
-        ) for c in combinations]
-
-    return sfeatures
+    for c in itertools.product(*options_list):
+        yield SFeature(
+            sf.type, 
+            sf.name, 
+            cin=MBundle(MFeature(t[0], *t[1]) for t in c if t[1] is not None),
+            cout=MBundle(sf.cout)
+            )
 
 
 def unpack_cin(sb, sem_features): # received values: all combinations are viable
-    options = [unpack_sf(f, sem_features) for f in sb]
-    combinations = [SBundle(x) for x in itertools.product(*options)]
-    return combinations
+    options = [list(unpack_sf(f, sem_features)) for f in sb] # options for a single feature are few; their product is not
+    return (SBundle(x) for x in itertools.product(*options))
 
 
 def unpack_cout(sb): # emitted values: fully determined by received and lexical
@@ -84,23 +89,88 @@ def unpack_cout(sb): # emitted values: fully determined by received and lexical
     return SBundle(consensus_sb)
 
 
-def unpack_sb(sb, sem_features):
-    combs = unpack_cin(sb, sem_features)
-    return [unpack_cout(comb) for comb in combs]
+def unpack_sb(sb, sem_features, sem=None, morpheme_index=None): # yield LIs one at a time, skipping unpronounceable ones if an index is given
+    for comb in unpack_cin(sb, sem_features):
+        if morpheme_index is None or is_pronounceable(sem, comb, morpheme_index):
+            yield unpack_cout(comb)
 
 
-def is_pronounceable(sem, sb, morphemes):
-    mb = sb.mor().compatible()
-    for morpheme in morphemes:
-        if morpheme[0] == sem and set(morpheme[1]).issubset(set(mb)):
-            return True
-    return False
-
-
-def is_good(sem, sb, morphemes):
+def unpack_mg(mg, sem_features, morpheme_index=None):
+    for sem, sb in mg:
+        for new_sb in unpack_sb(sb, sem_features, sem, morpheme_index):
+            yield sem, new_sb
+
+
+own_key = lambda sf: (is_pos(sf), is_lic(sf) or is_lee(sf), sf.name) # polarity, Move (rather than Merge), name
+partner_key = lambda sf: (not is_pos(sf), is_lic(sf) or is_lee(sf), sf.name) # features that can check sf
+
+
+def possible_couts(sb, options, j): # all values the j-th feature can emit, given cin options for every feature; mirrors unpack_cout
+    states = {()} # consensus dictionaries reachable so far, as sorted items
+    for i, sf in enumerate(sb):
+        if sf.cin is not None:
+            new_states = set()
+            for state in states:
+                for opt in options[i]:
+                    d = dict(state)
+                    d.update((mf.name, None if i == j else mf) for mf in opt.cin) # None: received along j itself, never emitted
+                    new_states.add(tuple(sorted(d.items())))
+            states = new_states
+
+    couts = set()
+    for state in states:
+        sf_mdict = {mf.name:mf for mf in sb[j].cout if mf.is_lex is True} # keep lexically determined values
+        for name, mf in state:
+            if mf is not None: sf_mdict.setdefault(name, mf)
+        couts.add(MBundle(MFeature(v.name, v.value, False) for v in sf_mdict.values()))
+    return couts
+
+
+def unpack_mg_constrained(mg, sem_features, start, morpheme_index=None): # only yield cin values that some partner feature can emit
+    is_free = lambda sf: not is_pos(sf) and sf.name == start # the start category is never checked
+    options = [[list(unpack_sf(sf, sem_features)) for sf in sb] for sem, sb in mg]
+
+    changed = True
+    while changed: # shrink cin options until every remaining one is offered by some partner
+        offered = {} # {own key: compatible couts}
+        for (sem, sb), li_options in zip(mg, options):
+            for j, sf in enumerate(sb):
+                if sf.cout is not None:
+                    offered.setdefault(own_key(sf), set()).update(c.compatible() for c in possible_couts(sb, li_options, j))
+
+        changed = False
+        for (sem, sb), li_options in zip(mg, options):
+            for i, sf in enumerate(sb):
+                if sf.cin is not None and not is_free(sf):
+                    kept = [opt for opt in li_options[i] if opt.cin.compatible() in offered.get(partner_key(sf), ())]
+                    if len(kept) < len(li_options[i]):
+                        li_options[i] = kept
+                        changed = True
+
+    accepted = {} # {own key: compatible cins}
+    for (sem, sb), li_options in zip(mg, options):
+        for i, sf in enumerate(sb):
+            if sf.cin is not None:
+                accepted.setdefault(own_key(sf), set()).update(opt.cin.compatible() for opt in li_options[i])
+
+    for (sem, sb), li_options in zip(mg, options):
+        for comb in itertools.product(*li_options):
+            comb = SBundle(comb)
+            if morpheme_index is None or is_pronounceable(sem, comb, morpheme_index):
+                new_sb = unpack_cout(comb)
+                if all(sf.cout is None or is_free(sf) or sf.cout.compatible() in accepted.get(partner_key(sf), ()) for sf in new_sb): # someone must receive what is emitted
+                    yield sem, new_sb
+
+
+def is_pronounceable(sem, sb, morpheme_index):
+    mb = set(sb.mor().compatible())
+    return any(morpheme.issubset(mb) for morpheme in morpheme_index.get(sem, ()))
+
+
+def is_good(sem, sb, morpheme_index):
     conditions = [
         # is_consistent(sb),
-        is_pronounceable(sem, sb, morphemes),
+        is_pronounceable(sem, sb, morpheme_index),
     ]
     return all(conditions)
 
@@ -148,12 +218,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-g', '--grammar', action='store', type=str)
     parser.add_argument('-o', '--one_op', action='store_true', default=False)
+    parser.add_argument('-sn', '--semi_naive', action='store_true', default=False)
+    parser.add_argument('-p', '--prune', action='store_true', default=False, help='drop LIs with no matching morpheme in the equations')
+    parser.add_argument('-c', '--constrain', action='store_true', default=False, help='only unpack agreement values that some partner feature can supply')
     args = parser.parse_args()
 
     start, mg, eqs = file_to_mg(args.grammar)
     syn_features = get_syn_features(mg)
     sem_features = get_sem_features(mg)
-    morphemes = get_morphemes(eqs)
+    morpheme_index = get_morpheme_index(eqs) if args.prune else None
     print(start)
     print(syn_features)
     print(list(sem_features.items()))
@@ -161,21 +234,13 @@ if __name__ == '__main__':
     for (sem, sb) in mg: print(sem, sb)
     print()
 
-    unpacked_mg = []
-    for sem, sb in mg:
-        for new_sb in unpack_sb(sb, sem_features):
-            # print(sem, '\t', new_sb)
-            unpacked_mg.append((sem, new_sb))
-    
-    # print()
-
-    # combs = [(sem, unpack_cin(sb, sem_features)) for (sem, sb) in mg]
-    # unpacked_mg = list(set((sem, unpack_cout(sb)) for (sem, sbs) in combs for sb in sbs if is_good(sem, sb, morphemes)))
-    
-    new_mg_dict = {i:c for i, (sem, c) in enumerate(unpacked_mg)}
+    if args.constrain: unpacked_iter = unpack_mg_constrained(mg, sem_features, start, morpheme_index)
+    else: unpacked_iter = unpack_mg(mg, sem_features, morpheme_index)
+    unpacked_mg = dict(enumerate(unpacked_iter)) # only surviving LIs are stored
+    new_mg_dict = {i:c for i, (sem, c) in unpacked_mg.items()}
     print(f'Unpacked: {len(unpacked_mg)}\n')
 
-    cfg = mg2mcfg(new_mg_dict, start, useful=True, one_op=args.one_op)
+    cfg = mg2mcfg(new_mg_dict, start, useful=True, one_op=args.one_op, semi_naive=args.semi_naive)
     ids = [y[0] for x in cfg.values() for y in x.keys() if isinstance(y[0], int)]
 
     # for k, v in cfg.items():
@@ -2,12 +2,17 @@
 import argparse
 import os, shutil
 import shelve
-
-import networkx as nx
-import pydot as pd
+import multiprocessing
+from hashlib import blake2b
+from functools import lru_cache
+from heapq import nsmallest
+from bisect import insort
+from itertools import islice
 
 from grammars import *
 from mdl import *
+from corpus import write_corpus, read_corpus
+from words import Word_automaton, key_prefixes
 
 class Step:
     def __init__(self, mg, order, eqs, solution, cfg, fresh, parent=None, rank=None, level=None, note=None):
@@ -28,6 +33,68 @@ class Step:
     def __gt__ (self, other):
         return other.rank < self.rank
 
+class Best_grammars: # the k cheapest grammars recorded so far, cheapest first; a tie goes to the grammar recorded first, as in a stable sort
+    def __init__(self, k, hsize_aux):
+        self.k = k
+        self.hsize_aux = hsize_aux
+        self.best = [] # (cost, record number, hash), sorted
+        self.recorded = 0
+        
+    def add(self, h, mdl):
+        entry = (self.hsize_aux(mdl), self.recorded, h)
+        self.recorded += 1
+        if len(self.best) < self.k or entry < self.best[-1]:
+            insort(self.best, entry)
+            del self.best[self.k:]
+            
+    def top(self, n):
+        return [h for cost, i, h in self.best[:n]]
+
+class Search: # a single optimization run: its configuration and every grammar it has found
+    def __init__(self, head_name, grammar_cost, corpus_cost, hsize_aux, beam_size=100, check_top=50, use_chimera=True,
+                 qparams=((False, False), (True, True)), jobs=1, verbose_feedback=False, verbose_history=False, level_plot_path=None,
+                 cost_cache_size=1000, checkpoint_path=None, check_every=1):
+        self.head_name = head_name
+        self.cost_function = mdl_full(grammar_cost, corpus_cost)
+        # derive costs from the parent grammar where the cost functions allow it
+        self.costs = Incremental_cost(grammar_cost, corpus_cost, cost_cache_size) if grammar_cost in lexicon_costs and corpus_cost in corpus_splits else None
+        self.hsize_aux = hsize_aux
+        self.beam_size = beam_size
+        self.check_top = check_top
+        self.use_chimera = use_chimera
+        self.split_lex = corpus_cost == mdl_cfg_split
+        self.qparams = qparams # pairs (is_high, is_suffix); simultaneously find roots at start and suffixes
+        self.jobs = jobs
+        self.verbose_feedback = verbose_feedback
+        self.verbose_history = verbose_history
+        self.level_plot_path = level_plot_path
+        self.checkpoint_path = checkpoint_path # shelf the state is saved to after every cycle; None to keep everything in memory
+        self.check_every = check_every # check CFG usage on every n-th new step; 0 to skip the check
+        
+        self.orig_names = set() # feature names used in the input MG
+        self.results, self.mdls, self.processed = {}, {}, set()
+        self.best = Best_grammars(max(check_top, 1), hsize_aux) # kept up to date by record
+        self.lcounter = -1
+        self.steps_checked = 0 # new steps seen by step_checks
+        self.checkpoint = None # open shelf; holds the steps that are no longer in results
+        
+    def hsize(self, h):
+        return self.hsize_aux(self.mdls[h])
+        
+    def step(self, h):
+        if h in self.results: return self.results[h]
+        if self.checkpoint == None: raise Exception("step {} is not in memory and no checkpoint is open".format(h))
+        return self.checkpoint[step_key(h)]
+        
+    def record(self, h, mdl):
+        self.mdls[h] = mdl
+        self.best.add(h, mdl)
+        
+    def reset_grammars(self, mdls={}): # start over from the given costs, in the order they were recorded
+        self.mdls = {}
+        self.best = Best_grammars(self.best.k, self.hsize_aux)
+        for h, mdl in mdls.items(): self.record(h, mdl)
+
 def pretty_label(ns, maxlen=20):
     l, curr = "", ns[0]
     for n in ns[1:]:
@@ -39,7 +106,9 @@ def pretty_label(ns, maxlen=20):
     if curr: l += "\n {}".format(curr)
     return l
 
-def mg_to_plot(mg, n, t="", fresh=set()): # grammar, path sans extension, title, fresh categories
+def mg_to_plot(mg, n, head_name, t="", fresh=set()): # grammar, path sans extension, start category, title, fresh categories
+    import pydot as pd # only needed for plotting
+    
     ftsize = '50'
     graph = pd.Dot(graph_type='digraph', label=t, fontsize=ftsize, rankdir='RL', layout='dot', esep=5)
     graph.add_node(pd.Node(head_name, style='filled', fillcolor='lightgray',  fontsize=ftsize)) # fillcolor='lightskyblue'
@@ -76,26 +145,7 @@ def mg_to_plot(mg, n, t="", fresh=set()): # grammar, path sans extension, title,
     # graph.write_svg('{}.svg'.format(n))
     # graph.write_dot('{}.dot'.format(n))
     
-def word_graph(mg):
-    mg_adj, edge_labels = {}, {}
-    dict_append(mg_adj, head_name, nend, True) # sentence category is always allowed to terminate words
-    
-    for li_mor, li_syn in mg.items():        
-        li_cat_val = get_cat(li_syn)
-        li_sels = [f for f in li_syn if is_sel(f)]
-        
-        if li_sels and is_msel(li_sels[0]): rem_sels, vstart = li_sels[1:], li_sels[0].val # affix; edge from first sel to cat
-        else: rem_sels, vstart = li_sels[0:], nstart # not affix; edge from start to cat
-        
-        dict_append(mg_adj, vstart, li_cat_val, True)
-        dict_append(edge_labels, (vstart, li_cat_val), li_mor, True)
-        
-        for li_sel in rem_sels: # all selectors except strong/weak if present
-            dict_append(mg_adj, li_sel.val, nend, True) # end words from all selected categories
-     
-    return nx.DiGraph(mg_adj), edge_labels
-
-def preprocess_mg(mg): # initialize mg, eqs, solution; identify existing complex eqs if any
+def preprocess_mg(mg, head_name): # initialize mg, eqs, solution; identify existing complex eqs if any
     new_mg, eqs, mor_to_str = {}, {}, {}
     mcounter, wcounter = {}, {}
     
@@ -104,14 +154,11 @@ def preprocess_mg(mg): # initialize mg, eqs, solution; identify existing complex
         new_mg[new_name] = right
         mor_to_str[new_name] = pphon(left)
 
-    G, edge_labels = word_graph(new_mg)
-
-    for path in nx.all_simple_paths(G, source=nstart, target=nend):
-        for word in product(*[edge_labels[(path[i], path[i+1])] for i in range (0, len(path)-2)]):
-            word_phon = "".join(mor_to_str[m] for m in word)
-            wcounter.setdefault(word_phon, 0)
-            word_name, wcounter = li_name(word_phon, wcounter, extra=0)
-            eqs[word_name] = word
+    for word in Word_automaton(new_mg, head_name).words():
+        word_phon = "".join(mor_to_str[m] for m in word)
+        wcounter.setdefault(word_phon, 0)
+        word_name, wcounter = li_name(word_phon, wcounter, extra=0)
+        eqs[word_name] = word
                       
     return new_mg, eqs, mor_to_str
     
@@ -122,31 +169,53 @@ def step_to_mg(step_mg, mor_to_phon):
         mg[new_name] = li_syn
     return mg
 
-def current_hash(x):
-    return hash(x)
+hash_mod = 1 << 128
 
-def hash_step(mg, eqs={}):
-    tuple_mg = tuple(mg.items())
-    tuple_eqs = tuple((w, tuple(m)) for w, m in eqs.items())
-    return current_hash((tuple_mg, tuple_eqs))
+def stable_hash(x): # unlike hash(), the same in every process and run; x must have a deterministic repr
+    return int.from_bytes(blake2b(repr(x).encode(), digest_size=16).digest(), 'big')
+
+@lru_cache(maxsize=1 << 16)
+def li_hash(i, li_mor, li_syn): # an LI at position i of the order
+    return stable_hash((i, li_mor, li_syn.tup))
+    
+def eq_hash(word, morphemes):
+    return stable_hash((word, tuple(morphemes)))
+
+def hash_step(mg, eqs={}): # grammar fingerprint: a sum of per-LI and per-equation hashes, so changing one LI changes one term
+    h = sum(li_hash(i, li_mor, li_syn) for i, (li_mor, li_syn) in enumerate(mg.items()))
+    h += sum(eq_hash(word, morphemes) for word, morphemes in eqs.items())
+    return h % hash_mod
+    
+def hash_step_update(h, old_lis=(), new_lis=(), old_eqs=(), new_eqs=()): # replace (i, li_mor, li_syn) and (word, morphemes) terms
+    h -= sum(li_hash(*li) for li in old_lis) + sum(eq_hash(*eq) for eq in old_eqs)
+    h += sum(li_hash(*li) for li in new_lis) + sum(eq_hash(*eq) for eq in new_eqs)
+    return h % hash_mod
     
 def rename_cfg(cfg, feature_dict, li_dict): # rename features and LIs within a CFG
     if cfg == None: return
     
-    new_cfg = {}
+    new_cfg = Cfg()
+    new_chains = {} # each chain is renamed once
+    def rename(exp):
+        for c in exp:
+            if not c in new_chains: new_chains[c] = Chain(c.type, unify_bundle(c.features, feature_dict))
+        return tuple(new_chains[c] for c in exp)
     
+    new_lefts = {} # {new left: old lefts renamed to it}
     for left in cfg:
-        if left == start_symbol: new_left = left
-        else: new_left = tuple(Chain(c.type, unify_bundle(c.features, feature_dict)) for c in left)
-        
-        new_cfg.setdefault(new_left, {})
+        new_left = left if left == start_symbol else rename(left)
+        new_lefts.setdefault(new_left, []).append(left)
+    
+    for new_left, lefts in new_lefts.items():
+        new_rights = [(left, right, (li_dict[right[0]],) if cfg[left][right].is_term else tuple(rename(r) for r in right)) # terminal node: rename LI
+                      for left in lefts for right in cfg[left]]
+        if lefts == [new_left] and all(new_right == right and all(li_dict[li] == li for li in cfg[left][right].usage) for left, right, new_right in new_rights):
+            new_cfg[new_left] = cfg[new_left] # nothing to rename: share the bucket
+            if isinstance(cfg, Cfg): cfg.owned.discard(new_left) # so cfg copies it before changing it
+            continue
         
-        for right in cfg[left]:
-            if cfg[left][right].is_term == True: # terminal node: rename LI
-                new_right = (li_dict[right[0]],)
-            else: # nonterminal node: rename features in expressions
-                new_right = tuple(tuple(Chain(c.type, unify_bundle(c.features, feature_dict)) for c in r) for r in right)
-            
+        new_cfg[new_left] = {}
+        for left, right, new_right in new_rights:
             new_cfg[new_left].setdefault(new_right, Rule_data(cfg[left][right].is_term, {}, None))
             
             for li, data in cfg[left][right].usage.items():
@@ -155,7 +224,7 @@ def rename_cfg(cfg, feature_dict, li_dict): # rename features and LIs within a C
 
     return new_cfg
     
-def make_step(mg, ord, eqs, mor_to_phon, cfg):
+def make_step(mg, ord, eqs, mor_to_phon, cfg, orig_names):
     new_mg, new_ord, new_mor_to_phon = {}, [], {}
     fnames, mnames, li_pairs, li_reps = {}, {}, {}, {}
 
@@ -195,7 +264,7 @@ def unify_type(l):
     try: return uni_types_sets[s]
     except KeyError: return None
     
-def unify_name(names, id=None):
+def unify_name(names, head_name, orig_names, id=None):
     name_set = set(names)
     if len(name_set) == 1: return next(iter(names))
     elif head_name in name_set: return head_name
@@ -205,12 +274,12 @@ def unify_name(names, id=None):
         elif id != None: return id
         else: return names[0]
         
-def unify_shared(bundles, syn_i, is_high): 
+def unify_shared(bundles, syn_i, is_high, head_name, orig_names): 
     new_b = []
     rng = range (-1, syn_i-1, -1) if is_high else range(0, syn_i)
     for j in rng:
         jtype = unify_type([b[j].type for b in bundles])
-        jname = unify_name([b[j].val for b in bundles], "0{}".format(j))
+        jname = unify_name([b[j].val for b in bundles], head_name, orig_names, "0{}".format(j))
         jfeature = Feature(jtype, jname)
         if is_high: new_b.insert(0, jfeature)
         else: new_b.append(jfeature)
@@ -244,25 +313,20 @@ def concat_word(word, solution): # given a sequence of morphemes and a solution
 def cycle_check(eqs): # basic check to ensure no morpheme occurs twice in the same word
     return all(len(set(morphemes)) == len(morphemes) for morphemes in eqs.values())
 
-def chimera_check(cc, f_out, f_in, g, eqs, solution): # use word graph to compare possible words with original words
-    old_paths = set((concat_word(morphemes, solution), get_path(g, morphemes)) for word, morphemes in eqs.items())
-    f_new = unify_name((f_out, f_in), id=f_in) # this is a temporary name
+def old_words(g, eqs, solution): # (string, syntactic path) of each original word
+    return frozenset((concat_word(morphemes, solution), get_path(g, morphemes)) for word, morphemes in eqs.items())
+
+def chimera_check(search, cc, f_out, f_in, g, eqs, solution, old_paths=None, old_prefixes=None): # use word graph to compare possible words with original words
+    if old_paths == None: old_paths = old_words(g, eqs, solution)
+    f_new = unify_name((f_out, f_in), search.head_name, search.orig_names, id=f_in) # this is a temporary name
     new_g = unify_grammar({li_mor:li_syn for li_mor, li_syn in g.items() if li_mor != cc}, {f_out:f_new, f_in:f_new})    
-    G, edge_labels = word_graph(new_g)
-    
-    try:
-        nx.find_cycle(G)
-        return False # fail the check on finding a cycle
-    except nx.exception.NetworkXNoCycle: pass
+    words = Word_automaton(new_g, search.head_name)
+    if words.has_cycle(): return False # fail the check on finding a cycle
     
-    new_paths = set()
-    for path in nx.all_simple_paths(G, source=nstart, target=nend):
-        for morphemes in product(*[edge_labels[(path[i], path[i+1])] for i in range (0, len(path)-2)]):
-            new_paths.add((concat_word(morphemes, solution), get_path(new_g, morphemes)))
-            
     # TODO: also recognize bad syntactic paths beyond words (i.e. weird complements)
     
-    return new_paths.issubset(old_paths)
+    piece = lambda m, is_first, is_last: (solution[m], get_path_single(new_g[m], is_first, is_last)) # a word's key is the sum of these
+    return words.within(piece, old_paths, old_prefixes) # every new word is an old word
     
 def key_mor_sel(b):
     b_first = b[0]
@@ -316,16 +380,16 @@ def note_decompose(batch_tuple):
     note = "\ndecomposition: {}".format(note_lis)
     return note
 
-def qdecompose(h, new_queue, qparams):    
-    g, eqs, ord = transform_mg.results[h].mg, transform_mg.results[h].eqs, transform_mg.results[h].order
-    solution = transform_mg.results[h].solution
+def qdecompose(search, h, new_queue):    
+    g, eqs, ord = search.results[h].mg, search.results[h].eqs, search.results[h].order
+    solution = search.results[h].solution
     
-    for is_high, is_suffix in qparams:
+    for is_high, is_suffix in search.qparams:
         for v in select_morphemes(g, ord, eqs, solution, is_high, is_suffix): # resulting batches don't overlap
             for metabatch, syn_inds in get_batches(v, is_high, is_suffix, {}):
                 for syn_ind in syn_inds:
                     
-                    new_cfg = transform_mg.results[h].cfg
+                    new_cfg = search.results[h].cfg
                     new_g, new_solution, new_ord = dict(g), dict(solution), list(ord)
                     new_eqs, dec_dict = {}, {}
                     note = ""
@@ -337,7 +401,7 @@ def qdecompose(h, new_queue, qparams):
                         
                         cat_i = temp_b_i(i) # separate category for each batch within a metabatch
                         name_i = (emp_mor, cat_i)
-                        syn_i = unify_shared(all_syns, syn_ind, is_high)
+                        syn_i = unify_shared(all_syns, syn_ind, is_high, search.head_name, search.orig_names)
                         bundle_i = Bundle(attach_shared(syn_i, Feature(ssel if is_high else cat, cat_i), is_high))
                         new_g[name_i] = bundle_i
                         new_solution[name_i] = shared_phon
@@ -375,7 +439,7 @@ def qdecompose(h, new_queue, qparams):
                             except KeyError: new_morphemes.append(m)
                             new_eqs[word] = new_morphemes
                         
-                    new_queue = add_step(h, new_g, new_ord, new_eqs, new_solution, new_cfg, new_queue, note)
+                    new_queue = add_step(search, h, new_g, new_ord, new_eqs, new_solution, new_cfg, new_queue, note)
 
     return new_queue
     
@@ -394,21 +458,25 @@ def cat_changers(lis, mor_to_phon, changers_only): # assuming no identical edges
 
     return {p:mor for p, mor in li_dict.items() if not p in stop_pairs}
     
-def qcontract_single(h, new_queue, qparams):
+def qcontract_single(search, h, new_queue):
         
-    g, eqs, ord = transform_mg.results[h].mg, transform_mg.results[h].eqs, transform_mg.results[h].order
-    solution = transform_mg.results[h].solution
+    g, eqs, ord = search.results[h].mg, search.results[h].eqs, search.results[h].order
+    solution = search.results[h].solution
 
+    old_paths, old_prefixes = None, None
     for ((li_orig, li_dest), li_mor) in cat_changers(g.items(), solution, True).items():
-
-        cond = chimera_check(li_mor, li_orig, li_dest, g, eqs, solution) if use_chimera else True
+        
+        if search.use_chimera and old_paths == None: # shared by every pair checked on this grammar
+            old_paths = old_words(g, eqs, solution)
+            old_prefixes = key_prefixes(old_paths)
+        cond = chimera_check(search, li_mor, li_orig, li_dest, g, eqs, solution, old_paths, old_prefixes) if search.use_chimera else True
         if cond:
 
             new_g, new_eqs = dict(g), dict(eqs)
-            new_cfg = transform_mg.results[h].cfg
+            new_cfg = search.results[h].cfg
             del new_g[li_mor]
 
-            li_new = unify_name((li_orig, li_dest))
+            li_new = unify_name((li_orig, li_dest), search.head_name, search.orig_names)
             unify_dict = {li_orig:li_new, li_dest:li_new}
             new_g = unify_grammar(new_g, unify_dict)
             new_eqs = {word:tuple_without(morphemes, li_mor) for word, morphemes in new_eqs.items()}
@@ -417,14 +485,16 @@ def qcontract_single(h, new_queue, qparams):
             new_solution = {mor:phon for mor, phon in solution.items() if not mor == li_mor}
             
             note = "\nsingle contraction: {} → {}".format(li_orig, li_dest)
-            new_queue = add_step(h, new_g, new_ord, new_eqs, new_solution, new_cfg, new_queue, note)
+            new_queue = add_step(search, h, new_g, new_ord, new_eqs, new_solution, new_cfg, new_queue, note)
 
     return new_queue
     
-def qremove_greedy(h, new_queue, qparams):
-    g, eqs, ord = transform_mg.results[h].mg, transform_mg.results[h].eqs, transform_mg.results[h].order
+def qremove_greedy(search, h, new_queue):
+    g, eqs, ord = search.results[h].mg, search.results[h].eqs, search.results[h].order
     
-    li_dict = cat_changers(g.items(), transform_mg.results[h].solution, False)
+    import networkx as nx
+    
+    li_dict = cat_changers(g.items(), search.results[h].solution, False)
     gr = nx.MultiDiGraph(list(li_dict.keys())) # form graph from list of edges
     to_delete = {}
     
@@ -451,7 +521,7 @@ def qremove_greedy(h, new_queue, qparams):
             cross_ord = new_ord.copy()
             cross_eqs = {}
             cross_dict = dict(zip(to_delete_keys, element)) # associate replacement lists with original morphemes
-            cross_solution = {li_mor:li_phon for li_mor, li_phon in transform_mg.results[h].solution.items() if not li_mor in to_delete}
+            cross_solution = {li_mor:li_phon for li_mor, li_phon in search.results[h].solution.items() if not li_mor in to_delete}
                      
             for word, morphemes in eqs.items():
                 new_morphemes = []
@@ -463,11 +533,11 @@ def qremove_greedy(h, new_queue, qparams):
             note_items = [(pf(g[mor]), ", ".join(["{}".format(pf(g[m])) for m in cross_dict[mor]])) for mor in cross_dict]
             note = "\nreplacement: {}".format("; ".join(["{} with {}".format(item[0], item[1]) for item in note_items]))
             
-            cross_cfg = transform_mg.results[h].cfg # no need to copy, as the original grammar is not modified
+            cross_cfg = search.results[h].cfg # no need to copy, as the original grammar is not modified
             for mor, alt_mors in cross_dict.items():
                 cross_cfg = cfg_remove(cross_cfg, (mor, g[mor]),  [(m, g[m]) for m in alt_mors]) if cross_cfg else None
 
-            new_queue = add_step(h, cross_g, cross_ord, cross_eqs, cross_solution, cross_cfg, new_queue, note)
+            new_queue = add_step(search, h, cross_g, cross_ord, cross_eqs, cross_solution, cross_cfg, new_queue, note)
     
     return new_queue
     
@@ -489,16 +559,16 @@ def items_to_trie(mg_items, rev, seq_fun):
 
 def trie_splits(trie_items, rev, seq_fun, split_root):
     trie = items_to_trie(trie_items, rev, seq_fun)
-    trie_splits_aux.result = {}
-    trie_splits_aux(trie, rev, 0, split_root) # None if we don't want a root batch
-    return trie_splits_aux.result
+    result = {}
+    trie_splits_aux(result, trie, rev, 0, split_root) # None if we don't want a root batch
+    return result
     
-def trie_splits_aux(t, rev, i, can_split_parent):
+def trie_splits_aux(result, t, rev, i, can_split_parent):
     t_yield = []
     t_split = set()
     for key in t: # process the children first
         if isinstance (t[key], dict): # nonleaf child
-            key_yield = trie_splits_aux(t[key], rev, i-1 if rev else i+1, key[1])
+            key_yield = trie_splits_aux(result, t[key], rev, i-1 if rev else i+1, key[1])
             t_yield.extend(key_yield)
             t_split.add(key[1])
         else: # leaf child
@@ -506,7 +576,7 @@ def trie_splits_aux(t, rev, i, can_split_parent):
             t_split.add(t[key])
     can_split = can_split_parent == True if rev else (not False in t_split)
     if can_split and len(t_yield) > 1: # 0 to allow batches of one
-        dict_append(trie_splits_aux.result, tuple(t_yield), i, True)
+        dict_append(result, tuple(t_yield), i, True)
     return t_yield # list of leaves under t
 
 get_first_type = lambda b, t: next(((i, f.val) for i, f in enumerate(b) if t(f)), (0, None))
@@ -519,55 +589,117 @@ def cfg_add(cfg, left, right, is_term, usage_li, usage_ind, usage_num):
     cfg[left][right].usage[usage_li].num += usage_num
     return
 
+class Cfg(dict): # {left: {right: Rule_data}}; a CFG derived from another shares every LHS bucket it does not change
+    def __init__(self, rules=()):
+        super().__init__(rules)
+        self.index = None # {LI: {(left, right): None} for rules headed by it}; None holds unused rules and empty buckets
+        self.owned = set() # lefts whose buckets were copied for this CFG, so they can be changed
+        
+    def __getstate__(self): # the index is rebuilt on first use
+        return {}
+        
+    def __setstate__(self, state):
+        self.index, self.owned = None, set()
+        
+    def li_rules(self, li): # rules whose usage mentions li, in CFG order
+        if self.index == None:
+            self.index = {}
+            for left, rights in self.items():
+                if not rights: self.index.setdefault(None, {})[(left, None)] = None
+                for right, data in rights.items():
+                    for m in data.usage or (None,): self.index.setdefault(m, {})[(left, right)] = None
+        return self.index.get(li, {})
+        
+    def derive(self): # a CFG to be changed, without unused rules or empty buckets, as cfg_add would have rebuilt it
+        unused = self.li_rules(None) # builds the index
+        cfg = Cfg(self)
+        cfg.index = dict(self.index) # rule sets are replaced, never changed
+        for left, right in unused:
+            if right == None: del cfg[left]
+            else: cfg.drop_use(left, right, None)
+        cfg.index.pop(None, None)
+        self.owned = set() # the buckets are shared with cfg now, so both copy before changing them
+        return cfg
+        
+    def bucket(self, left): # the rules under left, copied on the first change
+        if not left in self.owned:
+            self[left] = {right: Rule_data(data.is_term, {m: LI_usage(u.ind, u.num) for m, u in data.usage.items()}, data.mcfg_map)
+                          for right, data in self.get(left, {}).items()}
+            self.owned.add(left)
+        return self[left]
+        
+    def add_use(self, left, right, is_term, li, ind, num): # cfg_add without touching shared buckets
+        rights = self.bucket(left)
+        rights.setdefault(right, Rule_data(is_term, {}))
+        usage = rights[right].usage
+        if not li in usage:
+            usage[li] = LI_usage(ind, 0)
+            self.index[li] = dict(self.li_rules(li))
+            self.index[li][(left, right)] = None
+        usage[li].num += num
+        
+    def drop_use(self, left, right, li): # forget the uses of a rule headed by li; a rule without usage goes, and so does an empty bucket
+        rights = self.bucket(left)
+        rights[right].usage.pop(li, None)
+        self.index[li] = {rule: None for rule in self.li_rules(li) if rule != (left, right)}
+        if not rights[right].usage: del rights[right]
+        if not rights:
+            del self[left]
+            self.owned.discard(left)
+
+def as_cfg(cfg):
+    return cfg if isinstance(cfg, Cfg) else Cfg(cfg)
+
 def cfg_decompose(orig_cfg, old_li, upper_li, lower_li, ind):
-    cfg = {}
+    orig_cfg = as_cfg(orig_cfg)
+    cfg = orig_cfg.derive() # only rules associated with old_li change
     
     term_old, term_upper, term_lower = terminal_exp(old_li[1]), terminal_exp(upper_li[1]), terminal_exp(lower_li[1])
     term_old_uses = orig_cfg[term_old][(old_li[0],)].usage[old_li[0]].num
     
-    cfg_add(cfg, term_upper, (upper_li[0],), True, upper_li[0], 0, term_old_uses) # add new upper LI
+    cfg.add_use(term_upper, (upper_li[0],), True, upper_li[0], 0, term_old_uses) # add new upper LI
     
-    for left in orig_cfg:
-        for right in orig_cfg[left]:
+    old_rules = orig_cfg.li_rules(old_li[0])
+    for left, right in old_rules: # the rule is associated with old_li
+        current_is_term = orig_cfg[left][right].is_term
+        old_usage = orig_cfg[left][right].usage[old_li[0]] # get number of relevant uses
+
+        if left == start_symbol or old_usage.ind > ind: # expand upper LI; mostly same rule but reassign uses to upper_li
+            upper_ind = old_usage.ind-(ind-1)
+            new_right_first = (Chain(derived, right[0][0].features),) + right[0][1:] # first argument is always derived
+            new_right = (new_right_first,) + right[1:]
+            cfg.add_use(left, new_right, False, upper_li[0], upper_ind, old_usage.num)
             
-            current_is_term = orig_cfg[left][right].is_term
-            for usage_li, usage_data in orig_cfg[left][right].usage.items():
-                if usage_li != old_li[0]: # adding all unrelated rule usage to the new cfg
-                    cfg_add(cfg, left, right, current_is_term, usage_li, usage_data.ind, usage_data.num)
-
-            if old_li[0] in orig_cfg[left][right].usage: # the rule is associated with old_li
-                old_usage = orig_cfg[left][right].usage[old_li[0]] # get number of relevant uses
-
-                if left == start_symbol or old_usage.ind > ind: # expand upper LI; mostly same rule but reassign uses to upper_li
-                    upper_ind = old_usage.ind-(ind-1)
-                    new_right_first = (Chain(derived, right[0][0].features),) + right[0][1:] # first argument is always derived
-                    new_right = (new_right_first,) + right[1:]
-                    cfg_add(cfg, left, new_right, False, upper_li[0], upper_ind, old_usage.num)
-                    
-                else: # expanding lower LI
-                    if current_is_term: # add new terminal rule for lower LI
-                        new_left = term_lower
-                        new_right = (lower_li[0],)
-                    else:
-                        new_left = (Chain(left[0].type, lower_li[1][old_usage.ind:]),) + left[1:]
-                        new_right = ((Chain(right[0][0].type, lower_li[1][old_usage.ind-1:]),) + right[0][1:],) + right[1:]
-                    cfg_add(cfg, new_left, new_right, current_is_term, lower_li[0], old_usage.ind, old_usage.num)
-                    
-                    if old_usage.ind == ind: # merge upper and lower
-                        merge_right = (term_upper, new_left)
-                        cfg_add(cfg, left, merge_right, False, upper_li[0], 1, old_usage.num)
+        else: # expanding lower LI
+            if current_is_term: # add new terminal rule for lower LI
+                new_left = term_lower
+                new_right = (lower_li[0],)
+            else:
+                new_left = (Chain(left[0].type, lower_li[1][old_usage.ind:]),) + left[1:]
+                new_right = ((Chain(right[0][0].type, lower_li[1][old_usage.ind-1:]),) + right[0][1:],) + right[1:]
+            cfg.add_use(new_left, new_right, current_is_term, lower_li[0], old_usage.ind, old_usage.num)
             
+            if old_usage.ind == ind: # merge upper and lower
+                merge_right = (term_upper, new_left)
+                cfg.add_use(left, merge_right, False, upper_li[0], 1, old_usage.num)
+    
+    for left, right in old_rules: cfg.drop_use(left, right, old_li[0])
     return cfg
     
 def cfg_contract(orig_cfg, old_names, unify_dict):
-    cfg = {start_symbol:{}}
+    cfg = Cfg({start_symbol:{}})
+    new_chains = {} # each chain is renamed once
+    def rename(exp):
+        for c in exp:
+            if not c in new_chains: new_chains[c] = Chain(c.type, unify_bundle(c.features, unify_dict))
+        return tuple(new_chains[c] for c in exp)
     
     for left in orig_cfg:
-        new_left = left if left == start_symbol else tuple(Chain(c.type, unify_bundle(c.features, unify_dict)) for c in left)
+        new_left = left if left == start_symbol else rename(left)
         
         for right in orig_cfg[left]:
             if orig_cfg[left][right].is_term == True: new_right = right
-            else: new_right = tuple(tuple(Chain(c.type, unify_bundle(c.features, unify_dict)) for c in r) for r in right)
+            else: new_right = tuple(rename(r) for r in right)
         
             new_usage_keys = set(orig_cfg[left][right].usage.keys()).difference(old_names) 
             if new_usage_keys: # if the LHS expression can be headed by something other than the items we just deleted
@@ -582,38 +714,33 @@ def cfg_contract(orig_cfg, old_names, unify_dict):
       
     cfg = rule_heads(closure(cfg, cfg_to_exps(cfg))) # run closure, add potential heads to new rules. Needed because licensees!
                 
-    return cfg
+    return as_cfg(cfg)
     
 def cfg_remove(orig_cfg, old_li, new_lis):
-    cfg = {}
+    orig_cfg = as_cfg(orig_cfg)
+    cfg = orig_cfg.derive() # only rules associated with old_li change
     
     term_old = terminal_exp(old_li[1])
     term_old_uses = orig_cfg[term_old][(old_li[0],)].usage[old_li[0]].num
     terms_new = [terminal_exp(new_li[1]) for new_li in new_lis]
        
     for i in range(len(new_lis)):
-        cfg_add(cfg, terms_new[i], (new_lis[i][0],), True, new_lis[i][0], 0, term_old_uses) # add new terminals
+        cfg.add_use(terms_new[i], (new_lis[i][0],), True, new_lis[i][0], 0, term_old_uses) # add new terminals
     
-    for left in orig_cfg:
-        for right in orig_cfg[left]:
-            
-            current_is_term = orig_cfg[left][right].is_term
+    old_rules = orig_cfg.li_rules(old_li[0])
+    for left, right in old_rules:
+        if orig_cfg[left][right].is_term == False:
+            old_usage = orig_cfg[left][right].usage[old_li[0]] # get uses associated with old_li; ind should always be 1
+
+            new_right_snd = right[1] # expression selected by old_li
             
-            for usage_li, usage_data in orig_cfg[left][right].usage.items():
-                if usage_li != old_li[0]: # add all usage not associated with old_li
-                    cfg_add(cfg, left, right, current_is_term, usage_li, usage_data.ind, usage_data.num)
-                  
-            if old_li[0] in orig_cfg[left][right].usage and current_is_term == False:
-                old_usage = orig_cfg[left][right].usage[old_li[0]] # get uses associated with old_li; ind should always be 1
-
-                new_right_snd = right[1] # expression selected by old_li
-                
-                for i in range(len(new_lis)):
-                    new_left = (Chain(derived, new_lis[i][1][1:]),) + right[1][1:]
-                    new_right_fst = terms_new[i]
-                    cfg_add(cfg, new_left, (new_right_fst, new_right_snd), False, new_lis[i][0], old_usage.ind, old_usage.num)
-                    new_right_snd = new_left
+            for i in range(len(new_lis)):
+                new_left = (Chain(derived, new_lis[i][1][1:]),) + right[1][1:]
+                new_right_fst = terms_new[i]
+                cfg.add_use(new_left, (new_right_fst, new_right_snd), False, new_lis[i][0], old_usage.ind, old_usage.num)
+                new_right_snd = new_left
     
+    for left, right in old_rules: cfg.drop_use(left, right, old_li[0])
     return cfg
     
 def feedback_time(chunk_start, h_i, l):
@@ -622,95 +749,128 @@ def feedback_time(chunk_start, h_i, l):
         return datetime.now()
     else: return chunk_start
     
-def feedback_level(fun, local_mdls, l, len_orig, len_new, len_all):
-    best_overall = min(local_mdls.values(), key=hsize_aux)
-    print("Level {}: {}. Known grammars: {}, best so far: ({:0.2f}, {:0.2f}). Processed: {}, new: {}, in queue: {}".format(l, fun.__name__, len(local_mdls), *best_overall, len_orig, len_new, len_all))
+def feedback_level(search, fun, len_orig, len_new, len_all):
+    best_overall = search.mdls[search.best.top(1)[0]]
+    print("Level {}: {}. Known grammars: {}, best so far: ({:0.2f}, {:0.2f}). Processed: {}, new: {}, in queue: {}".format(search.lcounter, fun.__name__, len(search.mdls), *best_overall, len_orig, len_new, len_all))
     
-def feedback_cycle(local_results, local_mdls, current_best, new_best, queue_len, bestx=1):
+def feedback_cycle(search, current_best, new_best, queue_len, bestx=1):
     lcb = len(current_best)
     unchanged = next((i for i in range(lcb) if new_best[i] != current_best[i]), lcb)
-    print("Cycle completed. No change in top {}/{}; in queue: {}; grammars recorded: {}\n".format(unchanged, check_top, queue_len, len(local_results)))
+    print("Cycle completed. No change in top {}/{}; in queue: {}; grammars recorded: {}\n".format(unchanged, search.check_top, queue_len, len(search.results)))
     
-    if verbose_feedback:
+    if search.verbose_feedback:
         for pos in range(0, bestx):
             try:
-                res = local_results[new_best[pos]]
-                print("#{} grammar: {}; ({:0.2f}, {:0.2f}); obtained at level {}, {}".format(pos, new_best[pos], *local_mdls[new_best[pos]], res.level, res.note))
+                res = search.step(new_best[pos])
+                print("#{} grammar: {}; ({:0.2f}, {:0.2f}); obtained at level {}, {}".format(pos, new_best[pos], *search.mdls[new_best[pos]], res.level, res.note))
                 pretty_mg(step_to_mg(res.mg, res.solution))
-                pretty_cfg(res.cfg, split_lex, nonzero=True, used=True)
+                pretty_cfg(res.cfg, search.split_lex, nonzero=True, used=True)
                 print("-------")
             except IndexError: break
         print()
         
-def get_history(h, local_results):
+def get_history(search, h):
     history, prev_hash = [], h
     while prev_hash:
         history.insert(0, prev_hash)
-        prev_hash = local_results[history[0]].parent
+        prev_hash = search.step(history[0]).parent
     return history
 
-def feedback_history(best_hash, local_results, local_mdls, plot_path):
+def feedback_history(search, best_hash):
     print("Recording grammar history...")
         
-    for history_hash in get_history(best_hash, local_results):
-        res = local_results[history_hash]
+    for history_hash in get_history(search, best_hash):
+        res = search.step(history_hash)
         
-        if verbose_feedback:
-            print("Obtained at level: {}, hash: {}, cost: ({:0.2f}, {:0.2f}), rank: {}; {}".format(res.level, history_hash, local_mdls[history_hash][0], local_mdls[history_hash][1], res.rank, res.note))
+        if search.verbose_feedback:
+            print("Obtained at level: {}, hash: {}, cost: ({:0.2f}, {:0.2f}), rank: {}; {}".format(res.level, history_hash, search.mdls[history_hash][0], search.mdls[history_hash][1], res.rank, res.note))
             pretty_mg(step_to_mg(res.mg, res.solution))
             pretty_mg(res.mg)
             pretty_eqs(res.eqs)
-            pretty_cfg(res.cfg, split_lex, nonzero=True, used=True)
+            pretty_cfg(res.cfg, search.split_lex, nonzero=True, used=True)
         
-        if plot_path != None:
-            plot_name = ["L{}".format(res.level), "({:0.2f}, {:0.2f})".format(local_mdls[history_hash][0], local_mdls[history_hash][1]), "{}".format(res.rank)]
-            plot_dir = os.path.join(os.getcwd(), r'{}'.format(plot_path))        
+        if search.level_plot_path != None:
+            plot_name = ["L{}".format(res.level), "({:0.2f}, {:0.2f})".format(search.mdls[history_hash][0], search.mdls[history_hash][1]), "{}".format(res.rank)]
+            plot_dir = os.path.join(os.getcwd(), r'{}'.format(search.level_plot_path))        
             if not os.path.exists(plot_dir):
                 os.makedirs(plot_dir)            
-            mg_to_plot(step_to_mg(res.mg, res.solution), "{}/{}".format(plot_dir, "-".join(plot_name)), res.note, res.fresh)
+            mg_to_plot(step_to_mg(res.mg, res.solution), "{}/{}".format(plot_dir, "-".join(plot_name)), search.head_name, res.note, res.fresh)
     print()
     
-def apply_fun_cycle(fun, queue, qparams, cutoff):
+def apply_fun_cycle(search, fun, queue, cutoff):
     queue_out = set(queue)
     while True:
-        queue = apply_fun(fun, queue, qparams, cutoff, keep_orig=False) # only steps that JUST underwent contraction
+        queue = apply_fun(search, fun, queue, cutoff, keep_orig=False) # only steps that JUST underwent contraction
         queue_out.update(queue)
         if not queue: return queue_out
     
-def apply_fun(fun, queue, qparams, cutoff, keep_orig=True):
+worker_search = None # the search a pool worker was forked with; each worker process has its own
+
+def init_worker(search):
+    global worker_search
+    worker_search = search
+    
+def expand_worker(fun_h): # run in a worker process: expand one grammar against a copy of the search state
+    fun, h = fun_h
+    n_known = len(worker_search.mdls)
+    new_queue = fun(worker_search, h, set())
+    new_hashes = [new_hash for new_hash in islice(worker_search.mdls, n_known, None) if new_hash in new_queue] # in the order add_step recorded them
+    return [(new_hash, worker_search.results[new_hash], worker_search.mdls[new_hash]) for new_hash in new_hashes]
+    
+def expand_parallel(search, fun, queue, queue_out):
+    ordered = list(queue) # merge in the order the serial loop would have used
+    # forked after the level starts, so workers see the current state
+    with multiprocessing.get_context('fork').Pool(search.jobs, init_worker, (search,)) as pool:
+        chunk_start = datetime.now()
+        chunksize = max(1, len(ordered) // (4 * search.jobs))
+        for h_i, new_steps in enumerate(pool.imap(expand_worker, [(fun, h) for h in ordered], chunksize)):
+            for new_hash, new_step, new_mdl in new_steps:
+                if not new_hash in search.mdls: # the first grammar to produce a step keeps it, as in the serial run
+                    queue_out.add(new_hash)
+                    search.record(new_hash, new_mdl)
+                    search.results[new_hash] = new_step
+            chunk_start = feedback_time(chunk_start, h_i, len(ordered))
+    return queue_out
+    
+def apply_fun(search, fun, queue, cutoff, keep_orig=True):
     queue_out = set(queue) if keep_orig else set() # initialize output queue with or without original grammars
     len_orig = len(queue_out)
     
-    transform_mg.lcounter +=1
-    chunk_start = datetime.now()
-    for h_i, h in enumerate(queue): # process each grammar in the queue
-        queue_out = fun(h, queue_out, qparams)
-        chunk_start = feedback_time(chunk_start, h_i, len(queue))       
+    search.lcounter +=1
+    if search.jobs > 1 and len(queue) > 1:
+        queue_out = expand_parallel(search, fun, queue, queue_out)
+    else:
+        chunk_start = datetime.now()
+        for h_i, h in enumerate(queue): # process each grammar in the queue
+            queue_out = fun(search, h, queue_out)
+            chunk_start = feedback_time(chunk_start, h_i, len(queue))       
 
-    queue_out = queue_out.difference(transform_mg.processed) # discard already processed grammars
-    queue_sorted_overall = sorted(queue_out, key=lambda h: hsize(transform_mg.mdls)(h))
+    queue_out = queue_out.difference(search.processed) # discard already processed grammars
+    costs = {h:search.hsize(h) for h in queue_out}
     
     if cutoff != None:
          queue_final = set()
-         if queue_out:
-             cutoff_hash = queue_sorted_overall[cutoff] if len(queue_sorted_overall) > cutoff else queue_sorted_overall[-1]
-             cutoff_val = hsize(transform_mg.mdls)(cutoff_hash)
-             cutoff_ind = next((i for (i, v) in enumerate(queue_sorted_overall) if hsize(transform_mg.mdls)(v) > cutoff_val), None)
-             queue_final.update(queue_sorted_overall[:cutoff_ind])
+         if queue_out: # keep the cutoff+1 cheapest grammars and every grammar tied with the last of them
+             cutoff_val = costs[nsmallest(cutoff+1, costs, key=costs.get)[-1]]
+             queue_sorted = sorted((h for h in costs if costs[h] <= cutoff_val), key=costs.get)
+             queue_final.update(queue_sorted)
+         else: queue_sorted = []
     
-    else: queue_final = queue_out
+    else: queue_final, queue_sorted = queue_out, sorted(costs, key=costs.get)
     
-    for queue_hash in queue_final:
-        transform_mg.results[queue_hash].rank = (queue_sorted_overall.index(queue_hash))
+    for rank, queue_hash in enumerate(queue_sorted): # sorting is stable, so ties are ranked as in a sort of all of queue_out
+        search.results[queue_hash].rank = rank
     
-    feedback_level(fun, transform_mg.mdls, transform_mg.lcounter, len(queue), len(queue_out)-len_orig, len(queue_final))
+    feedback_level(search, fun, len(queue), len(queue_out)-len_orig, len(queue_final))
     return queue_final
     
-def step_checks(new_g, new_eqs, new_ord, new_cfg, note):
+def step_checks(search, new_g, new_eqs, new_ord, new_cfg, note):
     if set(new_ord) == set(new_g.keys()): pass
     else: raise Exception("{}\nOrder does not match MG!".format(note))
     
-    if new_cfg == None or cfg_check(new_cfg, new_eqs): pass
+    search.steps_checked += 1
+    skip_cfg = search.check_every == 0 or search.steps_checked % search.check_every != 0
+    if new_cfg == None or skip_cfg or cfg_check(new_cfg, new_eqs): pass
     else:
         pretty_mg(new_g)
         pretty_eqs(new_eqs)
@@ -720,89 +880,92 @@ def step_checks(new_g, new_eqs, new_ord, new_cfg, note):
         pretty_cfg(new_cfg)
         raise Exception("{}\nCFG usage values don't check out!".format(note))    
     
-def add_step(h, new_g, new_ord, new_eqs, new_solution, new_cfg, new_queue, note=""):
+def step_cost(search, h, new_g, new_solution, new_step):
+    if search.costs == None: return search.cost_function(step_to_mg(new_step.mg, new_step.solution), new_step.cfg)
+    if h == None: return search.costs.cost(new_step.mg, new_step.solution, new_step.cfg)
+    
+    parent = search.results[h] # the unrenamed grammar shares LI names with its parent; the renamed CFG has duplicate LIs merged
+    return search.costs.child_cost(h, parent.mg, parent.solution, parent.cfg, new_g, new_solution, new_step.cfg)
     
-    step_checks(new_g, new_eqs, new_ord, new_cfg, note)    
-    new_step = make_step(new_g, new_ord, new_eqs, new_solution, new_cfg)
+def add_step(search, h, new_g, new_ord, new_eqs, new_solution, new_cfg, new_queue, note=""):
+    
+    step_checks(search, new_g, new_eqs, new_ord, new_cfg, note)    
+    new_step = make_step(new_g, new_ord, new_eqs, new_solution, new_cfg, search.orig_names)
     new_hash = hash_step(new_step.mg, new_step.eqs)
     
-    if not new_hash in transform_mg.mdls:
+    if not new_hash in search.mdls:
         new_queue.add(new_hash)
-        transform_mg.mdls[new_hash] = cost_function(step_to_mg(new_step.mg, new_step.solution), new_step.cfg)
-        new_step.parent, new_step.level, new_step.note = h, transform_mg.lcounter, note
-        transform_mg.results[new_hash] = new_step
+        search.record(new_hash, step_cost(search, h, new_g, new_solution, new_step))
+        new_step.parent, new_step.level, new_step.note = h, search.lcounter, note
+        search.results[new_hash] = new_step
 
     return new_queue
     
-def transform_mg(orig_mg, orig_eqs, orig_solution, orig_cfg, beam_size):
-    
-    global orig_names
-    orig_names = get_feature_names(orig_mg) # record feature names used in the input MG
+step_key = lambda h: "step {}".format(h)
 
-    transform_mg.lcounter = -1
-    transform_mg.results, transform_mg.mdls, transform_mg.processed = {}, {}, set()
-    ord = list(sorted(orig_mg.keys(), key=lambda x:[int(i) for i in x[1:]]))
-    queue = add_step(None, orig_mg, ord, orig_eqs, orig_solution, orig_cfg, set(), "original")
+def save_checkpoint(search, queue, new_best, finished):
+    for h, step in search.results.items(): # steps first: the state written last refers to them
+        search.checkpoint[step_key(h)] = step
+    search.checkpoint['state'] = (search.lcounter, search.orig_names, search.mdls, search.processed, queue, new_best, finished)
+    search.checkpoint.sync()
+    search.results = {h:search.results[h] for h in queue} # page out everything the next cycle does not expand
+    
+def load_checkpoint(search):
+    search.lcounter, search.orig_names, mdls, search.processed, queue, new_best, finished = search.checkpoint['state']
+    search.reset_grammars(mdls)
+    search.results = {h:search.checkpoint[step_key(h)] for h in queue}
+    print("Resuming after level {}. Known grammars: {}, in queue: {}\n".format(search.lcounter, len(search.mdls), len(queue)))
+    return queue, new_best, finished
+    
+def transform_mg(search, orig_mg, orig_eqs, orig_solution, orig_cfg, resume=False):
+    
+    if search.checkpoint_path != None:
+        checkpoint_dir = os.path.dirname(search.checkpoint_path)
+        if checkpoint_dir and not os.path.exists(checkpoint_dir): os.makedirs(checkpoint_dir)
+        search.checkpoint = shelve.open(search.checkpoint_path, 'c' if resume else 'n')
+    
+    if resume and search.checkpoint != None and 'state' in search.checkpoint:
+        queue, new_best, finished = load_checkpoint(search)
     
-    new_best = [] # initialize best hash list
-    while True:
-        
-        queue = apply_fun(qdecompose, queue, qparams, beam_size)
-        queue = apply_fun_cycle(qcontract_single, queue, qparams, beam_size)
-        queue = apply_fun(qremove_greedy, queue, qparams, beam_size)
-        
-        transform_mg.processed.update(queue) # keep track of grammars that have already been in the queue
-        mdl_hashes_sorted = sorted(transform_mg.mdls.keys(), key=hsize(transform_mg.mdls))
-        current_best, new_best = new_best, mdl_hashes_sorted[:check_top]
-        
-        valuable_hashes = set(get_history(mdl_hashes_sorted[0], transform_mg.results))
-        for h in queue: valuable_hashes.update(get_history(h, transform_mg.results))        
-        transform_mg.results = {h:transform_mg.results[h] for h in valuable_hashes}
-        
-        feedback_cycle(transform_mg.results, transform_mg.mdls, current_best, new_best, len(queue))
-        
-        if len(queue) == 0 or new_best == current_best: break
-        
-    best_hash, best_mdl = min(transform_mg.mdls.items(), key=lambda x: hsize_aux(x[1]))
-    if verbose_history: feedback_history(best_hash, transform_mg.results, transform_mg.mdls, level_plot_path)    
-    return transform_mg.results[best_hash], best_mdl
-    
-parser = argparse.ArgumentParser()
-parser.add_argument('-vf', '--verbose_feedback', action='store_true', default=False, help='print transformation steps')
-parser.add_argument('-vh', '--verbose_history', action='store_true', default=False, help='print best grammar history')
-parser.add_argument('-c', '--corpus', action='store', nargs='?', type=str, help='corpus name')
-parser.add_argument('-cs', '--corpus_size', action='store', nargs='?', type=int, default=None, help='corpus size')
-parser.add_argument('-gn', '--generate_new', action='store_true', default=False, help='force generate new corpus')
-parser.add_argument('-go', '--generate_only', action='store_true', default=False, help='generate new corpus and stop')
-parser.add_argument('-gm', '--generate_method', action='store', nargs='?', type=str, default="gen_rand", help='corpus generation method')
-parser.add_argument('-ct', '--check_top', action='store', nargs='?', type=int, default=50, help='number of grammars for the stop criterion. Default: 50')
-parser.add_argument('-bs', '--beam_size', action='store', nargs='?', type=int, default=100, help='number of candidates to keep at each level. Default: 100')
-parser.add_argument('-gc', '--grammar_cost', action='store', nargs='?', type=str, default="mdl_1d", help='grammar cost function')
-parser.add_argument('-cc', '--corpus_cost', action='store', nargs='?', type=str, default="mdl_cfg", help='corpus cost function')
-parser.add_argument('-oc', '--overall_cost', action='store', nargs='?', type=str, default="hsize_ord", help='overall cost function. Values: hsize_ord, hsize_sum, hsize_grammar, hsize_grammar_alt')
-parser.add_argument('-noch', '--nocheck', action='store_true', default=False, help='suppress the chimera_check heuristic')
-args = parser.parse_args()
-
-verbose_feedback = args.verbose_feedback
-verbose_history = args.verbose_history
-corpus_name = args.corpus
-gen_new = args.generate_new
-gen_only = args.generate_only
-gen_method = eval(args.generate_method)
-corpus_size = args.corpus_size if args.corpus_size != None else 100 if gen_method==gen_rand else inf
-
-qparams = [(False, False), (True, True)] # list of of pairs: (is_high, is_suffix); simultaneously find roots at start and suffixes
-
-beam_size = args.beam_size
-check_top = args.check_top
-use_chimera = not(args.nocheck)
-grammar_cost = eval(args.grammar_cost)
-corpus_cost = eval(args.corpus_cost)
-cost_function = mdl_full(grammar_cost, corpus_cost)
-split_lex = True if corpus_cost == mdl_cfg_split else False
-hsize_aux = eval(args.overall_cost)
-hsize = lambda d: (lambda h: hsize_aux(d[h]))
+    else:
+        search.orig_names = get_feature_names(orig_mg) # record feature names used in the input MG
 
+        search.lcounter = -1
+        search.results, search.processed = {}, set()
+        search.reset_grammars()
+        ord = list(sorted(orig_mg.keys(), key=lambda x:[int(i) for i in x[1:]]))
+        queue = add_step(search, None, orig_mg, ord, orig_eqs, orig_solution, orig_cfg, set(), "original")
+        new_best, finished = [], False # initialize best hash list
+    
+    while not finished:
+        
+        queue = apply_fun(search, qdecompose, queue, search.beam_size)
+        queue = apply_fun_cycle(search, qcontract_single, queue, search.beam_size)
+        queue = apply_fun(search, qremove_greedy, queue, search.beam_size)
+        
+        search.processed.update(queue) # keep track of grammars that have already been in the queue
+        current_best, new_best = new_best, search.best.top(search.check_top)
+        
+        valuable_hashes = set(get_history(search, search.best.top(1)[0]))
+        for h in queue: valuable_hashes.update(get_history(search, h))        
+        search.results = {h:search.results[h] for h in valuable_hashes if h in search.results} # the rest of the history is in the checkpoint
+        
+        feedback_cycle(search, current_best, new_best, len(queue))
+        
+        finished = len(queue) == 0 or new_best == current_best
+        if search.checkpoint != None: save_checkpoint(search, queue, new_best, finished)
+        
+    best_hash = search.best.top(1)[0]
+    best_mdl = search.mdls[best_hash]
+    if search.verbose_history: feedback_history(search, best_hash)    
+    best_step = search.step(best_hash)
+    
+    if search.checkpoint != None:
+        search.results.update((h, search.step(h)) for h in get_history(search, best_hash)) # the best history stays readable without the shelf
+        search.checkpoint.close()
+        search.checkpoint = None
+    return best_step, best_mdl
+    
 def show_examples(examples, mcfg, show_all):
     if show_all or len(examples) <= 50:
         for ex in examples: pretty_sentence(mcfg_string(ex, mcfg))
@@ -812,58 +975,141 @@ def show_examples(examples, mcfg, show_all):
         for ex in examples[-25:]: pretty_sentence(mcfg_string(ex, mcfg))
     print("Total examples: {}".format(len(examples)))
 
-if __name__ == "__main__":
+
+sized_methods = [gen_rand, gen_uniform, gen_uniform_syn, gen_pcfg] # generation methods that draw with replacement, so every corpus size is finite
+
+class Config: # options for a learner run; defaults match the command line
+    def __init__(self, corpus_size=None, gen_method=gen_rand, beam_size=100, check_top=50, grammar_cost=mdl_1d, corpus_cost=mdl_cfg,
+                 overall_cost=hsize_ord, use_chimera=True, jobs=1, verbose_feedback=False, verbose_history=False, level_plot_path=None,
+                 checkpoint_path=None, resume=False, check_every=1, mean_length=None):
+        self.gen_method = gen_method
+        self.mean_length = mean_length # gen_pcfg: tilt rule probabilities to this many LIs per sentence on average; None to keep them
+        self.corpus_size = corpus_size if corpus_size != None else 100 if gen_method in sized_methods else inf # otherwise all trees
+        self.beam_size = beam_size
+        self.check_top = check_top
+        self.grammar_cost = grammar_cost
+        self.corpus_cost = corpus_cost
+        self.overall_cost = overall_cost
+        self.use_chimera = use_chimera
+        self.jobs = jobs
+        self.verbose_feedback = verbose_feedback
+        self.verbose_history = verbose_history
+        self.level_plot_path = level_plot_path
+        self.checkpoint_path = checkpoint_path
+        self.resume = resume # continue from the last cycle saved at checkpoint_path
+        self.check_every = check_every # check CFG usage on every n-th new step; 0 to skip the check
+        
+        self.qparams = [(False, False), (True, True)] # list of of pairs: (is_high, is_suffix); simultaneously find roots at start and suffixes
+        self.cost_function = mdl_full(grammar_cost, corpus_cost)
+        
+    def gen_args(self): # keyword arguments for the generation method
+        return {'mean_length': self.mean_length} if self.gen_method == gen_pcfg and self.mean_length != None else {}
+
+class Corpus: # a sample generated from an input grammar, together with that grammar
+    def __init__(self, head_name, examples, mcfg, mg, eqs, solution):
+        self.head_name = head_name
+        self.examples = examples
+        self.mcfg = mcfg
+        self.mg = mg
+        self.eqs = eqs
+        self.solution = solution
+        
+def corpus_path(corpus_name, config):
+    mean_length = "_ml{}".format(config.mean_length) if config.gen_args() else ""
+    return "corpora/{}_{}_{}{}.corpus".format(corpus_name, config.gen_method.__name__, config.corpus_size, mean_length)
+    
+def generate_corpus(corpus_name, config):
+    start_mg, head_name = file_to_mg(corpus_name)
+    orig_mg, orig_eqs, mor_to_str = preprocess_mg(start_mg, head_name)
+    mcfg, examples, orig_eqs = make_corpus(orig_mg, orig_eqs, mor_to_str, config.corpus_size, config.gen_method, start_exp_fun(head_name), config.jobs, config.gen_args())
+    return Corpus(head_name, examples, mcfg, orig_mg, orig_eqs, mor_to_str)
+    
+def save_corpus(corpus, path):
+    corpus_dir = os.path.dirname(path)
+    if corpus_dir and not os.path.exists(corpus_dir): os.makedirs(corpus_dir)
+    write_corpus(path, corpus.head_name, corpus.examples, corpus.mcfg, corpus.mg, corpus.eqs, corpus.solution)
+    
+def load_corpus(path): # a Stored_corpus reads each part from the file on first use
+    return read_corpus(path)
+    
+def get_corpus(corpus_name, config, gen_new=False): # load a stored corpus, generating and storing it if needed
+    path = corpus_path(corpus_name, config)
+    if gen_new or not os.path.exists(path):
+        print("Generating corpus:")
+        corpus = generate_corpus(corpus_name, config)
+        save_corpus(corpus, path)
+    else:
+        print("Loading corpus:")
+        corpus = load_corpus(path)
+    return corpus
+    
+def make_search(head_name, config):
+    return Search(head_name, config.grammar_cost, config.corpus_cost, config.overall_cost, config.beam_size, config.check_top, config.use_chimera,
+                  config.qparams, config.jobs, config.verbose_feedback, config.verbose_history, config.level_plot_path,
+                  checkpoint_path=config.checkpoint_path, check_every=config.check_every)
+    
+def run_search(corpus, config): # learn a grammar for the corpus; returns the best step and its cost
+    search = make_search(corpus.head_name, config)
+    orig_cfg = drop_maps(corpus.mcfg) if config.overall_cost != hsize_grammar else None
+    return transform_mg(search, corpus.mg, corpus.eqs, corpus.solution, orig_cfg, config.resume)
+    
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-vf', '--verbose_feedback', action='store_true', default=False, help='print transformation steps')
+    parser.add_argument('-vh', '--verbose_history', action='store_true', default=False, help='print best grammar history')
+    parser.add_argument('-c', '--corpus', action='store', nargs='?', type=str, help='corpus name')
+    parser.add_argument('-cs', '--corpus_size', action='store', nargs='?', type=int, default=None, help='corpus size. Default: 100 for gen_rand and gen_uniform, otherwise every tree')
+    parser.add_argument('-gn', '--generate_new', action='store_true', default=False, help='force generate new corpus')
+    parser.add_argument('-go', '--generate_only', action='store_true', default=False, help='generate new corpus and stop')
+    parser.add_argument('-gm', '--generate_method', action='store', nargs='?', type=str, default="gen_rand", help='corpus generation method')
+    parser.add_argument('-ml', '--mean_length', action='store', nargs='?', type=float, default=None, help='with gen_pcfg, target mean sentence length in LIs. Default: the unscaled rule probabilities')
+    parser.add_argument('-ct', '--check_top', action='store', nargs='?', type=int, default=50, help='number of grammars for the stop criterion. Default: 50')
+    parser.add_argument('-bs', '--beam_size', action='store', nargs='?', type=int, default=100, help='number of candidates to keep at each level. Default: 100')
+    parser.add_argument('-gc', '--grammar_cost', action='store', nargs='?', type=str, default="mdl_1d", help='grammar cost function')
+    parser.add_argument('-cc', '--corpus_cost', action='store', nargs='?', type=str, default="mdl_cfg", help='corpus cost function')
+    parser.add_argument('-oc', '--overall_cost', action='store', nargs='?', type=str, default="hsize_ord", help='overall cost function. Values: hsize_ord, hsize_sum, hsize_grammar, hsize_grammar_alt')
+    parser.add_argument('-noch', '--nocheck', action='store_true', default=False, help='suppress the chimera_check heuristic')
+    parser.add_argument('-j', '--jobs', action='store', nargs='?', type=int, default=1, help='number of worker processes for expanding the beam. Default: 1')
+    parser.add_argument('-ck', '--checkpoint', action='store_true', default=False, help='save the search state after every cycle')
+    parser.add_argument('-rs', '--resume', action='store_true', default=False, help='continue from the last saved cycle (implies --checkpoint)')
+    parser.add_argument('-ce', '--check_every', action='store', nargs='?', type=int, default=1, help='check CFG usage on every n-th new grammar; 0 to skip the check. Default: 1')
+    args = parser.parse_args(argv)
     
     start_time = datetime.now()
     
-    args_data = "{}_bs{}_{}_{}".format(corpus_name, beam_size, args.overall_cost, "ch" if use_chimera else "noch")
-    # args_data = "{}-{}-{}-bs{}-{}-{}-{}-{}".format(corpus_name, args.generate_method, corpus_size, beam_size, args.grammar_cost, args.corpus_cost, args.overall_cost, "ch" if use_chimera else "noch")
+    args_data = "{}_bs{}_{}_{}".format(args.corpus, args.beam_size, args.overall_cost, "noch" if args.nocheck else "ch")
     level_plot_path = "plots/{}".format(args_data)
-    corpus_path = "corpora/{}_{}_{}".format(corpus_name, args.generate_method, corpus_size)
-    
-    if verbose_history and os.path.exists(level_plot_path): shutil.rmtree(level_plot_path)
+    checkpoint_path = "checkpoints/{}".format(args_data) if args.checkpoint or args.resume else None
+    config = Config(args.corpus_size, eval(args.generate_method), args.beam_size, args.check_top, eval(args.grammar_cost), eval(args.corpus_cost),
+                    eval(args.overall_cost), not(args.nocheck), args.jobs, args.verbose_feedback, args.verbose_history, level_plot_path,
+                    checkpoint_path, args.resume, args.check_every, args.mean_length)
     
-    global head_name
+    if config.verbose_history and os.path.exists(level_plot_path): shutil.rmtree(level_plot_path)
     
-    if gen_new or not os.path.exists("{}.db".format(corpus_path)): # generate a new corpus 
-        print("Generating corpus:")
-        start_mg, head_name = file_to_mg(corpus_name)
-        orig_mg, orig_eqs, mor_to_str = preprocess_mg(start_mg)
-        
-        mcfg, examples, orig_eqs = make_corpus(orig_mg, orig_eqs, mor_to_str, corpus_size, gen_method, start_exp_fun(head_name))
-        
-        shelf = shelve.open(corpus_path)
-        shelf['head_name'], shelf['examples'], shelf['mcfg'], shelf['mg'], shelf['eqs'] = head_name, examples, mcfg, orig_mg, orig_eqs
-        shelf['solution'] = mor_to_str
-        shelf.close()
-        
-    else: # load an existing corpus
-        print("Loading corpus:")
-        shelf = shelve.open(corpus_path)
-        head_name, examples, mcfg, orig_mg, orig_eqs = shelf['head_name'], shelf['examples'], shelf['mcfg'], shelf['mg'], shelf['eqs']
-        mor_to_str = shelf['solution']
-        shelf.close()
+    corpus = get_corpus(args.corpus, config, args.generate_new)
     
-    show_examples(examples, mcfg, gen_only)
-    orig_solved = step_to_mg(orig_mg, mor_to_str)
-    print("Input cost: ({:0.2f}, {:0.2f})\n".format(*cost_function(orig_solved, mcfg)))
-    mg_to_plot(orig_solved, "plots/{}_original".format(corpus_name))
+    show_examples(corpus.examples, corpus.mcfg, args.generate_only)
+    orig_solved = step_to_mg(corpus.mg, corpus.solution)
+    print("Input cost: ({:0.2f}, {:0.2f})\n".format(*config.cost_function(orig_solved, corpus.mcfg)))
+    mg_to_plot(orig_solved, "plots/{}_original".format(args.corpus), corpus.head_name)
         
-    if not gen_only:  
+    if not args.generate_only:  
         
-        orig_cfg = drop_maps(mcfg) if hsize_aux != hsize_grammar else None
-        pretty_cfg(orig_cfg, nonzero=True, used=True)
+        if config.overall_cost != hsize_grammar: pretty_cfg(drop_maps(corpus.mcfg), nonzero=True, used=True)
         
-        best_result, best_cost = transform_mg(orig_mg, orig_eqs, mor_to_str, orig_cfg, beam_size)
+        best_result, best_cost = run_search(corpus, config)
         
         print()
         new_solved = step_to_mg(best_result.mg, best_result.solution)
         pretty_mg(new_solved, True)
         pretty_eqs(best_result.eqs)
-        mg_to_plot(new_solved, "plots/{}_({:0.2f}, {:0.2f})".format(args_data, best_cost[0], best_cost[1]))
-        print("Output cost: {}".format(cost_function(new_solved, best_result.cfg)))        
+        mg_to_plot(new_solved, "plots/{}_({:0.2f}, {:0.2f})".format(args_data, best_cost[0], best_cost[1]), corpus.head_name)
+        print("Output cost: {}".format(config.cost_function(new_solved, best_result.cfg)))        
         print("Best grammar hash: {}".format(hash_step(new_solved)))
         
-        mg_to_file(new_solved, "{}_out".format(corpus_name), head_name)
+        mg_to_file(new_solved, "{}_out".format(args.corpus), corpus.head_name)
     
     print("Elapsed time: {}\n".format(datetime.now() - start_time))
+
+if __name__ == "__main__":
+    main()
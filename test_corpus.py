@@ -0,0 +1,49 @@
+import os
+import pytest
+from corpus import *
+from grammars import mg2mcfg, gen_ord, mcfg_uses, start_symbol
+from mgagr import file_to_mg, get_sem_features, unpack_mg_constrained
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch): # lexica are read relative to the repo
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+def rule_dump(mcfg): # rules with their usage as plain values, for comparison
+    return {left:{right:(data.is_term, {m:(u.ind, u.num) for m, u in data.usage.items()}, data.mcfg_map) for right, data in rights.items()}
+            for left, rights in mcfg.items()}
+
+def same_tree(t1, t2): # == without recursion
+    stack = [(t1, t2)]
+    while stack:
+        x, y = stack.pop()
+        if isinstance(x, list) and isinstance(y, list) and len(x) == len(y): stack.extend(zip(x, y))
+        elif isinstance(x, list) or isinstance(y, list) or x != y: return False
+    return True
+
+def corpus_parts(name, n):
+    start, mg, eqs = file_to_mg(name)
+    unpacked = dict(enumerate(unpack_mg_constrained(mg, get_sem_features(mg), start)))
+    g, solution = {i:sb for i, (sem, sb) in unpacked.items()}, {i:str(sem) for i, (sem, sb) in unpacked.items()}
+    mcfg = mg2mcfg(g, start, useful=True, one_op=True)
+    examples = gen_ord(mcfg, solution, n)
+    for t in examples: mcfg_uses(t, mcfg)
+    return start, examples, mcfg, g, {'w': ('a', 'b')}, solution
+
+
+def test_corpus_round_trip(tmp_path):
+    parts = corpus_parts('there_high', 50)
+    write_corpus(tmp_path / 'c', *parts)
+    stored = read_corpus(tmp_path / 'c')
+    head_name, examples, mcfg, mg, eqs, solution = parts
+    assert (stored.head_name, stored.mg, stored.eqs, stored.solution) == (head_name, mg, eqs, solution)
+    assert rule_dump(stored.mcfg) == rule_dump(mcfg)
+    assert len(stored.examples) == len(examples) and list(stored.examples) == examples
+    assert stored.examples[-1] == examples[-1]
+
+def test_deep_tree_round_trip(tmp_path):
+    head_name, examples, mcfg, mg, eqs, solution = corpus_parts('there_high', 1)
+    deep = examples[0]
+    for i in range(3000): deep = [(start_symbol, False), deep]
+    write_corpus(tmp_path / 'c', head_name, [deep, examples[0]], mcfg, mg, eqs, solution)
+    stored = read_corpus(tmp_path / 'c')
+    assert same_tree(stored.examples[0], deep) and stored.examples[1] == examples[0]
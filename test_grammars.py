@@ -0,0 +1,198 @@
+import os, random
+from copy import deepcopy
+import pytest
+import grammars
+from grammars import *
+from mgagr import file_to_mg, get_sem_features, unpack_mg_constrained
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch): # lexica are read relative to the repo
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+def rule_dump(mcfg): # rules with their usage as plain values, for comparison
+    return {left:{right:(data.is_term, {m:(u.ind, u.num) for m, u in data.usage.items()}, data.mcfg_map) for right, data in rights.items()}
+            for left, rights in mcfg.items()}
+
+def unpacked(name):
+    start, mg, eqs = file_to_mg(name)
+    return start, [sb for sem, sb in unpack_mg_constrained(mg, get_sem_features(mg), start)]
+
+
+@pytest.mark.parametrize('name, one_op', [('there_high', True), ('eng', False), ('eng_one_op', True)])
+def test_semi_naive_closure_matches_naive(name, one_op):
+    start, pool = unpacked(name)
+    mg = dict(enumerate(pool))
+    for useful in (False, True):
+        assert rule_dump(mg2mcfg(mg, start, useful, one_op, semi_naive=True)) == rule_dump(mg2mcfg(mg, start, useful, one_op))
+
+@pytest.mark.parametrize('name, one_op', [('there_high', True), ('eng', False), ('eng_one_op', True)])
+def test_incremental_mcfg_matches_mg2mcfg(name, one_op):
+    start, pool = unpacked(name)
+    rng = random.Random(7)
+    mg = {i:pool[i] for i in rng.sample(range(len(pool)), len(pool) // 2)}
+    inc, next_name = Incremental_mcfg(mg, start, one_op), len(pool)
+    for step in range(40):
+        op = rng.choice(['add', 'remove', 'replace']) if mg else 'add'
+        if op == 'add':
+            mg[next_name] = rng.choice(pool)
+            inc.add_li(next_name, mg[next_name])
+            next_name += 1
+        elif op == 'remove':
+            name = rng.choice(list(mg))
+            del mg[name]
+            inc.remove_li(name)
+        else:
+            name = rng.choice(list(mg))
+            mg[name] = rng.choice(pool)
+            inc.replace_li(name, mg[name])
+        for useful in (False, True):
+            assert rule_dump(inc.mcfg(useful)) == rule_dump(mg2mcfg(dict(mg), start, useful=useful, one_op=one_op))
+
+def unpacked_mcfg(name, one_op):
+    start, pool = unpacked(name)
+    mg = dict(enumerate(pool))
+    return mg2mcfg(mg, start, useful=True, one_op=one_op), {i:str(i) for i in mg}
+
+def tree_size(t): # rule applications in a derivation tree
+    size, stack = 0, [t]
+    while stack:
+        t = stack.pop()
+        size += 1
+        if not t[0][1]: stack.extend(t[1:])
+    return size
+
+def test_derivations_unranking():
+    mcfg, mor_to_str = unpacked_mcfg('eng', False)
+    derivations = Derivations(mcfg, mor_to_str)
+    for size in range(1, 13):
+        trees = list(derivations.trees(start_symbol, size))
+        assert len(trees) == derivations.count(start_symbol, size)
+        assert [derivations.tree(start_symbol, size, r) for r in range(len(trees))] == trees
+        assert all(tree_size(t) == size for t in trees)
+    with pytest.raises(IndexError): derivations.tree(start_symbol, 12, derivations.count(start_symbol, 12))
+
+def test_gen_ord_by_size():
+    mcfg, mor_to_str = unpacked_mcfg('eng', False)
+    trees = gen_ord(mcfg, mor_to_str, 200)
+    sizes = [tree_size(t) for t in trees]
+    assert len(trees) == 200 and sizes == sorted(sizes)
+    assert len(set(repr(t) for t in trees)) == 200
+    assert trees[:20] == gen_ord(mcfg, mor_to_str, 20)
+    with pytest.raises(Exception, match='infinitely many'): gen_ord(mcfg, mor_to_str, inf)
+
+def test_gen_sample_distinct():
+    mcfg, mor_to_str = unpacked_mcfg('eng', False)
+    random.seed(1)
+    trees = gen_sample(mcfg, mor_to_str, 100, max_size=16)
+    assert len(set(repr(t) for t in trees)) == 100 and max(tree_size(t) for t in trees) <= 16
+    assert len(gen_sample(mcfg, mor_to_str, 10 ** 6, max_size=10)) == sum(Derivations(mcfg).count(start_symbol, s) for s in range(1, 11))
+    with pytest.raises(Exception, match='infinitely many'): gen_sample(mcfg, mor_to_str, inf)
+
+def test_gen_uniform_is_uniform():
+    mcfg, mor_to_str = unpacked_mcfg('eng', False)
+    random.seed(2)
+    n = sum(Derivations(mcfg).count(start_symbol, s) for s in range(1, 11))
+    trees = gen_uniform(mcfg, mor_to_str, 100 * n, max_size=10)
+    counts = {}
+    for t in trees: counts[repr(t)] = counts.get(repr(t), 0) + 1
+    assert len(counts) == n == 44
+    assert sum((c - 100) ** 2 / 100 for c in counts.values()) < 80 # chi-square above its 0.999 quantile for 43 degrees of freedom
+    with pytest.raises(Exception, match='finite corpus size'): gen_uniform(mcfg, mor_to_str, inf)
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_corpus_counts_match_sequential_counts(jobs):
+    start, pool = unpacked('eng')
+    mg = dict(enumerate(pool))
+    mcfg, mor_to_str = mg2mcfg(mg, start), {i:str(i) for i in mg}
+    random.seed(4)
+    examples = gen_uniform(mg2mcfg(mg, start, useful=True), mor_to_str, 300)
+    
+    sequential, words = deepcopy(mcfg), {}
+    for ex in examples:
+        mcfg_uses(ex, sequential)
+        for w in mcfg_to_words(mcfg_string(ex, sequential), mg): words[w] = words.get(w, 0) + 1
+    batched = deepcopy(mcfg)
+    rule_counts, word_counts = corpus_counts(examples, batched, mg, jobs)
+    assert rule_dump(add_rule_counts(batched, rule_counts)) == rule_dump(sequential)
+    assert dict(word_counts) == words
+
+def usage_cfg_and_eqs(): # CFG with the usage of a uniform corpus, and one equation per LI holding its number of uses
+    start, pool = unpacked('eng')
+    mg = dict(enumerate(pool))
+    mcfg, mor_to_str = mg2mcfg(mg, start), {i:str(i) for i in mg}
+    random.seed(5)
+    rule_counts, word_counts = corpus_counts(gen_uniform(mg2mcfg(mg, start, useful=True), mor_to_str, 200), mcfg, mg)
+    cfg = drop_maps(add_rule_counts(mcfg, rule_counts))
+    li_uses = {li: 0 for li in mg}
+    for rights in cfg.values():
+        for right, data in rights.items():
+            if data.is_term: li_uses[right[0]] += data.usage_sum()
+    return cfg, {(str(li), str(li), n): [li] for li, n in li_uses.items()}
+
+def test_cfg_check():
+    cfg, eqs = usage_cfg_and_eqs()
+    assert cfg_check(deepcopy(cfg), eqs)
+    
+    used = [(left, right, li) for left, rights in cfg.items() for right, data in rights.items() for li, u in data.usage.items() if u.num]
+    rng = random.Random(6)
+    for i in range(30):
+        changed = deepcopy(cfg)
+        left, right, li = rng.choice(used)
+        changed[left][right].usage[li].num += 1
+        assert not cfg_check(changed, eqs)
+
+def lis_in(t): # LIs in a derivation tree, one per terminal node
+    n, stack = 0, [t]
+    while stack:
+        t = stack.pop()
+        if t[0][1]: n += 1
+        else: stack.extend(t[1:])
+    return n
+
+def mean_and_error(xs):
+    mean = sum(xs) / len(xs)
+    return mean, (sum((x - mean) ** 2 for x in xs) / (len(xs) - 1) / len(xs)) ** .5
+
+def test_pcfg_expectations_match_samples():
+    mcfg, mor_to_str = unpacked_mcfg('eng', False)
+    probs = rule_probs(mcfg)
+    random.seed(12)
+    trees = [pcfg_tree(mcfg, mor_to_str, probs, inf) for i in range(4000)]
+    for expected, measure in ((expected_lengths(probs), lis_in), (expected_sizes(probs), tree_size)):
+        mean, error = mean_and_error([measure(t) for t in trees])
+        assert abs(mean - expected[start_symbol]) < 4 * error
+
+@pytest.mark.parametrize('mean_length', [4, 10])
+def test_rescale_probs_reaches_mean_length(mean_length):
+    mcfg, mor_to_str = unpacked_mcfg('eng', False)
+    assert expected_lengths(rescale_probs(rule_probs(mcfg), mean_length))[start_symbol] == pytest.approx(mean_length, rel=1e-3)
+    random.seed(13)
+    trees = gen_pcfg(mcfg, mor_to_str, 2000, mean_length=mean_length)
+    mean, error = mean_and_error([lis_in(t) for t in trees])
+    assert abs(mean - mean_length) < 4 * error + .02 * mean_length # redrawing the largest trees shortens sentences a little
+
+def toy_mcfg(rights): # {left: {right: is_term}}
+    return {left: {right: Rule_data(is_term, {}) for right, is_term in rs.items()} for left, rs in rights.items()}
+
+def test_gen_pcfg_errors_and_redraws():
+    branching = toy_mcfg({start_symbol: {('A',): False}, 'A': {('A', 'A'): False, ('a',): True}})
+    probs = {start_symbol: {('A',): 1}, 'A': {('A', 'A'): .7, ('a',): .3}} # more than one child expected per node
+    assert expected_lengths(probs)[start_symbol] == inf
+    with pytest.raises(Exception, match='do not terminate'): gen_pcfg(branching, {'a': 'a'}, 10, probs=probs)
+    random.seed(14)
+    max_size = 3 * expected_sizes(rescale_probs(probs, 3))[start_symbol]
+    trees = gen_pcfg(branching, {'a': 'a'}, 500, probs=probs, mean_length=3, max_factor=3)
+    assert len(trees) == 500 and max(tree_size(t) for t in trees) <= max_size
+    
+    pair = toy_mcfg({start_symbol: {('A', 'A'): False}, 'A': {('a',): True}}) # every sentence has two LIs
+    with pytest.raises(Exception, match='longer than 1 LIs'): gen_pcfg(pair, {'a': 'a'}, 10, mean_length=1)
+    assert [lis_in(t) for t in gen_pcfg(pair, {'a': 'a'}, 5, mean_length=2)] == [2] * 5
+    with pytest.raises(Exception, match='finite corpus size'): gen_pcfg(pair, {'a': 'a'}, inf)
+
+def test_solve_linear_without_numpy(monkeypatch):
+    mcfg, mor_to_str = unpacked_mcfg('eng', False)
+    probs = rule_probs(mcfg)
+    lengths, sizes = expected_lengths(probs), expected_sizes(probs)
+    monkeypatch.setattr(grammars, 'load_numpy', lambda: None)
+    assert expected_lengths(probs) == pytest.approx(lengths) and expected_sizes(probs) == pytest.approx(sizes)
+    assert solve_linear([[1, 2], [2, 4]], [1, 2]) == None
@@ -0,0 +1,248 @@
+import os, subprocess, sys, io, contextlib, random
+import pytest
+import optimize
+from optimize import *
+from benchmarks import plain_mg
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch): # lexica are read relative to the repo
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_hash_step_is_stable_across_processes():
+    code = "from optimize import *; from benchmarks import plain_mg; print(hash_step(plain_mg('eng')[1], {'w': ['a', 'b']}))"
+    for seed in (1, 2):
+        out = subprocess.run([sys.executable, '-c', code], env=dict(os.environ, PYTHONHASHSEED=str(seed)), capture_output=True, check=True, text=True).stdout
+        assert int(out) == hash_step(plain_mg('eng')[1], {'w': ['a', 'b']})
+
+def test_numpy_is_imported_on_first_use():
+    code = "import sys, optimize; loaded = 'numpy' in sys.modules; optimize.mdl_cfg({0: {}}); print(loaded, 'numpy' in sys.modules)"
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, check=True, text=True).stdout
+    assert out.split() == ['False', str(load_numpy() is not None)]
+
+def test_hash_step_update():
+    mg = plain_mg('eng')[1]
+    names = list(mg)
+    new_mg = dict(mg)
+    new_mg[names[1]] = mg[names[0]]
+    h = hash_step_update(hash_step(mg), old_lis=[(1, names[1], mg[names[1]])], new_lis=[(1, names[1], mg[names[0]])],
+                         new_eqs=[('w', ['a'])])
+    assert h == hash_step(new_mg, {'w': ['a']})
+    assert h != hash_step(mg) and hash_step(dict(reversed(mg.items()))) != hash_step(mg) # the order is part of the grammar
+
+def run_search(config, lexicon='eng'): # transform_mg on a plain lexicon, quietly
+    start, mg = plain_mg(lexicon)
+    search = make_search(start, config)
+    with contextlib.redirect_stdout(io.StringIO()): result = transform_mg(search, *preprocess_mg(mg, start), None)
+    return search, result
+
+def usage_cfg(rng, n_lefts=6, lis='abcdef'): # a random CFG with rule usage, for the corpus costs
+    cfg = Cfg()
+    for left in range(n_lefts):
+        for right in range(rng.randint(1, 4)):
+            cfg.setdefault(left, {})[(right,)] = Rule_data(right == 0, {m: LI_usage(1, rng.randint(0, 5)) for m in rng.sample(lis, 2)})
+    return cfg
+
+
+@pytest.mark.parametrize('grammar_cost', [mdl_1d, mdl_2d, mdl_3d])
+def test_incremental_cost_matches_full_cost(monkeypatch, grammar_cost):
+    scored = []
+    def checked(search, h, new_g, new_solution, new_step):
+        cost = step_cost(search, h, new_g, new_solution, new_step)
+        with contextlib.redirect_stdout(io.StringIO()): # mdl_1d reports its parts
+            assert cost == search.cost_function(step_to_mg(new_step.mg, new_step.solution), new_step.cfg)
+        scored.append(h)
+        return cost
+    monkeypatch.setattr(optimize, 'step_cost', checked)
+    search, result = run_search(Config(beam_size=5, grammar_cost=grammar_cost, overall_cost=hsize_grammar))
+    assert search.costs.hits and any(h != None for h in scored)
+
+@pytest.mark.parametrize('corpus_cost', [mdl_cfg, mdl_cfg_split])
+def test_incremental_cost_matches_full_cost_with_cfg(monkeypatch, corpus_cost):
+    checked_costs = []
+    def checked(search, h, new_g, new_solution, new_step):
+        cost = step_cost(search, h, new_g, new_solution, new_step)
+        full = search.cost_function(step_to_mg(new_step.mg, new_step.solution), new_step.cfg)
+        assert cost == search.costs.cost(new_step.mg, new_step.solution, new_step.cfg) and cost == pytest.approx(full)
+        checked_costs.append(cost)
+        return cost
+    monkeypatch.setattr(optimize, 'step_cost', checked)
+    
+    rng = random.Random(11)
+    bundles = [Bundle([Feature(cat, 't')]), Bundle([Feature(rsel, 't'), Feature(cat, 'c')]), Bundle([Feature(rsel, 'c'), Feature(cat, 'c')]),
+               Bundle([Feature(rsel, 'v'), Feature(cat, 't')]), Bundle([Feature(cat, 'v')])] # v is renamed by make_step
+    search = Search('c', mdl_2d, corpus_cost, hsize_sum, check_every=0)
+    search.orig_names = {'t', 'c'}
+    mg = {'l{}'.format(i): rng.choice(bundles) for i in range(6)}
+    cfg = Cfg({start_symbol: {(terminal_exp(bundles[2]),): Rule_data(False, {'l0': LI_usage(1, 4)})}})
+    for li, li_syn in mg.items(): cfg.setdefault(terminal_exp(li_syn), {})[(li,)] = Rule_data(True, {li: LI_usage(0, rng.randint(1, 5))})
+    queue = add_step(search, None, mg, list(mg), {}, {li: rng.choice('xy') for li in mg}, cfg, set())
+    
+    for i in range(40): # children of random known grammars; phon changes make and break duplicate LIs
+        h = rng.choice(list(search.results))
+        parent = search.results[h]
+        new_g, new_solution, new_cfg = dict(parent.mg), dict(parent.solution), parent.cfg.derive()
+        new_solution[rng.choice(list(new_g))] = rng.choice('xyz')
+        li = rng.choice(list(new_g))
+        rights = new_cfg[terminal_exp(new_g[li])]
+        num = rights[(li,)].usage[li].num
+        new_cfg.drop_use(terminal_exp(new_g[li]), (li,), li)
+        new_g[li] = rng.choice(bundles) # its terminal rule moves along, with one more use
+        new_cfg.add_use(terminal_exp(new_g[li]), (li,), True, li, 0, num + 1)
+        add_step(search, h, new_g, list(parent.mg), {}, new_solution, new_cfg, set())
+    assert len(checked_costs) > 20 and any(cost[1] for cost in checked_costs) and search.costs.hits
+
+@pytest.mark.parametrize('corpus_cost', [mdl_cfg, mdl_cfg_split])
+def test_incremental_corpus_cost(corpus_cost):
+    rng = random.Random(3)
+    costs = Incremental_cost(mdl_2d, corpus_cost)
+    mg, solution = {'a': Bundle([Feature(cat, 't')])}, {'a': 'a'}
+    for trial in range(20):
+        parent = usage_cfg(rng)
+        cfg = parent.derive()
+        for i in range(3):
+            left, right = rng.randrange(6), (rng.randrange(5),)
+            if rng.random() < .5: cfg.add_use(left, right, False, rng.choice('abcdef'), 1, rng.randint(1, 5))
+            elif right in cfg.get(left, {}): cfg.drop_use(left, right, next(iter(cfg[left][right].usage)))
+        cost = costs.child_cost(trial, mg, solution, parent, mg, solution, cfg)
+        assert cost == costs.cost(mg, solution, cfg)
+        assert cost[1] == pytest.approx(corpus_cost(cfg))
+
+def test_resume_after_interruption(monkeypatch, tmp_path):
+    config = Config(beam_size=10, grammar_cost=mdl_1d, overall_cost=hsize_grammar)
+    search, result = run_search(config)
+    
+    config.checkpoint_path = str(tmp_path / 'eng')
+    saves = []
+    def interrupted(search, *args):
+        save_checkpoint(search, *args)
+        saves.append(search.lcounter)
+        if len(saves) == 2:
+            search.checkpoint.close()
+            raise KeyboardInterrupt
+    monkeypatch.setattr(optimize, 'save_checkpoint', interrupted)
+    with pytest.raises(KeyboardInterrupt): run_search(config)
+    
+    monkeypatch.setattr(optimize, 'save_checkpoint', save_checkpoint)
+    start, mg = plain_mg('eng')
+    resumed = make_search(start, config)
+    with contextlib.redirect_stdout(io.StringIO()): resumed_result = transform_mg(resumed, *preprocess_mg(mg, start), None, resume=True)
+    assert resumed_result[1] == result[1] and resumed.best.top(5) == search.best.top(5)
+    best = resumed.best.top(1)[0]
+    assert len(get_history(resumed, best)) > 1 and get_history(resumed, best) == get_history(search, best) # read back before the shelf closed
+
+def cfg_dump(cfg):
+    return {left:{right:(data.is_term, {m:(u.ind, u.num) for m, u in data.usage.items()}) for right, data in rights.items()} for left, rights in cfg.items()}
+
+def test_cfg_copy_on_write():
+    rng = random.Random(5)
+    parent = usage_cfg(rng)
+    parent[6] = {}
+    parent[0][(9,)] = Rule_data(False, {})
+    before = cfg_dump(parent)
+    
+    child = parent.derive()
+    assert not 6 in child and not (9,) in child[0] # unused rules and empty buckets go, as in cfg_add
+    child.add_use(0, (1,), False, 'z', 2, 3)
+    right, data = next(iter(child[1].items()))
+    child.drop_use(1, right, next(iter(data.usage)))
+    assert cfg_dump(parent) == before
+    assert set(child.li_rules('z')) == {(0, (1,))}
+    
+    changed = parent.derive()
+    for left in range(6): changed.add_use(left, (0,), True, 'a', 1, 1) # changed owns every bucket now
+    grandchild = changed.derive()
+    grandchild_before = cfg_dump(grandchild)
+    for left in range(6): changed.add_use(left, (0,), True, 'a', 1, 1) # and copies them again once derived from
+    assert cfg_dump(grandchild) == grandchild_before
+
+def test_rename_cfg_shared_buckets_stay_copy_on_write():
+    bundle = Bundle([Feature(cat, 't')])
+    parent = Cfg({start_symbol: {(terminal_exp(bundle),): Rule_data(False, {'a': LI_usage(1, 1)})}, terminal_exp(bundle): {('a',): Rule_data(True, {'a': LI_usage(0, 1)})}})
+    cfg = parent.derive()
+    cfg.add_use(terminal_exp(bundle), ('a',), True, 'a', 0, 1) # cfg owns the bucket now
+    renamed = rename_cfg(cfg, {}, {'a': 'a'})
+    assert renamed[terminal_exp(bundle)] is cfg[terminal_exp(bundle)] # nothing to rename
+    before = cfg_dump(renamed)
+    cfg.add_use(terminal_exp(bundle), ('a',), True, 'a', 0, 1)
+    cfg.drop_use(start_symbol, (terminal_exp(bundle),), 'a')
+    assert cfg_dump(renamed) == before
+
+def chimera_candidates(g, solution, rng): # the checks qcontract_single makes, and random ones
+    vals = sorted({f.val for li_syn in g.values() for f in li_syn}, key=str)
+    candidates = [(li_mor, f_out, f_in) for (f_out, f_in), li_mor in cat_changers(g.items(), solution, False).items()]
+    return candidates + [(rng.choice(list(g)), rng.choice(vals), rng.choice(vals)) for i in range(5)]
+
+def test_chimera_check_matches_brute_force():
+    from test_words import simple_path_words
+    search, result = run_search(Config(beam_size=10, grammar_cost=mdl_2d, overall_cost=hsize_grammar))
+    rng, verdicts = random.Random(8), set()
+    for step in search.results.values():
+        g, eqs, solution = step.mg, step.eqs, step.solution
+        old_paths = old_words(g, eqs, solution)
+        for cc, f_out, f_in in chimera_candidates(g, solution, rng):
+            f_new = unify_name((f_out, f_in), search.head_name, search.orig_names, id=f_in)
+            new_g = unify_grammar({li_mor:li_syn for li_mor, li_syn in g.items() if li_mor != cc}, {f_out:f_new, f_in:f_new})
+            automaton = Word_automaton(new_g, search.head_name)
+            expected = not automaton.has_cycle() and all((concat_word(w, solution), get_path(new_g, w)) in old_paths for w in simple_path_words(automaton))
+            verdicts.add(expected)
+            assert chimera_check(search, cc, f_out, f_in, g, eqs, solution) == expected
+    assert verdicts == {True, False}
+
+def test_chimera_checks_share_the_original_words(monkeypatch):
+    checks = []
+    def checked(search, cc, f_out, f_in, g, eqs, solution, old_paths=None, old_prefixes=None):
+        verdict = chimera_check(search, cc, f_out, f_in, g, eqs, solution, old_paths, old_prefixes)
+        assert old_paths == old_words(g, eqs, solution) and verdict == chimera_check(search, cc, f_out, f_in, g, eqs, solution)
+        checks.append(old_paths)
+        return verdict
+    monkeypatch.setattr(optimize, 'chimera_check', checked)
+    run_search(Config(beam_size=10, grammar_cost=mdl_2d, overall_cost=hsize_grammar))
+    assert len(checks) > len(set(map(id, checks))) # built once per grammar, not once per pair
+
+@pytest.mark.parametrize('hsize_aux', [hsize_grammar, hsize_ord, hsize_sum])
+def test_best_grammars_keep_ties_in_record_order(hsize_aux):
+    rng = random.Random(9)
+    for k in (1, 3, 20):
+        best, recorded = Best_grammars(k, hsize_aux), []
+        for h in range(200):
+            mdl = (rng.randint(0, 4), rng.randint(0, 2))
+            best.add(h, mdl)
+            recorded.append((h, mdl))
+        stable = [h for h, mdl in sorted(recorded, key=lambda x: hsize_aux(x[1]))] # sorting is stable
+        assert best.top(k) == stable[:k] and best.top(2) == stable[:min(k, 2)]
+
+@pytest.mark.parametrize('cutoff', [0, 2, 5, None])
+def test_apply_fun_beam(cutoff):
+    rng = random.Random(10)
+    search = Search('c', mdl_2d, mdl_cfg, hsize_sum)
+    found = set()
+    def expand(search, h, queue_out): # new grammars with many tied costs
+        for i in range(rng.randint(0, 6)):
+            new_hash = rng.getrandbits(64)
+            found.add(new_hash)
+            search.record(new_hash, (rng.randint(0, 3), rng.randint(0, 2)))
+            search.results[new_hash] = Step(None, None, None, None, None, None)
+            queue_out.add(new_hash)
+        return queue_out
+    queue = {0}
+    search.record(0, (3, 3))
+    search.results[0] = Step(None, None, None, None, None, None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for level in range(4):
+            queue = apply_fun(search, expand, queue, cutoff)
+            ranked = sorted(queue, key=lambda h: search.results[h].rank)
+            assert [search.results[h].rank for h in ranked] == list(range(len(queue)))
+            assert [search.hsize(h) for h in ranked] == sorted(search.hsize(h) for h in queue)
+            if cutoff != None and len(queue) > cutoff + 1: # only ties with the last kept grammar go past the cutoff
+                assert search.hsize(ranked[-1]) == search.hsize(ranked[cutoff])
+            assert all(search.hsize(h) > search.hsize(ranked[-1]) for h in found - queue)
+            search.processed.update(queue)
+            found.clear()
+
+@pytest.mark.parametrize('grammar_cost, beam_size', [(mdl_1d, 5), (mdl_2d, 20)])
+def test_parallel_search_matches_serial(grammar_cost, beam_size):
+    searches = [run_search(Config(beam_size=beam_size, grammar_cost=grammar_cost, overall_cost=hsize_grammar, jobs=jobs))[0] for jobs in (1, 2)]
+    serial, parallel = searches
+    assert list(parallel.mdls.items()) == list(serial.mdls.items()) # recorded in the same order, with the same costs
+    assert parallel.best.top(50) == serial.best.top(50) and parallel.lcounter == serial.lcounter
@@ -0,0 +1,43 @@
+import os, pickle, subprocess, sys, threading
+from utils import *
+
+def other_process(code, seed): # pickled result of code run under another string hash seed
+    env = dict(os.environ, PYTHONHASHSEED=str(seed))
+    return pickle.loads(subprocess.run([sys.executable, '-c', code], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       capture_output=True, check=True).stdout)
+
+
+def test_bundle_hash_is_structural():
+    a, b = Bundle([Feature(rsel, 'v'), Feature(cat, 't')]), Bundle((Feature(rsel, 'v'), Feature(cat, 't')))
+    assert a == b and hash(a) == hash(b)
+    assert a != Bundle([Feature(cat, 't'), Feature(rsel, 'v')])
+    assert {a: 1}[b] == 1
+
+def test_bundle_unpickled_from_another_process():
+    code = "import pickle, sys; from utils import *; sys.stdout.buffer.write(pickle.dumps(Bundle([Feature(rsel, 'v'), Feature(cat, 't')])))"
+    for seed in (1, 2):
+        b = other_process(code, seed)
+        assert b == Bundle([Feature(rsel, 'v'), Feature(cat, 't')])
+        assert {b: 1}[Bundle([Feature(rsel, 'v'), Feature(cat, 't')])] == 1
+
+def test_register_keeps_the_first_instance(): # what a thread that lost the race to intern a key sees
+    first = SFeature(cat, 'interned_first')
+    late = object.__new__(SFeature)
+    late.type, late.name, late.cin, late.cout, late.vanilla_sf = cat, 'interned_first', None, None, None
+    assert SFeature.register(late, (cat, 'interned_first', None, None)) is first
+    assert SFeature.by_id[first.id] is first and not hasattr(late, 'id')
+
+def test_interning_across_threads():
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6) # switch threads as often as possible
+    try:
+        barrier, made = threading.Barrier(8), [[] for i in range(8)]
+        def intern(i):
+            barrier.wait()
+            made[i].extend(MFeature('threaded', j) for j in range(200))
+        threads = [threading.Thread(target=intern, args=(i,)) for i in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+    finally: sys.setswitchinterval(switch)
+    assert all(m == made[0] and all(a is b for a, b in zip(m, made[0])) for m in made)
+    assert all(MFeature.by_id[f.id] is f for f in made[0])
@@ -0,0 +1,51 @@
+import os
+from itertools import product
+import pytest
+from words import *
+from benchmarks import plain_mg
+from optimize import preprocess_mg, old_words, get_path_single
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch): # lexica are read relative to the repo
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+def simple_path_words(automaton): # morpheme tuples along every path from nstart to nend without a repeated state
+    words, stack = set(), [[nstart]]
+    while stack:
+        path = stack.pop()
+        for nxt in automaton.succ.get(path[-1], ()):
+            if nxt == nend: words.update(product(*[automaton.labels[(path[i], path[i+1])] for i in range(len(path)-1)]))
+            elif not nxt in path: stack.append(path + [nxt])
+    return words
+
+def lexicon(name):
+    start, mg = plain_mg(name)
+    g, eqs, solution = preprocess_mg(mg, start)
+    return start, g, eqs, solution
+
+
+@pytest.mark.parametrize('name', ['eng', 'eng_one_op', 'there_high'])
+def test_words_are_the_simple_paths(name):
+    start, g, eqs, solution = lexicon(name)
+    automaton = Word_automaton(g, start)
+    words = list(automaton.words())
+    assert len(words) == len(set(words)) and set(words) == simple_path_words(automaton) == set(eqs.values())
+    assert not automaton.has_cycle()
+
+def test_has_cycle():
+    start, g, eqs, solution = lexicon('eng')
+    automaton = Word_automaton(g, start)
+    assert not automaton.has_cycle()
+    state = next(s for s in automaton.succ[nstart] if s != nend)
+    automaton.succ.setdefault(state, set()).add(nstart) # back to the start
+    assert automaton.has_cycle()
+
+def test_within():
+    start, g, eqs, solution = lexicon('eng')
+    automaton = Word_automaton(g, start)
+    piece = lambda m, is_first, is_last: (solution[m], get_path_single(g[m], is_first, is_last))
+    keys = old_words(g, eqs, solution)
+    assert automaton.within(piece, keys)
+    for key in keys: # every key belongs to a word, so each one is needed
+        assert not automaton.within(piece, keys - {key})
+    assert not automaton.within(piece, frozenset())
@@ -1,8 +1,10 @@
 
 import re
+import threading
 
 from datetime import datetime, timedelta
-from collections import UserList, namedtuple, Sequence, Counter, OrderedDict
+from collections import UserList, namedtuple, Counter, OrderedDict
+from collections.abc import Sequence
 from pprint import pprint, pformat
 from math import log2, inf
 from itertools import product, chain, combinations
@@ -10,6 +12,15 @@ from itertools import product, chain, combinations
 palette_hex = ["#F7931D", "#00B9F1", " #00A875", "#ECDE38", " #0072BC", "#F15A22", " #DA6FAB"]
 default_hex = "#000000"
 
+numpy_cache = [] # [numpy, or None without it], filled on first use
+
+def load_numpy(): # imported on first use, so that importing the modules does not pay for NumPy
+    if not numpy_cache:
+        try: import numpy
+        except ImportError: numpy = None
+        numpy_cache.append(numpy)
+    return numpy_cache[0]
+
 def require_input():
     input("Enter to continue...")
     
@@ -24,14 +35,25 @@ def pf(obj):
         return pformat(obj)
         
 def pprint_tree(t, sep="", inherit=""): # pretty-print n-ary tree in preorder; assuming (node_label, is_terminal_below)
-    parent = pf(t[0][0])
-    if t[0][1] == True: # terminal node directly below
-        print("{}╴{}  '{}'".format(sep, parent,pname(t[1])))
-    else: # non-terminal node directly below
-        print("{}╴{}".format(sep, parent))
-        for c in t[1:-1]:
-            pprint_tree(c, inherit+" ├──", inherit+" │  ")
-        pprint_tree(t[-1], inherit+" └──", inherit+"    ")
+    stack = [(t, sep, inherit)]
+    while stack:
+        t, sep, inherit = stack.pop()
+        parent = pf(t[0][0])
+        if t[0][1] == True: # terminal node directly below
+            print("{}╴{}  '{}'".format(sep, parent,pname(t[1])))
+        else: # non-terminal node directly below
+            print("{}╴{}".format(sep, parent))
+            stack.append((t[-1], inherit+" └──", inherit+"    "))
+            stack.extend((c, inherit+" ├──", inherit+" │  ") for c in reversed(t[1:-1]))
+
+def postorder(t): # nodes of a derivation tree, children before parents, left to right, without recursion
+    nodes, stack = [], [t]
+    while stack: # preorder, right to left
+        t = stack.pop()
+        nodes.append(t)
+        if t[0][1] != True: stack.extend(t[1:])
+    nodes.reverse()
+    return nodes
                 
 def pprint_trie(d, sep="", inherit="", parent=""): # pretty-print trie
     if not isinstance(d, dict):
@@ -93,6 +115,10 @@ def pretty_sentence(s):
 class Bundle(Sequence):
     def __init__(self, a):
         self.tup = tuple(a)
+        self.hash = hash(self.tup) # structural; computed once, since bundles are never modified
+    
+    def __reduce__(self): # string hashes differ between processes: recompute on unpickling
+        return (Bundle, (self.tup,))
         
     def __repr__(self):
         return " ".join([pf(f) for f in self])
@@ -103,8 +129,11 @@ class Bundle(Sequence):
     def __getitem__(self, index):
         return self.tup[index]
         
+    def __iter__(self): # Sequence would go through __getitem__ one index at a time
+        return iter(self.tup)
+        
     def __eq__(self, other):
-        return self.tup == other.tup
+        return self.hash == other.hash and self.tup == other.tup
         
     def __gt__ (self, other):
         return other.tup < self.tup
@@ -113,7 +142,7 @@ class Bundle(Sequence):
         return other.tup > self.tup
     
     def __hash__(self):
-        return hash(repr(self)) # TODO: fix this!! Hash should have nothing to do with pretty-printing!
+        return self.hash
         
     def __add__(self, other):
         return self.tup + other
@@ -242,36 +271,79 @@ def powerset(l):
     return chain.from_iterable(combinations(l, r) for r in range(1, len(l)+1))
 
 
-class MFeature:
-    def __init__(self, name, value, is_lex=None):
-        self.name = name
-        self.value = value
-        self.is_lex = is_lex
-        self.tup = (self.name, self.value, self.is_lex)
+class Interned: # flyweight: one shared instance per distinct value, hashed and compared by a small integer id
+    __slots__ = ()
+    lock = threading.Lock() # the table lookup in __new__ and the insert here are separate steps
+    
+    @classmethod
+    def register(cls, obj, key): # obj, or the instance another thread registered for key first
+        with Interned.lock:
+            if key in cls.table: return cls.table[key]
+            obj.id = len(cls.by_id)
+            cls.by_id.append(obj)
+            cls.table[key] = obj
+        return obj
+    
+    @classmethod
+    def from_id(cls, i): # convert the compact form back
+        return cls.by_id[i]
+
+    def __eq__(self, other):
+        return self is other
+    
+    def __hash__(self):
+        return self.id
+    
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return self
+
+
+class MFeature(Interned):
+    __slots__ = ('name', 'value', 'is_lex', 'id')
+    table, by_id = {}, []
+    
+    def __new__(cls, name, value, is_lex=None):
+        key = (name, value, is_lex)
+        try: return cls.table[key]
+        except KeyError:
+            mf = object.__new__(cls)
+            mf.name, mf.value, mf.is_lex = key
+            return cls.register(mf, key)
+    
+    def __reduce__(self):
+        return (MFeature, self.tup)
+    
+    @property
+    def tup(self):
+        return (self.name, self.value, self.is_lex)
 
     def __repr__(self):
         if self.value is None: return ''
         else: return f'{self.name}:{self.value}{"!" if self.is_lex else ""}'
     
-    def __eq__(self, other):
-        return self.tup == other.tup
-    
     def __gt__ (self, other):
         return other.tup < self.tup
         
     def __lt__ (self, other):
         return other.tup > self.tup
     
-    def __hash__(self):
-        return hash((self.tup))
-    
     def compatible(self):
         return MFeature(self.name, self.value, None)
 
 
-class MBundle(tuple):
+class MBundle(Interned, tuple):
+    table, by_id = {}, []
+    
     def __new__ (cls, items):
-        return super(MBundle, cls).__new__(cls, tuple(sorted(items)))
+        key = tuple(sorted(items))
+        try: return cls.table[key]
+        except KeyError: return cls.register(super(MBundle, cls).__new__(cls, key), key)
+    
+    def __reduce__(self):
+        return (MBundle, (tuple(self),))
 
     def __repr__(self):
         return f'[{",".join([f.__repr__() for f in self if f.value is not None])}]'
@@ -283,13 +355,25 @@ class MBundle(tuple):
         return(MBundle(map(lambda x: x.compatible(), self)))
 
 
-class SFeature:
-    def __init__(self, type, name, cin=None, cout=None):
-        self.type = type
-        self.name = name
-        self.cin = cin
-        self.cout = cout
-        self.tup = (self.type, self.name, self.cin, self.cout)
+class SFeature(Interned):
+    __slots__ = ('type', 'name', 'cin', 'cout', 'id', 'vanilla_sf')
+    table, by_id = {}, []
+    
+    def __new__(cls, type, name, cin=None, cout=None):
+        key = (type, name, cin, cout)
+        try: return cls.table[key]
+        except KeyError:
+            sf = object.__new__(cls)
+            sf.type, sf.name, sf.cin, sf.cout = key
+            sf.vanilla_sf = None # computed on first request
+            return cls.register(sf, key)
+    
+    def __reduce__(self):
+        return (SFeature, self.tup)
+    
+    @property
+    def tup(self):
+        return (self.type, self.name, self.cin, self.cout)
     
     def joined(self, do_cin, compatible=False):
         return ','.join([(f.compatible() if compatible else f).__repr__() for f in (self.cin if do_cin else self.cout)])
@@ -299,23 +383,19 @@ class SFeature:
         cout_str = '' if self.cout is None else '[{}]→'.format(self.joined(do_cin=False))
         return f'{self.type[0]}{self.name}{self.type[1]}{cin_str}{cout_str}'
     
-    def __eq__(self, other):
-        return self.tup == other.tup
-    
     def __gt__ (self, other):
         return other.tup < self.tup
         
     def __lt__ (self, other):
         return other.tup > self.tup
     
-    def __hash__(self):
-        return hash((self.tup))
-    
     def vanilla(self):
-        cin_str = '' if self.cin is None else '_[{}]'.format(self.joined(do_cin=True, compatible=True))
-        cout_str = '' if self.cout is None else '_[{}]'.format(self.joined(do_cin=False, compatible=True))
-        (fst, snd) = (cin_str, cout_str) if is_pos(self) else (cout_str, cin_str)
-        return SFeature(self.type, f'{self.name}{fst}{snd}', None)
+        if self.vanilla_sf is None:
+            cin_str = '' if self.cin is None else '_[{}]'.format(self.joined(do_cin=True, compatible=True))
+            cout_str = '' if self.cout is None else '_[{}]'.format(self.joined(do_cin=False, compatible=True))
+            (fst, snd) = (cin_str, cout_str) if is_pos(self) else (cout_str, cin_str)
+            self.vanilla_sf = SFeature(self.type, f'{self.name}{fst}{snd}', None)
+        return self.vanilla_sf
     
     def stripped(self):
         return SFeature(self.type, f'{self.name}', None, None)
@@ -406,17 +486,20 @@ class Node():
 
 
 def to_node(li, parent=None, is_term=False):
-    n = Node(parent=parent)
-    if is_term:
-        data = li[0]
-        child = Node(data=li[1], parent=n, children=None)
-        children = [child,]
-        child.fringe = fringe = children
-    else:
-        (data, next_term) = li[0]
-        children = [to_node(c, parent=n, is_term=next_term) for c in li[1:]]
-        fringe = [leaf for c in children for leaf in c.fringe]
-    n.data = data
-    n.children = children
-    n.fringe = fringe
-    return n
+    root = Node(parent=parent)
+    inner, stack = [], [(li, root, is_term)]
+    while stack: # preorder
+        li, n, is_term = stack.pop()
+        if is_term:
+            n.data = li[0]
+            child = Node(data=li[1], parent=n, children=None)
+            n.children = [child,]
+            child.fringe = n.fringe = n.children
+        else:
+            (n.data, next_term) = li[0]
+            n.children = [Node(parent=n) for c in li[1:]]
+            stack.extend([(c, child, next_term) for c, child in zip(li[1:], n.children)])
+            inner.append(n)
+    for n in reversed(inner): # children before parents
+        n.fringe = [leaf for c in n.children for leaf in c.fringe]
+    return root
@@ -0,0 +1,98 @@
+# Words of a grammar as a finite-state automaton over categories: a word is a path from nstart to nend, read off its edge labels
+
+from utils import *
+
+
+class Word_automaton:
+    def __init__(self, mg, head_name):
+        self.succ, self.labels = {}, {} # {state: {next states}}, {(state, next state): {LIs}}
+        self.final = set([head_name]) # states with an edge to nend
+        dict_append(self.succ, head_name, nend, True) # sentence category is always allowed to terminate words
+
+        for li_mor, li_syn in mg.items():
+            li_cat_val = get_cat(li_syn)
+            li_sels = [f for f in li_syn if is_sel(f)]
+
+            if li_sels and is_msel(li_sels[0]): rem_sels, vstart = li_sels[1:], li_sels[0].val # affix; edge from first sel to cat
+            else: rem_sels, vstart = li_sels[0:], nstart # not affix; edge from start to cat
+
+            dict_append(self.succ, vstart, li_cat_val, True)
+            dict_append(self.labels, (vstart, li_cat_val), li_mor, True)
+
+            for li_sel in rem_sels: # all selectors except strong/weak if present
+                dict_append(self.succ, li_sel.val, nend, True) # end words from all selected categories
+                self.final.add(li_sel.val)
+
+    def has_cycle(self):
+        done, on_path = set(), set()
+        for root in list(self.succ):
+            if root in done: continue
+            stack = [(root, iter(self.succ[root]))]
+            on_path.add(root)
+            while stack:
+                state, nexts = stack[-1]
+                nxt = next((w for w in nexts if not w in done), None)
+                if nxt == None:
+                    stack.pop()
+                    on_path.discard(state)
+                    done.add(state)
+                elif nxt in on_path: return True
+                else:
+                    on_path.add(nxt)
+                    stack.append((nxt, iter(self.succ.get(nxt, ()))))
+        return False
+
+    def words(self): # morpheme tuples along simple paths, in the order networkx's all_simple_paths would give them
+        path, stack = [nstart], [iter(self.succ.get(nstart, ()))]
+        while stack:
+            nxt = next((w for w in stack[-1] if not w in path), None)
+            if nxt == None:
+                stack.pop()
+                path.pop()
+            elif nxt == nend:
+                yield from product(*[self.labels[(path[i], path[i+1])] for i in range(len(path)-1)])
+            else:
+                path.append(nxt)
+                stack.append(iter(self.succ.get(nxt, ())))
+
+    def live(self): # states from which a word can be completed
+        pred = {}
+        for state, nexts in self.succ.items():
+            for w in nexts: dict_append(pred, w, state, True)
+        live, stack = set(self.final), list(self.final)
+        while stack:
+            for v in pred.get(stack.pop(), ()):
+                if not v in live:
+                    live.add(v)
+                    stack.append(v)
+        return live
+
+    def within(self, piece, keys, prefixes=None): # whether every word has its key in keys; the automaton must be acyclic
+        # a key is the sum of piece(m, is_first, is_last) over the morphemes m of a word, so a word whose prefix
+        # matches no key prefix fails as soon as it is read, without enumerating its continuations
+        live = self.live()
+        if not keys: return not nstart in live # no key, so there must be no word
+        if prefixes == None: prefixes = key_prefixes(keys)
+        empty = tuple(x[:0] for x in next(iter(keys)))
+
+        stack = [(nstart, empty, True)]
+        while stack:
+            state, read, is_first = stack.pop()
+            for nxt in self.succ.get(state, ()):
+                if not nxt in live: continue
+                for m in self.labels[(state, nxt)]:
+                    if nxt in self.final:
+                        word = tuple(x + y for x, y in zip(read, piece(m, is_first, True)))
+                        if not word in keys: return False
+                    if any(w != nend and w in live for w in self.succ.get(nxt, ())):
+                        prefix = tuple(x + y for x, y in zip(read, piece(m, is_first, False)))
+                        if not all(x in ps for x, ps in zip(prefix, prefixes)): return False
+                        stack.append((nxt, prefix, False))
+        return True
+
+
+def key_prefixes(keys): # prefixes of each key component, checked separately; can be shared by every within() call on the same keys
+    prefixes = [set() for x in next(iter(keys), ())]
+    for key in keys:
+        for x, ps in zip(key, prefixes): ps.update(x[:i] for i in range(len(x)+1))
+    return prefixes